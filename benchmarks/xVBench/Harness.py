@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+
+# xVector Engine Benchmark Suite
+# Copyright (c) 2012 James Buchwald
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+'''
+Timing and memory measurement for the benchmark suite.
+
+A benchmark is a function which performs a fixed number of operations on a
+fixture built by a setup function.  Each benchmark is timed the same way
+timeit does it: the cyclic garbage collector is switched off, the number of
+calls per round is raised until a round takes long enough to time reliably,
+and then several rounds are timed.  Times are reported per operation; the
+median of the rounds is the figure to compare between runs, the best round
+shows what the code can do on a quiet machine.
+
+Two memory figures are taken for every benchmark, both of which are exact
+and don't depend on what else the process has done:
+
+  - fixture: the objects reachable from the fixture and their total size,
+    measured the same way as the server's memory reports.
+  - retained: the number of objects tracked by the garbage collector which
+    are still alive after a call but weren't before it.  Anything other than
+    zero for a benchmark which shouldn't keep anything is a leak.
+
+Results are written as JSON so that runs can be kept and compared against
+later versions of the code (see Compare()).
+'''
+
+import gc
+import json
+import platform
+import sys
+import time
+import types
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows.
+    resource = None
+
+ResultsFormat = 1
+'''Version of the results file format.'''
+
+MaxCallsPerRound = 1000000
+'''Upper limit on the number of calls timed in a single round.'''
+
+SharedTypes = (type, types.ModuleType, types.FunctionType,
+               types.BuiltinFunctionType, types.CodeType, types.FrameType,
+               types.ClassType, types.MethodType)
+'''Types which belong to the program rather than its data.'''
+
+# Pick the most precise timer available, the same way timeit does.
+if sys.platform == "win32":
+    Timer = time.clock
+else:
+    Timer = time.time
+
+
+class Benchmark(object):
+    '''
+    A single benchmark.
+    '''
+    
+    def __init__(self, name, run, setup=None, ops=1, fresh=False,
+                 params=None):
+        '''
+        Declares a benchmark.
+        
+        @type name: string
+        @param name: Dotted name of the benchmark, starting with the module
+        being measured (for example "Maps.64x64x5.Load").
+        
+        @type run: callable
+        @param run: Function which performs the operations being measured.
+        It is called with the fixture as its only argument.
+        
+        @type setup: callable
+        @param setup: Function which builds the fixture, or None if the
+        benchmark doesn't need one.  Setup is never timed.
+        
+        @type ops: integer
+        @param ops: Number of operations performed by one call of run.
+        
+        @type fresh: bool
+        @param fresh: If True, the fixture is rebuilt before every call.  Use
+        this for benchmarks which change their fixture.
+        
+        @type params: dict
+        @param params: Values describing the benchmark's input, copied into
+        the results.
+        '''
+        self.Name = name
+        '''Dotted name of the benchmark.'''
+        self.Run = run
+        '''Function which performs the operations being measured.'''
+        self.Setup = setup
+        '''Function which builds the fixture, or None.'''
+        self.Ops = ops
+        '''Number of operations performed by one call of Run.'''
+        self.Fresh = fresh
+        '''If True, the fixture is rebuilt before every call.'''
+        self.Params = params or {}
+        '''Values describing the benchmark's input.'''
+    
+    def MakeFixture(self):
+        '''
+        Builds a new fixture.
+        '''
+        if self.Setup is None:
+            return None
+        return self.Setup()
+
+
+def DeepSize(root):
+    '''
+    Measures the memory held by an object and everything it refers to.
+    
+    @param root: Object to measure.
+    
+    @return: Tuple (number of objects, total size in bytes).
+    '''
+    count = 0
+    size = 0
+    seen = set()
+    pending = [root]
+    while pending:
+        obj = pending.pop()
+        key = id(obj)
+        if key in seen or isinstance(obj, SharedTypes):
+            continue
+        seen.add(key)
+        count += 1
+        size += sys.getsizeof(obj)
+        pending.extend(gc.get_referents(obj))
+    return (count, size)
+
+
+def _TimeCalls(bench, fixture, calls):
+    '''
+    Times a number of calls of a benchmark.
+    
+    @return: Total time taken, in seconds.
+    '''
+    run = bench.Run
+    if not bench.Fresh:
+        start = Timer()
+        for i in xrange(calls):
+            run(fixture)
+        return Timer() - start
+    
+    # Only the calls are timed, not the setup between them.
+    total = 0.0
+    for i in xrange(calls):
+        fixture = bench.MakeFixture()
+        start = Timer()
+        run(fixture)
+        total += Timer() - start
+    return total
+
+
+def _Retained(bench, fixture):
+    '''
+    Counts the objects left alive by a single call of a benchmark.
+    '''
+    gc.collect()
+    before = len(gc.get_objects())
+    if bench.Fresh:
+        # Whatever the call adds to its own fixture goes away with it, so
+        # only what outlives the fixture is counted.
+        bench.Run(bench.MakeFixture())
+    else:
+        bench.Run(fixture)
+    gc.collect()
+    return len(gc.get_objects()) - before
+
+
+def _Median(values):
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+    if len(ordered) % 2:
+        return ordered[middle]
+    return (ordered[middle - 1] + ordered[middle]) / 2.0
+
+
+def Measure(bench, rounds=5, mintime=0.2):
+    '''
+    Times a benchmark and measures its memory use.
+    
+    @type bench: Benchmark
+    @param bench: Benchmark to measure.
+    
+    @type rounds: integer
+    @param rounds: Number of timed rounds.
+    
+    @type mintime: float
+    @param mintime: Minimum duration of a round in seconds.  More calls are
+    made per round until this is reached.
+    
+    @return: dict of results, as written to the results file.
+    '''
+    fixture = bench.MakeFixture()
+    fixtureobjs, fixturesize = DeepSize(fixture)
+    
+    gcenabled = gc.isenabled()
+    gc.collect()
+    gc.disable()
+    try:
+        # Warm up, then work out how many calls make a long enough round.
+        calls = 1
+        elapsed = _TimeCalls(bench, fixture, calls)
+        while elapsed < mintime and calls < MaxCallsPerRound:
+            if elapsed > 0:
+                scale = mintime / elapsed
+                calls = int(min(calls * scale * 1.2 + 1, calls * 10))
+            else:
+                calls *= 10
+            calls = min(calls, MaxCallsPerRound)
+            elapsed = _TimeCalls(bench, fixture, calls)
+        
+        # Time the rounds.
+        times = []
+        for i in xrange(rounds):
+            elapsed = _TimeCalls(bench, fixture, calls)
+            times.append(elapsed / (calls * bench.Ops))
+    finally:
+        if gcenabled:
+            gc.enable()
+    retained = _Retained(bench, fixture)
+    
+    median = _Median(times)
+    mean = sum(times) / len(times)
+    stdev = (sum((t - mean) ** 2 for t in times) / len(times)) ** 0.5
+    return {
+            "name": bench.Name,
+            "params": bench.Params,
+            "ops": bench.Ops,
+            "calls": calls,
+            "rounds": rounds,
+            "best": min(times),
+            "median": median,
+            "mean": mean,
+            "stdev": stdev,
+            "ops_per_sec": (1.0 / median) if median else None,
+            "fixture_objects": fixtureobjs,
+            "fixture_bytes": fixturesize,
+            "retained_objects": retained,
+           }
+
+
+def PeakMemory():
+    '''
+    Returns the peak resident size of the process in kilobytes, or None if
+    it isn't available on this platform.
+    '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        # Reported in bytes rather than kilobytes.
+        peak //= 1024
+    return peak
+
+
+def Environment():
+    '''
+    Describes the machine and software the benchmarks ran on.
+    
+    @return: dict copied into the results file.
+    '''
+    from xVLib import Version
+    version = "%i.%i%s" % (Version.MajorVersion, Version.MinorVersion,
+                           Version.LetterVersion)
+    return {
+            "engine_version": version,
+            "engine_build": Version.UniqueVersionID,
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+           }
+
+
+def WriteResults(path, environment, settings, results, skipped):
+    '''
+    Writes a results file.
+    
+    @type path: string
+    @param path: Path of the file to write.
+    
+    @type environment: dict
+    @param environment: Description of the machine, from Environment().
+    
+    @type settings: dict
+    @param settings: Settings the benchmarks were run with.
+    
+    @type results: list
+    @param results: Results of the benchmarks, from Measure().
+    
+    @type skipped: list
+    @param skipped: (name, reason) tuples of benchmark groups which couldn't
+    be run.
+    
+    @raise IOError: Raised if the file can't be written.
+    '''
+    document = {
+                "format": ResultsFormat,
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "environment": environment,
+                "settings": settings,
+                "peak_rss_kb": PeakMemory(),
+                "results": results,
+                "skipped": [{"name": name, "reason": reason}
+                            for name, reason in skipped],
+               }
+    with open(path, "w") as fileobj:
+        json.dump(document, fileobj, indent=1, sort_keys=True)
+        fileobj.write("\n")
+
+
+def LoadResults(path):
+    '''
+    Reads a results file.
+    
+    @type path: string
+    @param path: Path of the file to read.
+    
+    @raise IOError: Raised if the file can't be read.
+    @raise ValueError: Raised if the file isn't a results file.
+    
+    @return: dict mapping benchmark names to their results.
+    '''
+    with open(path, "r") as fileobj:
+        document = json.load(fileobj)
+    if not isinstance(document, dict) or "results" not in document:
+        raise ValueError("%s is not a benchmark results file" % path)
+    if document.get("format") != ResultsFormat:
+        msg = "%s has unsupported results format %s"
+        raise ValueError(msg % (path, document.get("format")))
+    return dict((result["name"], result) for result in document["results"])
+
+
+def Compare(baseline, results, threshold=0.1):
+    '''
+    Compares results against an earlier run.
+    
+    @type baseline: dict
+    @param baseline: Earlier results, from LoadResults().
+    
+    @type results: list
+    @param results: New results, from Measure().
+    
+    @type threshold: float
+    @param threshold: Fraction by which the median time or the retained
+    object count may grow before it counts as a regression.
+    
+    @return: List of (name, old median, new median, ratio, regressed) tuples
+    for the benchmarks found in both runs.
+    '''
+    rows = []
+    for result in results:
+        old = baseline.get(result["name"])
+        if old is None or not old["median"]:
+            continue
+        ratio = result["median"] / old["median"]
+        regressed = ratio > 1.0 + threshold
+        retained = result.get("retained_objects", 0)
+        if retained > old.get("retained_objects", 0):
+            regressed = True
+        rows.append((result["name"], old["median"], result["median"], ratio,
+                     regressed))
+    return rows
+
+
+def PrintComparison(path, rows):
+    '''
+    Prints the rows returned by Compare() as a table.
+    
+    @type path: string
+    @param path: Path of the earlier results file.
+    
+    @return: True if any benchmark regressed.
+    '''
+    print
+    print "Compared with %s:" % path
+    print "%-48s %12s %12s %8s" % ("benchmark", "before", "after", "change")
+    regressions = False
+    for name, old, new, ratio, regressed in rows:
+        flag = "  REGRESSION" if regressed else ""
+        print "%-48s %12s %12s %+7.1f%%%s" % (name, FormatTime(old),
+                                              FormatTime(new),
+                                              (ratio - 1.0) * 100, flag)
+        regressions = regressions or regressed
+    return regressions
+
+
+def FormatTime(seconds):
+    '''
+    Formats a time with a sensible unit.
+    '''
+    if seconds >= 1.0:
+        return "%.3f s" % seconds
+    elif seconds >= 0.001:
+        return "%.3f ms" % (seconds * 1e3)
+    elif seconds >= 0.000001:
+        return "%.3f us" % (seconds * 1e6)
+    return "%.1f ns" % (seconds * 1e9)
@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+
+# xVector Engine Benchmark Suite
+# Copyright (c) 2012 James Buchwald
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+'''
+Benchmarks of the core library's hot paths.
+
+  - BinaryStructs: serializing and deserializing each primitive type.
+  - Packets: encoding and decoding every packet type.
+  - Networking: the receive path of BaseConnectionHandler, with a stream of
+    client packets arriving in fragments of various sizes.
+  - Maps: saving, loading and resizing maps of various sizes.
+
+All input is generated from a fixed random seed, so every run measures the
+same work.
+'''
+
+import cStringIO
+import random
+from xVLib import BinaryStructs, Maps, Networking, Packets
+from .Harness import Benchmark
+
+Seed = 0x5EED
+'''Seed of the random generator used to build input data.'''
+
+ValuesPerCall = 1000
+'''Number of values serialized per call of the BinaryStructs benchmarks.'''
+
+PacketsPerCall = 100
+'''Number of packets encoded or decoded per call of the Packets benchmarks.'''
+
+ObjectUpdatesPerPacket = 20
+'''Number of object updates in the sample UpdateObject packet.'''
+
+FragmentSizes = (1, 16, 512, 8192)
+'''Sizes of the fragments in which the receive path is fed its data.'''
+
+MapSizes = ((16, 16, 5), (64, 64, 5), (256, 256, 5))
+'''Map dimensions (width, height, depth) benchmarked.'''
+
+QuickMapSizes = ((16, 16, 5), (64, 64, 5))
+'''Map dimensions benchmarked in a quick run.'''
+
+
+def _RandomBytes(rng, length):
+    return b"".join(chr(rng.randrange(256)) for i in xrange(length))
+
+
+##
+## BinaryStructs
+##
+
+def _StructValues(rng):
+    '''
+    Builds the values used by the BinaryStructs benchmarks.
+    
+    @return: List of (name, serializer, deserializer, values) tuples.
+    '''
+    count = ValuesPerCall
+    words = [u"xVector", u"Übermensch", u"map", u"北京", u"a" * 32]
+    return [
+            ("Uint8", BinaryStructs.SerializeUint8,
+             BinaryStructs.DeserializeUint8,
+             [rng.randrange(2 ** 8) for i in xrange(count)]),
+            ("Uint16", BinaryStructs.SerializeUint16,
+             BinaryStructs.DeserializeUint16,
+             [rng.randrange(2 ** 16) for i in xrange(count)]),
+            ("Uint32", BinaryStructs.SerializeUint32,
+             BinaryStructs.DeserializeUint32,
+             [rng.randrange(2 ** 32) for i in xrange(count)]),
+            ("Sint16", BinaryStructs.SerializeSint16,
+             BinaryStructs.DeserializeSint16,
+             [rng.randrange(-2 ** 15, 2 ** 15) for i in xrange(count)]),
+            ("Sint32", BinaryStructs.SerializeSint32,
+             BinaryStructs.DeserializeSint32,
+             [rng.randrange(-2 ** 31, 2 ** 31) for i in xrange(count)]),
+            ("UTF8", BinaryStructs.SerializeUTF8,
+             BinaryStructs.DeserializeUTF8,
+             [rng.choice(words) for i in xrange(count)]),
+            ("Binary", BinaryStructs.SerializeBinary,
+             BinaryStructs.DeserializeBinary,
+             [_RandomBytes(rng, rng.randrange(1, 65))
+              for i in xrange(count)]),
+           ]
+
+
+def _StructRoundTrip(serialize, deserialize):
+    '''
+    Builds the run function of a BinaryStructs round trip benchmark.
+    '''
+    def Run(values):
+        writer = cStringIO.StringIO()
+        for value in values:
+            serialize(writer, value)
+        reader = cStringIO.StringIO(writer.getvalue())
+        for value in values:
+            deserialize(reader)
+    return Run
+
+
+def StructBenchmarks(rng):
+    '''
+    Benchmarks a round trip through each BinaryStructs type.
+    '''
+    benchmarks = []
+    for name, serialize, deserialize, values in _StructValues(rng):
+        run = _StructRoundTrip(serialize, deserialize)
+        benchmarks.append(Benchmark("BinaryStructs.%s.RoundTrip" % name, run,
+                                    setup=lambda values=values: values,
+                                    ops=len(values)))
+    return benchmarks
+
+
+##
+## Packets
+##
+
+def SamplePackets(rng):
+    '''
+    Builds one packet of every type, filled in with typical values.
+    
+    @return: List of packets, in order of packet type.
+    '''
+    samples = {}
+    for ptype, cls in Packets.PacketTypes.iteritems():
+        samples[ptype] = cls(None)
+    
+    samples[Packets.NegotiateConnection].ResumeToken = _RandomBytes(rng, 32)
+    packet = samples[Packets.ConnectionAccepted]
+    packet.ServerName = u"xVector Benchmark Server"
+    packet.ServerNewsURL = u"http://www.xvector.org/news"
+    samples[Packets.ConnectionRejected].RejectionCode = 4
+    for ptype in (Packets.Success, Packets.Failed):
+        samples[ptype].RequestSerial = rng.randrange(2 ** 32)
+        samples[ptype].ReasonCode = 1
+    samples[Packets.StartLogin].Username = u"benchmark"
+    packet = samples[Packets.LoginChallenge]
+    packet.Salt = _RandomBytes(rng, 16)
+    packet.Challenge = _RandomBytes(rng, 32)
+    packet = samples[Packets.FinishLogin]
+    packet.RequestSerial = rng.randrange(2 ** 32)
+    packet.ChallengeSolution = _RandomBytes(rng, 32)
+    samples[Packets.BadLogin].Reason = 2
+    packet = samples[Packets.Register]
+    packet.RequestSerial = rng.randrange(2 ** 32)
+    packet.Username = u"benchmark"
+    packet.Salt = _RandomBytes(rng, 16)
+    packet.PasswordHash = _RandomBytes(rng, 64)
+    packet.Email = u"benchmark@example.com"
+    packet = samples[Packets.LoginToken]
+    packet.Token = _RandomBytes(rng, 32)
+    packet.ValidFor = 300
+    packet = samples[Packets.Disconnect]
+    packet.Reason = packet.Reason_Restart
+    packet.Message = u"The server is restarting."
+    for ptype in (Packets.AddObject, Packets.DeleteObject):
+        samples[ptype].ObjectID = rng.randrange(2 ** 32)
+    packet = samples[Packets.AddObject]
+    packet.ObjectType = packet.Type_Player
+    packet.Name = u"benchmark"
+    packet.Sprite = rng.randrange(1000)
+    packet.X = rng.randrange(256)
+    packet.Y = rng.randrange(256)
+    packet.Direction = rng.randrange(4)
+    packet = samples[Packets.UpdateObject]
+    for i in xrange(ObjectUpdatesPerPacket):
+        # Most objects in view have only taken a step along one axis.
+        fields = rng.choice((packet.Field_X, packet.Field_Y,
+                             packet.Field_X | packet.Field_Direction))
+        packet.Updates.append((rng.randrange(2 ** 32), fields, 0,
+                               rng.randrange(256), rng.randrange(256),
+                               rng.randrange(4)))
+    return [samples[ptype] for ptype in sorted(samples)]
+
+
+def _Encode(packet):
+    for i in xrange(PacketsPerCall):
+        packet.GetBinaryForm()
+
+
+def _Decode(data):
+    build = Packets.BuildPacketFromStream
+    for i in xrange(PacketsPerCall):
+        build(cStringIO.StringIO(data), None)
+
+
+def PacketBenchmarks(rng):
+    '''
+    Benchmarks encoding and decoding each packet type.
+    '''
+    benchmarks = []
+    for packet in SamplePackets(rng):
+        name = type(packet).__name__[:-len("Packet")]
+        data = packet.GetBinaryForm()
+        params = {"size": len(data)}
+        benchmarks.append(Benchmark("Packets.%s.Encode" % name, _Encode,
+                                    setup=lambda packet=packet: packet,
+                                    ops=PacketsPerCall, params=params))
+        benchmarks.append(Benchmark("Packets.%s.Decode" % name, _Decode,
+                                    setup=lambda data=data: data,
+                                    ops=PacketsPerCall, params=params))
+    return benchmarks
+
+
+##
+## Networking
+##
+
+class ReceiveConnection(Networking.BaseConnectionHandler):
+    '''
+    Connection handler without a socket, fed from a list of fragments.
+    '''
+    
+    def __init__(self, fragments):
+        Networking.BaseConnectionHandler.__init__(self)
+        self.Fragments = fragments
+        '''Fragments returned by recv(), in order.'''
+        self.Next = 0
+        '''Index of the next fragment to return.'''
+        self.Received = 0
+        '''Number of packets received.'''
+    
+    def recv(self, buffer_size):
+        fragment = self.Fragments[self.Next]
+        self.Next += 1
+        return fragment
+    
+    def PacketReceived(self, packet):
+        self.Received += 1
+    
+    def OnCorruptPacket(self):
+        raise Packets.CorruptPacket("corrupt packet in benchmark stream")
+
+
+def ClientStream(rng):
+    '''
+    Builds a stream of the packets a client sends during a session.
+    
+    @return: Tuple (encoded stream, number of packets).
+    '''
+    samples = dict((packet.PacketType, packet)
+                   for packet in SamplePackets(rng))
+    session = [Packets.NegotiateConnection, Packets.Register,
+               Packets.StartLogin, Packets.FinishLogin]
+    session += [Packets.KeepAlive] * 16
+    encoded = [samples[ptype].GetBinaryForm() for ptype in session]
+    return (b"".join(encoded) * 5, len(encoded) * 5)
+
+
+def _ReceiveSetup(stream, size):
+    fragments = [stream[i:i + size] for i in xrange(0, len(stream), size)]
+    return ReceiveConnection(fragments)
+
+
+def _Receive(conn):
+    conn.Next = 0
+    conn.Received = 0
+    conn.RecvBuffer = b""
+    for i in xrange(len(conn.Fragments)):
+        conn.handle_read()
+    if conn.RecvBuffer:
+        raise Packets.IncompletePacket("stream ended inside a packet")
+
+
+def NetworkingBenchmarks(rng):
+    '''
+    Benchmarks the receive path with the data arriving in fragments.
+    '''
+    stream, count = ClientStream(rng)
+    benchmarks = []
+    for size in FragmentSizes:
+        name = "Networking.Receive.Fragment%i" % size
+        setup = lambda size=size: _ReceiveSetup(stream, size)
+        params = {"fragment": size, "bytes": len(stream), "packets": count}
+        benchmarks.append(Benchmark(name, _Receive, setup=setup, ops=count,
+                                    params=params))
+    return benchmarks
+
+
+##
+## Maps
+##
+
+def SampleMap(rng, width, height, depth):
+    '''
+    Builds a map with every tile set to a random sprite.
+    '''
+    newmap = Maps.BaseMap(width, height, depth)
+    newmap.MapName = u"Benchmark %ix%ix%i" % (width, height, depth)
+    for layer in newmap.tiles:
+        for column in layer:
+            for tile in column:
+                tile.tileid = rng.randrange(1024)
+    return newmap
+
+
+def _Save(mapobj):
+    mapobj.SaveToOpenFile(cStringIO.StringIO())
+
+
+def _Load(data):
+    Maps.BaseMap().LoadFromOpenFile(cStringIO.StringIO(data))
+
+
+def _Grow(mapobj):
+    mapobj.Resize(mapobj.Width + mapobj.Width // 4,
+                  mapobj.Height + mapobj.Height // 4, mapobj.Depth + 1)
+
+
+def _Shrink(mapobj):
+    mapobj.Resize(mapobj.Width - mapobj.Width // 4,
+                  mapobj.Height - mapobj.Height // 4, mapobj.Depth - 1)
+
+
+def MapBenchmarks(rng, sizes):
+    '''
+    Benchmarks saving, loading and resizing maps.
+    '''
+    benchmarks = []
+    for width, height, depth in sizes:
+        prefix = "Maps.%ix%ix%i." % (width, height, depth)
+        params = {"width": width, "height": height, "depth": depth,
+                  "tiles": width * height * depth}
+        mapobj = SampleMap(rng, width, height, depth)
+        writer = cStringIO.StringIO()
+        mapobj.SaveToOpenFile(writer)
+        data = writer.getvalue()
+        
+        benchmarks.append(Benchmark(prefix + "Save", _Save,
+                                    setup=lambda mapobj=mapobj: mapobj,
+                                    params=params))
+        benchmarks.append(Benchmark(prefix + "Load", _Load,
+                                    setup=lambda data=data: data,
+                                    params=dict(params, bytes=len(data))))
+        
+        # Resizing changes the map, so every call gets a new one.
+        setup = lambda w=width, h=height, d=depth: Maps.BaseMap(w, h, d)
+        benchmarks.append(Benchmark(prefix + "Grow", _Grow, setup=setup,
+                                    fresh=True, params=params))
+        benchmarks.append(Benchmark(prefix + "Shrink", _Shrink, setup=setup,
+                                    fresh=True, params=params))
+    return benchmarks
+
+
+def Collect(quick=False):
+    '''
+    Builds the core library benchmarks.
+    
+    @type quick: bool
+    @param quick: If True, leave out the largest inputs.
+    
+    @return: List of Benchmark objects.
+    '''
+    rng = random.Random(Seed)
+    benchmarks = []
+    benchmarks += StructBenchmarks(rng)
+    benchmarks += PacketBenchmarks(rng)
+    benchmarks += NetworkingBenchmarks(rng)
+    benchmarks += MapBenchmarks(rng, QuickMapSizes if quick else MapSizes)
+    return benchmarks
@@ -0,0 +1,536 @@
+# -*- coding: utf-8 -*-
+
+# xVector Engine Benchmark Suite
+# Copyright (c) 2012 James Buchwald
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+'''
+Rendering benchmarks for the client and the map editor.
+
+Synthetic maps are rendered into a QImage the size of the game window, the
+same way each program draws them:
+
+  - Client: MapRender.MapRenderer.RenderMap().
+  - Editor: the paintEvent() of xVMapEdit's MapEditWidget, driven through
+    QWidget.render(), with the layers above the current one drawn
+    translucent as in the editor.
+
+Each target is measured in three scenarios, a frame at a time:
+
+  - Full: the whole view is redrawn.
+  - Scroll: the view moves a few pixels; what is already drawn is moved
+    along and only the strip scrolled into view is drawn, as QScrollArea
+    does for the editor.
+  - Dirty: a small rectangle of one to three tiles square is redrawn, as
+    when a tile is edited or an animation frame changes.
+
+Every frame starts by advancing the tile animations by one client tick.  The
+maps are described by their size, their layer density (the fraction of
+tiles above the ground layer which hold a sprite; the ground layer is always
+full) and the fraction of those tiles whose sprite is animated.
+
+Nothing here needs a screen, but Qt must be able to create pixmaps; see
+StartApplication().
+'''
+
+import os
+import random
+from PyQt4 import QtCore, QtGui
+from xVLib import Maps
+from xVClient import MapRender, Sprite
+from .Harness import Timer
+
+Seed = 0x7113
+'''Seed of the random generator used to build maps and dirty rectangles.'''
+
+Viewport = (1024, 768)
+'''Size of the view rendered, in pixels (the client's window size).'''
+
+StaticSprites = 48
+'''Number of distinct static tile sprites.'''
+
+AnimatedSprites = 16
+'''Number of distinct animated tile sprites.'''
+
+AnimationFrames = 4
+'''Number of frames of each animated sprite.'''
+
+AnimationDelay = 100
+'''Time each animation frame is shown for, in milliseconds.'''
+
+TickLength = 25
+'''Time between frames, in milliseconds (the client runs at 40Hz).'''
+
+ScrollStep = 4
+'''Distance the view moves per frame in the Scroll scenario, in pixels.'''
+
+EditorLayer = 1
+'''Current layer of the editor; the layers above it are drawn translucent.'''
+
+
+class MapSpec(object):
+    '''
+    Description of a synthetic map.
+    '''
+    
+    def __init__(self, width, height, depth, density, animated):
+        '''
+        @type width: integer
+        @param width: Width of the map in tiles.
+        
+        @type height: integer
+        @param height: Height of the map in tiles.
+        
+        @type depth: integer
+        @param depth: Number of layers.
+        
+        @type density: float
+        @param density: Fraction of the tiles above the ground layer which
+        hold a sprite.
+        
+        @type animated: float
+        @param animated: Fraction of the sprites drawn which are animated.
+        '''
+        self.Width = width
+        '''Width of the map in tiles.'''
+        self.Height = height
+        '''Height of the map in tiles.'''
+        self.Depth = depth
+        '''Number of layers.'''
+        self.Density = density
+        '''Fraction of the tiles above the ground layer holding a sprite.'''
+        self.Animated = animated
+        '''Fraction of the sprites drawn which are animated.'''
+    
+    @property
+    def Name(self):
+        return "%ix%ix%i-d%i-a%i" % (self.Width, self.Height, self.Depth,
+                                     round(self.Density * 100),
+                                     round(self.Animated * 100))
+    
+    @property
+    def Params(self):
+        return {"width": self.Width, "height": self.Height,
+                "depth": self.Depth, "density": self.Density,
+                "animated": self.Animated}
+
+
+MapSpecs = [
+            MapSpec(40, 30, 5, 0.25, 0.0),
+            MapSpec(128, 128, 5, 0.25, 0.1),
+            MapSpec(128, 128, 5, 1.0, 0.1),
+            MapSpec(128, 128, 5, 0.5, 0.5),
+            MapSpec(512, 512, 5, 0.5, 0.1),
+           ]
+'''Maps rendered by default.'''
+
+
+def ParseMapSpec(text):
+    '''
+    Parses a map description of the form WIDTHxHEIGHTxDEPTH:DENSITY:ANIMATED,
+    for example "128x128x5:0.5:0.1".
+    
+    @raise ValueError: Raised if the description is invalid.
+    
+    @return: New MapSpec.
+    '''
+    parts = text.split(":")
+    if len(parts) != 3:
+        raise ValueError("expected WIDTHxHEIGHTxDEPTH:DENSITY:ANIMATED")
+    dims = parts[0].split("x")
+    if len(dims) != 3:
+        raise ValueError("expected WIDTHxHEIGHTxDEPTH:DENSITY:ANIMATED")
+    width, height, depth = [int(dim) for dim in dims]
+    density = float(parts[1])
+    animated = float(parts[2])
+    if width < 4 or height < 4 or depth < 1:
+        raise ValueError("maps must be at least 4x4x1")
+    if not (0.0 <= density <= 1.0 and 0.0 <= animated <= 1.0):
+        raise ValueError("density and animated fraction must be 0 to 1")
+    return MapSpec(width, height, depth, density, animated)
+
+
+def StartApplication():
+    '''
+    Creates the QApplication used for rendering.
+    
+    Qt 5 (and Qt 4 builds using QPA) are told to use the offscreen platform,
+    so no display is needed.  Ordinary Qt 4 builds for X11 still need an X
+    server to create pixmaps; under headless CI, run the benchmarks with
+    xvfb-run (the runner script does this itself when it can).
+    
+    @return: The application object.  Keep a reference to it while
+    rendering.
+    '''
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    app = QtGui.QApplication.instance()
+    if app is None:
+        app = QtGui.QApplication(["xVBench"])
+    return app
+
+
+def NeedsXServer():
+    '''
+    Checks whether Qt needs an X server which isn't there.
+    '''
+    if QtCore.QT_VERSION >= 0x50000:
+        return False
+    if not os.name == "posix" or os.uname()[0] == "Darwin":
+        return False
+    return not os.environ.get("DISPLAY")
+
+
+##
+## Synthetic content
+##
+
+def _SpritePixmap(color, rng):
+    '''
+    Draws a tile sprite: a block of color with a translucent pattern on top,
+    and a transparent corner so that the layers below show through.
+    '''
+    pixmap = QtGui.QPixmap(Maps.TileWidth, Maps.TileHeight)
+    pixmap.fill(QtCore.Qt.transparent)
+    painter = QtGui.QPainter()
+    painter.begin(pixmap)
+    painter.setPen(QtCore.Qt.NoPen)
+    painter.setBrush(QtGui.QBrush(color))
+    painter.drawRect(0, 0, Maps.TileWidth, Maps.TileHeight - 8)
+    overlay = QtGui.QColor(color).darker(150)
+    overlay.setAlpha(128)
+    painter.setBrush(QtGui.QBrush(overlay))
+    painter.drawEllipse(rng.randrange(16), rng.randrange(16), 16, 16)
+    painter.end()
+    return pixmap
+
+
+def SyntheticSprites(rng):
+    '''
+    Builds a sprite manager holding generated tile sprites.
+    
+    @return: Tuple (sprite manager, list of static sprite IDs, list of
+    animated sprite IDs).
+    '''
+    tiles = Sprite.SpriteSet()
+    tiles.type = "tile"
+    blank = Sprite.Sprite(Maps.TileWidth, Maps.TileHeight, "tile", 0)
+    tiles.append(blank)
+    
+    static = []
+    for i in xrange(StaticSprites):
+        sprite = Sprite.Sprite(Maps.TileWidth, Maps.TileHeight, "tile",
+                               len(tiles))
+        color = QtGui.QColor.fromHsv(rng.randrange(360), 160, 200)
+        sprite.img = _SpritePixmap(color, rng)
+        static.append(len(tiles))
+        tiles.append(sprite)
+    
+    animated = []
+    for i in xrange(AnimatedSprites):
+        anim = Sprite.AnimatedSprite(Maps.TileWidth, Maps.TileHeight,
+                                     AnimationDelay)
+        hue = rng.randrange(360)
+        for frame in xrange(AnimationFrames):
+            color = QtGui.QColor.fromHsv((hue + frame * 20) % 360, 200, 220)
+            anim.frames.append(_SpritePixmap(color, rng))
+        animated.append(len(tiles))
+        tiles.append(anim)
+        tiles._animations.append(anim)
+    
+    sprites = {'tiles': tiles}
+    return (sprites, static, animated)
+
+
+def SyntheticMap(rng, spec, static, animated):
+    '''
+    Builds a map according to a MapSpec.
+    
+    @type static: list
+    @param static: IDs of the static sprites to use.
+    
+    @type animated: list
+    @param animated: IDs of the animated sprites to use.
+    '''
+    newmap = Maps.BaseMap(spec.Width, spec.Height, spec.Depth)
+    for z, layer in enumerate(newmap.tiles):
+        for column in layer:
+            for tile in column:
+                if z > 0 and rng.random() >= spec.Density:
+                    continue
+                if rng.random() < spec.Animated:
+                    tile.tileid = rng.choice(animated)
+                else:
+                    tile.tileid = rng.choice(static)
+    return newmap
+
+
+##
+## Render targets
+##
+
+class RenderTarget(object):
+    '''
+    Something which renders a map into an image.
+    '''
+    
+    Name = None
+    '''Name of the target in the benchmark names.'''
+    
+    def __init__(self, viewport):
+        self.Image = QtGui.QImage(viewport[0], viewport[1],
+                                  QtGui.QImage.Format_ARGB32_Premultiplied)
+        '''Image rendered into, the size of the view.'''
+        self.Image.fill(0)
+    
+    def Render(self, x, y, width, height, origin):
+        '''
+        Renders part of the map into the image.
+        
+        @param x, y, width, height: Part of the map to render, in map
+        pixels.
+        
+        @type origin: tuple
+        @param origin: Position of the top-left corner of the view on the
+        map, in pixels.
+        '''
+        raise NotImplementedError
+    
+    def Scroll(self, dx, dy):
+        '''
+        Moves the contents of the image, the way a view is scrolled before
+        the exposed part is drawn.
+        '''
+        painter = QtGui.QPainter()
+        painter.begin(self.Image)
+        painter.drawImage(-dx, -dy, self.Image.copy())
+        painter.end()
+
+
+class ClientTarget(RenderTarget):
+    '''
+    Renders with MapRender.MapRenderer.RenderMap(), as the client does.
+    '''
+    
+    Name = "Client"
+    
+    def __init__(self, viewport, sprites, mapobj):
+        super(ClientTarget, self).__init__(viewport)
+        self.Renderer = MapRender.MapRenderer(sprites, mapobj)
+        '''Renderer drawing the map.'''
+    
+    def Render(self, x, y, width, height, origin):
+        originX, originY = origin
+        self.Renderer.RenderMap(self.Image, (x - originX, y - originY),
+                                (x, y), (-originX, -originY), width, height)
+
+
+class _EditorApp(object):
+    '''
+    Stand-in for the editor's main application, with what MapEditWidget
+    looks at.
+    '''
+    
+    def __init__(self, sprites):
+        self.Sprites = sprites
+        self.MainWindow = None
+
+
+class EditorTarget(RenderTarget):
+    '''
+    Renders with the editor's MapEditWidget.paintEvent().
+    '''
+    
+    Name = "Editor"
+    
+    def __init__(self, viewport, sprites, mapobj):
+        super(EditorTarget, self).__init__(viewport)
+        # Imported here so that the client benchmarks don't need the editor.
+        from xVMapEdit import EditorGlobals, MapWindow
+        EditorGlobals.MainApp = _EditorApp(sprites)
+        
+        # The widget expects to sit inside an editor window.
+        self._Window = QtGui.QWidget()
+        '''Stand-in for the editor sub-window.'''
+        self._Scroller = QtGui.QWidget(self._Window)
+        '''Stand-in for the scroll area holding the widget.'''
+        self.Widget = MapWindow.MapEditWidget(self._Scroller, mapobj)
+        '''Map editing widget being rendered.'''
+        self.Widget.resize(self.Widget.sizeHint())
+        self.Widget.current_layer = min(EditorLayer, mapobj.Depth - 1)
+    
+    def Render(self, x, y, width, height, origin):
+        originX, originY = origin
+        self.Widget.render(self.Image,
+                           QtCore.QPoint(x - originX, y - originY),
+                           QtGui.QRegion(x, y, width, height))
+
+
+Targets = (ClientTarget, EditorTarget)
+'''Render targets benchmarked.'''
+
+
+##
+## Scenarios
+##
+
+class View(object):
+    '''
+    Position of the view on the map.
+    '''
+    
+    def __init__(self, viewport, mapobj):
+        mapWidth = mapobj.Width * Maps.TileWidth
+        mapHeight = mapobj.Height * Maps.TileHeight
+        self.Width = min(viewport[0], mapWidth)
+        '''Width of the view in pixels.'''
+        self.Height = min(viewport[1], mapHeight)
+        '''Height of the view in pixels.'''
+        self.MaxX = mapWidth - self.Width
+        '''Largest horizontal position of the view.'''
+        self.X = self.MaxX // 2
+        '''Horizontal position of the view on the map.'''
+        self.Y = (mapHeight - self.Height) // 2
+        '''Vertical position of the view on the map.'''
+        self.Step = ScrollStep
+        '''Distance scrolled by the next frame.'''
+
+
+def _FullFrame(target, view, rng):
+    target.Render(view.X, view.Y, view.Width, view.Height, (view.X, view.Y))
+
+
+def _ScrollFrame(target, view, rng):
+    # Bounce between the edges of the map.
+    if not 0 <= view.X + view.Step <= view.MaxX:
+        view.Step = -view.Step
+    step = view.Step
+    target.Scroll(step, 0)
+    view.X += step
+    if step > 0:
+        x = view.X + view.Width - step
+    else:
+        x = view.X
+    target.Render(x, view.Y, abs(step), view.Height, (view.X, view.Y))
+
+
+def _DirtyFrame(target, view, rng):
+    columns = rng.randint(1, 3)
+    rows = rng.randint(1, 3)
+    x = rng.randrange(view.Width // Maps.TileWidth - columns + 1)
+    y = rng.randrange(view.Height // Maps.TileHeight - rows + 1)
+    target.Render(view.X + x * Maps.TileWidth, view.Y + y * Maps.TileHeight,
+                  columns * Maps.TileWidth, rows * Maps.TileHeight,
+                  (view.X, view.Y))
+
+
+Scenarios = (("Full", _FullFrame), ("Scroll", _ScrollFrame),
+             ("Dirty", _DirtyFrame))
+'''Scenarios benchmarked, as (name, frame function).'''
+
+
+def Percentile(ordered, fraction):
+    '''
+    Finds a percentile of a sorted list by the nearest-rank method.
+    '''
+    rank = int(round(fraction * len(ordered) + 0.5)) - 1
+    return ordered[max(0, min(rank, len(ordered) - 1))]
+
+
+def RunScenario(target, sprites, view, frame, frames, warmup, rng):
+    '''
+    Renders a number of frames and times each of them.
+    
+    @return: Sorted list of frame times in seconds.
+    '''
+    pump = sprites['tiles'].PumpAnimation
+    tick = 0
+    times = []
+    for i in xrange(warmup + frames):
+        tick += TickLength
+        start = Timer()
+        pump(tick)
+        frame(target, view, rng)
+        elapsed = Timer() - start
+        if i >= warmup:
+            times.append(elapsed)
+    times.sort()
+    return times
+
+
+def Measure(spec, frames=200, warmup=10, viewport=Viewport, keywords=()):
+    '''
+    Runs every target and scenario on a synthetic map.
+    
+    @type spec: MapSpec
+    @param spec: Map to render.
+    
+    @type frames: integer
+    @param frames: Number of frames timed per scenario.
+    
+    @type warmup: integer
+    @param warmup: Number of frames rendered before timing starts.
+    
+    @type viewport: tuple
+    @param viewport: Size of the view in pixels.
+    
+    @type keywords: list
+    @param keywords: If given, only run the benchmarks whose names contain
+    one of these strings.
+    
+    @return: Tuple (list of result dicts, list of (name, reason) tuples for
+    the benchmarks which couldn't be run).
+    '''
+    rng = random.Random(Seed)
+    sprites, static, animated = SyntheticSprites(rng)
+    mapobj = None
+    results = []
+    skipped = []
+    for targetClass in Targets:
+        for scenario, frame in Scenarios:
+            name = "Render.%s.%s.%s" % (targetClass.Name, spec.Name, scenario)
+            if keywords and not any(word in name for word in keywords):
+                continue
+            if mapobj is None:
+                mapobj = SyntheticMap(rng, spec, static, animated)
+            view = View(viewport, mapobj)
+            if scenario == "Scroll" and view.MaxX < ScrollStep:
+                skipped.append((name, "map is no wider than the view"))
+                continue
+            try:
+                target = targetClass(viewport, sprites, mapobj)
+            except ImportError as err:
+                skipped.append((name, "could not import: %s" % err))
+                continue
+            
+            # Start from a fully drawn view, as a real frame would.
+            _FullFrame(target, view, rng)
+            times = RunScenario(target, sprites, view, frame, frames, warmup,
+                                random.Random(Seed))
+            mean = sum(times) / len(times)
+            params = dict(spec.Params, viewport=list(viewport))
+            results.append({
+                            "name": name,
+                            "params": params,
+                            "frames": len(times),
+                            "best": times[0],
+                            "median": Percentile(times, 0.5),
+                            "p90": Percentile(times, 0.9),
+                            "p99": Percentile(times, 0.99),
+                            "max": times[-1],
+                            "mean": mean,
+                            "fps": (1.0 / mean) if mean else None,
+                           })
+    return (results, skipped)
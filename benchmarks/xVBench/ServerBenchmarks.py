@@ -0,0 +1,442 @@
+# -*- coding: utf-8 -*-
+
+# xVector Engine Benchmark Suite
+# Copyright (c) 2012 James Buchwald
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+'''
+Benchmarks of the server's hot paths.
+  
+  - IPBans: building the ban index and checking addresses against it, with
+    ban tables of various sizes.
+  - ConnectionManager: registering, updating and removing a large number of
+    connections.
+  - ServerConnection: the memory held by idle connections, and the work they
+    cost the main loop when it checks them for timeouts.
+  - Interest: moving objects around maps of various sizes and populations,
+    keeping track of which players can see them and sending the players
+    what changed.
+
+Importing this module imports xVServer and its dependencies (SQLAlchemy in
+particular); the benchmark runner skips these benchmarks if that fails.
+Nothing here touches the database, and the only network traffic is over
+loopback connections to the benchmark itself.
+'''
+
+import datetime
+import random
+import socket
+import struct
+from xVLib import ConfigurationFile, Packets
+from xVServer import ServerGlobals, IPBans, ServerNetworking, Interest
+from .Harness import Benchmark
+
+Seed = 0xBA5E
+'''Seed of the random generator used to build input data.'''
+
+BanTableSizes = (1000, 10000, 100000)
+'''Numbers of bans benchmarked.'''
+
+QuickBanTableSizes = (1000, 10000)
+'''Numbers of bans benchmarked in a quick run.'''
+
+LookupsPerCall = 1000
+'''Number of addresses checked per call of the IsBanned benchmarks.'''
+
+ConnectionCount = 10000
+'''Number of connections in the ConnectionManager benchmarks.'''
+
+IdleConnectionCount = 500
+'''
+Number of connections in the ServerConnection benchmarks.  Each one takes two
+file descriptors, so this is kept well below the usual limit of 1024.
+'''
+
+InterestWorlds = ((1000, 256), (10000, 800), (10000, 256))
+'''
+Populations and map sizes (in tiles) of the Interest benchmarks.  The first
+two are equally crowded, so moving an object should cost the same on both;
+the last is as big as the second but ten times as crowded.
+'''
+
+QuickInterestWorlds = ((1000, 256),)
+'''Populations and map sizes of the Interest benchmarks in a quick run.'''
+
+MovesPerCall = 1000
+'''Number of objects moved per call of the Interest benchmarks.'''
+
+
+##
+## IPBans
+##
+
+def _RandomIPv4(rng):
+    return socket.inet_ntoa(struct.pack("!I", rng.randrange(1, 2 ** 32)))
+
+
+def _RandomIPv6(rng):
+    packed = struct.pack("!QQ", 0x20010db800000000 | rng.randrange(2 ** 32),
+                         rng.randrange(2 ** 64))
+    return socket.inet_ntop(socket.AF_INET6, packed)
+
+
+def BanRows(rng, count):
+    '''
+    Builds a table of bans like a busy server's.
+    
+    Most bans are of single IPv4 addresses; the rest are IPv4 ranges and
+    IPv6 networks.  A quarter of them are temporary bans which haven't
+    expired yet.
+    
+    @return: List of rows in the format taken by IPBans.BanIndex.Build().
+    '''
+    later = datetime.datetime.now() + datetime.timedelta(days=30)
+    rows = []
+    for banid in xrange(1, count + 1):
+        kind = rng.random()
+        if kind < 0.7:
+            address = _RandomIPv4(rng)
+        elif kind < 0.9:
+            address = "%s/%i" % (_RandomIPv4(rng), rng.choice((16, 24, 28)))
+        else:
+            address = "%s/%i" % (_RandomIPv6(rng), rng.choice((48, 64, 128)))
+        family, low, mid, high, cidr = IPBans._ParseCIDR(address)
+        permanent = rng.random() < 0.75
+        expires = None if permanent else later
+        rows.append((banid, family, low, mid, high, cidr, permanent,
+                     expires))
+    return rows
+
+
+def Lookups(rng, rows):
+    '''
+    Builds the addresses checked by the IsBanned benchmarks.
+    
+    A tenth of them are banned, as on a server under attack from a handful
+    of known addresses; the rest are random, as connections usually are.
+    '''
+    addresses = []
+    for i in xrange(LookupsPerCall):
+        if i % 10 == 0:
+            row = rng.choice(rows)
+            family, low, mid, high = row[1:5]
+            if family == socket.AF_INET6:
+                packed = struct.pack("!QII", low, mid, high)
+                addresses.append(socket.inet_ntop(socket.AF_INET6, packed))
+            else:
+                addresses.append(socket.inet_ntoa(struct.pack("!I", high)))
+        elif i % 10 == 1:
+            addresses.append(_RandomIPv6(rng))
+        else:
+            addresses.append(_RandomIPv4(rng))
+    return addresses
+
+
+def _BuildIndex(rows):
+    IPBans.BanIndex().Build(rows)
+
+
+def _IndexSetup(rows):
+    index = IPBans.BanIndex()
+    index.Build(rows)
+    return index
+
+
+def _IsBanned(fixture):
+    index, addresses = fixture
+    IPBans.Index = index
+    isbanned = IPBans.IsBanned
+    for address in addresses:
+        isbanned(address)
+
+
+def BanBenchmarks(rng, sizes):
+    '''
+    Benchmarks building the ban index and checking addresses against it.
+    '''
+    benchmarks = []
+    for count in sizes:
+        rows = BanRows(rng, count)
+        addresses = Lookups(rng, rows)
+        prefix = "IPBans.%i." % count
+        params = {"bans": count}
+        benchmarks.append(Benchmark(prefix + "Build", _BuildIndex,
+                                    setup=lambda rows=rows: rows,
+                                    ops=count, params=params))
+        setup = lambda rows=rows, addresses=addresses: (_IndexSetup(rows),
+                                                        addresses)
+        benchmarks.append(Benchmark(prefix + "IsBanned", _IsBanned,
+                                    setup=setup, ops=len(addresses),
+                                    params=params))
+    return benchmarks
+
+
+##
+## ConnectionManager
+##
+
+class BenchConnection(object):
+    '''
+    Stand-in for a ServerConnection, with just what the manager looks at.
+    '''
+    
+    def __init__(self, number):
+        self.Address = ("10.%i.%i.%i" % (number >> 16 & 255, number >> 8 & 255,
+                                         number & 255),
+                        1024 + number % 60000)
+        '''Network address tuple of the peer.'''
+        self.Account = u"account%i" % number
+        '''Name of the account logged in to.'''
+        self.Character = u"character%i" % number
+        '''Name of the character playing.'''
+        self.LoggedIn = False
+        '''If True, the account and character names are reported.'''
+    
+    def GetAccountName(self):
+        return self.Account if self.LoggedIn else None
+    
+    def GetCharacterName(self):
+        return self.Character if self.LoggedIn else None
+
+
+class BenchApplication(object):
+    '''
+    Stand-in for the server application, with just its configuration.
+    '''
+    
+    def __init__(self):
+        self.Config = ConfigurationFile.ConfigSection()
+        '''Configuration values read by the connection manager.'''
+        network = ConfigurationFile.ConfigSection()
+        network.Connections = ConfigurationFile.ConfigSection()
+        network.Connections.Max = ConnectionCount * 2
+        network.Connections.PerIP = ConnectionCount * 2
+        network.Connections.RecvBufferLimit = 131072
+        network.Connections.SendHighWater = 262144
+        network.Connections.SendLowWater = 65536
+        network.Connections.SendBufferLimit = 1048576
+        network.Connections.SlowConsumerGrace = 15
+        self.Config.Network = network
+        self.Connections = None
+        '''Connection manager new ServerConnections register with.'''
+
+
+def _ManagerSetup(state):
+    '''
+    Builds a connection manager holding ConnectionCount connections.
+    
+    @type state: integer
+    @param state: 0 to leave the manager empty, 1 to add the connections,
+    2 to add them and log them in.
+    '''
+    # Every benchmark gets an empty ban index, whatever ran before it.
+    IPBans.Index = IPBans.BanIndex()
+    manager = ServerNetworking.ConnectionManager()
+    conns = [BenchConnection(i) for i in xrange(ConnectionCount)]
+    if state >= 1:
+        for conn in conns:
+            manager.AddConnection(conn)
+    if state >= 2:
+        for conn in conns:
+            conn.LoggedIn = True
+            manager.UpdateConnection(conn)
+    for conn in conns:
+        conn.LoggedIn = True
+    return (manager, conns)
+
+
+def _Add(fixture):
+    manager, conns = fixture
+    for conn in conns:
+        manager.AddConnection(conn)
+
+
+def _Update(fixture):
+    manager, conns = fixture
+    for conn in conns:
+        manager.UpdateConnection(conn)
+
+
+def _Remove(fixture):
+    manager, conns = fixture
+    for conn in conns:
+        manager.RemoveConnection(conn)
+
+
+def ManagerBenchmarks():
+    '''
+    Benchmarks the connection manager at ConnectionCount connections.
+    '''
+    params = {"connections": ConnectionCount}
+    prefix = "ConnectionManager.%i." % ConnectionCount
+    return [
+            Benchmark(prefix + "Add", _Add, setup=lambda: _ManagerSetup(0),
+                      ops=ConnectionCount, fresh=True, params=params),
+            Benchmark(prefix + "Update", _Update,
+                      setup=lambda: _ManagerSetup(1), ops=ConnectionCount,
+                      fresh=True, params=params),
+            Benchmark(prefix + "Remove", _Remove,
+                      setup=lambda: _ManagerSetup(2), ops=ConnectionCount,
+                      fresh=True, params=params),
+           ]
+
+
+##
+## ServerConnection
+##
+
+class IdleConnections(object):
+    '''
+    A set of idle server connections over loopback, as held by a server whose
+    players are connected but not doing anything.
+    
+    The connections are taken out of asyncore's socket map, so that nothing
+    outside the fixture refers to them and their sockets are closed when it
+    is thrown away.
+    '''
+    
+    def __init__(self, count):
+        ServerGlobals.Application.Connections = \
+                ServerNetworking.ConnectionManager()
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(128)
+        self.Clients = []
+        '''Client ends of the connections.'''
+        self.Connections = []
+        '''Server ends of the connections.'''
+        try:
+            for i in xrange(count):
+                client = socket.create_connection(listener.getsockname())
+                sock, address = listener.accept()
+                conn = ServerNetworking.ServerConnection(sock)
+                conn.del_channel()
+                self.Clients.append(client)
+                self.Connections.append(conn)
+        finally:
+            listener.close()
+        ServerGlobals.Application.Connections = None
+
+
+def _CheckTimeouts(fixture):
+    for conn in fixture.Connections:
+        conn.CheckTimeout()
+
+
+def ConnectionBenchmarks():
+    '''
+    Benchmarks idle connections.  The size of the fixture divided by the
+    number of connections is the footprint of a single idle connection (not
+    counting the kernel's socket buffers).
+    '''
+    count = IdleConnectionCount
+    return [
+            Benchmark("ServerConnection.%i.Idle" % count, _CheckTimeouts,
+                      setup=lambda: IdleConnections(count), ops=count,
+                      params={"connections": count}),
+           ]
+
+
+##
+## Interest
+##
+
+class BenchPeer(object):
+    '''
+    Stand-in for a player's connection, which encodes the packets sent to it
+    and counts their bytes instead of sending them.
+    '''
+    
+    def __init__(self):
+        self.Sent = 0
+        '''Number of bytes sent to the connection.'''
+    
+    def SendPacket(self, packet):
+        self.Sent += len(packet.GetBinaryForm())
+
+
+def _InterestSetup(population, size):
+    '''
+    Builds an area of interest manager with objects scattered over a map.
+    
+    A quarter of the objects are players; the rest are NPCs.
+    
+    @return: Tuple (manager, list of objects, random generator, map size).
+    '''
+    rng = random.Random(Seed)
+    manager = Interest.InterestManager()
+    objects = []
+    for i in xrange(population):
+        if i % 4 == 0:
+            obj = Interest.GameObject(Packets.AddObjectPacket.Type_Player,
+                                      u"player%i" % i, 1, BenchPeer())
+        else:
+            obj = Interest.GameObject(Packets.AddObjectPacket.Type_NPC,
+                                      u"npc%i" % i, 2)
+        manager.Add(obj, "bench", rng.randrange(size), rng.randrange(size))
+        objects.append(obj)
+    return (manager, objects, rng, size)
+
+
+def _Move(fixture):
+    manager, objects, rng, size = fixture
+    choice = rng.choice
+    limit = size - 1
+    for i in xrange(MovesPerCall):
+        obj = choice(objects)
+        x = min(max(obj.X + choice((-1, 0, 1)), 0), limit)
+        y = min(max(obj.Y + choice((-1, 0, 1)), 0), limit)
+        manager.Move(obj, x, y)
+    manager.Replicator.Flush()
+
+
+def InterestBenchmarks(worlds):
+    '''
+    Benchmarks random objects taking a step in a random direction.  Each
+    move works out who can see the object and what it can see; the updates
+    are then sent to the (stand-in) connections in a single round.
+    '''
+    benchmarks = []
+    for population, size in worlds:
+        name = "Interest.%i.%ix%i.Move" % (population, size, size)
+        setup = lambda population=population, size=size: \
+                _InterestSetup(population, size)
+        benchmarks.append(Benchmark(name, _Move, setup=setup,
+                                    ops=MovesPerCall,
+                                    params={"objects": population,
+                                            "map_size": size}))
+    return benchmarks
+
+
+def Collect(quick=False):
+    '''
+    Builds the server benchmarks.
+    
+    @type quick: bool
+    @param quick: If True, leave out the largest inputs.
+    
+    @return: List of Benchmark objects.
+    '''
+    ServerGlobals.Application = BenchApplication()
+    rng = random.Random(Seed)
+    benchmarks = []
+    benchmarks += BanBenchmarks(rng, QuickBanTableSizes if quick
+                                else BanTableSizes)
+    benchmarks += ManagerBenchmarks()
+    benchmarks += ConnectionBenchmarks()
+    benchmarks += InterestBenchmarks(QuickInterestWorlds if quick
+                                     else InterestWorlds)
+    return benchmarks
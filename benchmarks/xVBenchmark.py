@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+# xVector Engine Benchmark Suite
+# Copyright (c) 2012 James Buchwald
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+'''
+Runs the benchmark suite.
+
+Runs the core library and server benchmarks (see the xVBench package),
+prints a table of the results and optionally writes them to a JSON file:
+
+    python xVBenchmark.py -o results-0.1a.json
+
+Pass an earlier results file with --compare to see how each benchmark has
+changed since; the exit status is 1 if any of them got slower by more than
+the threshold or started keeping objects alive.  Pass -k to run only the
+benchmarks whose names contain a string, and --list to see the names.
+
+xVLib (and xVServer, for the server benchmarks) must be importable.  If the
+server can't be imported, its benchmarks are skipped and listed as such in
+the results.  For stable figures, run on an otherwise idle machine and
+compare only results taken on the same machine.
+'''
+
+import sys
+import optparse
+import traceback
+from xVBench import Harness
+
+
+def CollectBenchmarks(quick):
+    '''
+    Builds every benchmark which can run here.
+    
+    @return: Tuple (list of Benchmark objects, list of (group, reason)
+    tuples for the groups which were skipped).
+    '''
+    from xVBench import LibBenchmarks
+    benchmarks = LibBenchmarks.Collect(quick)
+    skipped = []
+    try:
+        from xVBench import ServerBenchmarks
+    except ImportError as err:
+        skipped.append(("ServerBenchmarks", "could not import: %s" % err))
+    else:
+        benchmarks += ServerBenchmarks.Collect(quick)
+    return (benchmarks, skipped)
+
+
+def Main():
+    '''
+    Entry point of the benchmark runner.
+    '''
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-o", "--output", default=None,
+                      help="write the results to this JSON file")
+    parser.add_option("-k", "--keyword", action="append", default=[],
+                      help="only run benchmarks whose names contain this "
+                      "(may be given more than once)")
+    parser.add_option("-r", "--rounds", type="int", default=5,
+                      help="number of timed rounds per benchmark")
+    parser.add_option("-t", "--min-time", type="float", default=0.2,
+                      dest="mintime",
+                      help="minimum duration of a round in seconds")
+    parser.add_option("-q", "--quick", action="store_true", default=False,
+                      help="leave out the largest inputs")
+    parser.add_option("-c", "--compare", default=None,
+                      help="compare against an earlier results file")
+    parser.add_option("--threshold", type="float", default=10.0,
+                      help="slowdown in percent reported as a regression "
+                      "by --compare (default: 10)")
+    parser.add_option("-l", "--list", action="store_true", default=False,
+                      help="list the benchmarks and exit")
+    options, args = parser.parse_args()
+    if options.rounds < 1:
+        parser.error("at least one round is needed")
+    
+    # Load the baseline first, so a bad path doesn't waste a whole run.
+    baseline = None
+    if options.compare:
+        try:
+            baseline = Harness.LoadResults(options.compare)
+        except (IOError, ValueError) as err:
+            print >> sys.stderr, "Could not load %s: %s" % (options.compare,
+                                                            err)
+            return 1
+    
+    # Work out what to run.
+    benchmarks, skipped = CollectBenchmarks(options.quick)
+    if options.keyword:
+        benchmarks = [bench for bench in benchmarks
+                      if any(word in bench.Name for word in options.keyword)]
+    if options.list:
+        for bench in benchmarks:
+            print bench.Name
+        return 0
+    for group, reason in skipped:
+        print "Skipping %s: %s" % (group, reason)
+    
+    # Run the benchmarks.
+    print "%-44s %12s %12s %10s %10s" % ("benchmark", "median/op", "best/op",
+                                          "fixture", "retained")
+    results = []
+    for bench in benchmarks:
+        try:
+            result = Harness.Measure(bench, options.rounds, options.mintime)
+        except Exception:
+            print "%-44s failed:" % bench.Name
+            traceback.print_exc()
+            skipped.append((bench.Name, "failed: %s" % sys.exc_info()[1]))
+            continue
+        results.append(result)
+        fixture = "%i KB" % (result["fixture_bytes"] // 1024)
+        print "%-44s %12s %12s %10s %10i" % (
+                bench.Name, Harness.FormatTime(result["median"]),
+                Harness.FormatTime(result["best"]), fixture,
+                result["retained_objects"])
+        sys.stdout.flush()
+    
+    # Write out the results.
+    if options.output:
+        settings = {"rounds": options.rounds, "min_time": options.mintime,
+                    "quick": options.quick, "keywords": options.keyword}
+        try:
+            Harness.WriteResults(options.output, Harness.Environment(),
+                                 settings, results, skipped)
+        except IOError as err:
+            print >> sys.stderr, "Could not write %s: %s" % (options.output,
+                                                             err)
+            return 1
+        print "Results written to %s." % options.output
+    
+    # Compare them.
+    status = 0
+    if baseline is not None:
+        rows = Harness.Compare(baseline, results, options.threshold / 100.0)
+        if Harness.PrintComparison(options.compare, rows):
+            status = 1
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(Main())
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+
+# xVector Engine Benchmark Suite
+# Copyright (c) 2012 James Buchwald
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+'''
+Runs the rendering benchmarks.
+
+Renders synthetic maps offscreen with the client's map renderer and the map
+editor's widget (see xVBench.RenderBenchmarks), prints the frame time
+percentiles and optionally writes them to a JSON file:
+
+    python xVRenderBenchmark.py -o render-0.1a.json
+
+Pass an earlier results file with --compare to see how the median frame time
+of each benchmark has changed since; the exit status is 1 if any of them got
+slower by more than the threshold.  Pass -m (more than once if needed) to
+render maps of your own instead of the default set, for example
+"-m 256x256x5:0.75:0.2" for a 256x256 map of 5 layers, three quarters full
+above the ground layer, a fifth of it animated.
+
+PyQt4, xVLib, xVClient and xVMapEdit must be importable.  No display is
+needed: Qt is told to use its offscreen platform where it has one, and on
+Linux builds of Qt 4 without one, the benchmarks are started again under
+xvfb-run if there is no X server.
+'''
+
+import os
+import sys
+import optparse
+import traceback
+from xVBench import Harness
+
+ReexecFlag = "XVBENCH_UNDER_XVFB"
+'''Environment variable set when the runner has restarted under xvfb-run.'''
+
+
+def _FindProgram(name):
+    for directory in os.environ.get("PATH", "").split(os.pathsep):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+def RestartUnderXvfb():
+    '''
+    Runs this script again under xvfb-run, which provides a virtual X
+    server.  Only returns if that isn't possible.
+    '''
+    xvfb = _FindProgram("xvfb-run")
+    if xvfb is None or os.environ.get(ReexecFlag):
+        return
+    os.environ[ReexecFlag] = "1"
+    sys.stdout.flush()
+    args = [xvfb, "-a", sys.executable, os.path.abspath(sys.argv[0])]
+    os.execv(xvfb, args + sys.argv[1:])
+
+
+def FormatRow(result):
+    '''
+    Formats a line of the results table.
+    '''
+    format = Harness.FormatTime
+    return "%-44s %10s %10s %10s %10s %8.1f" % (
+            result["name"], format(result["median"]), format(result["p90"]),
+            format(result["p99"]), format(result["max"]), result["fps"] or 0.0)
+
+
+def Main():
+    '''
+    Entry point of the rendering benchmark runner.
+    '''
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-o", "--output", default=None,
+                      help="write the results to this JSON file")
+    parser.add_option("-k", "--keyword", action="append", default=[],
+                      help="only run benchmarks whose names contain this "
+                      "(may be given more than once)")
+    parser.add_option("-m", "--map", action="append", default=[],
+                      dest="maps", metavar="WxHxD:DENSITY:ANIMATED",
+                      help="render this map instead of the default set "
+                      "(may be given more than once)")
+    parser.add_option("-n", "--frames", type="int", default=200,
+                      help="number of frames timed per benchmark")
+    parser.add_option("-w", "--warmup", type="int", default=10,
+                      help="number of frames rendered before timing")
+    parser.add_option("--viewport", default="1024x768", metavar="WxH",
+                      help="size of the view rendered (default: 1024x768)")
+    parser.add_option("-c", "--compare", default=None,
+                      help="compare against an earlier results file")
+    parser.add_option("--threshold", type="float", default=10.0,
+                      help="slowdown in percent reported as a regression "
+                      "by --compare (default: 10)")
+    parser.add_option("-l", "--list", action="store_true", default=False,
+                      help="list the maps which would be rendered and exit")
+    options, args = parser.parse_args()
+    if options.frames < 1:
+        parser.error("at least one frame is needed")
+    if options.warmup < 0:
+        parser.error("the number of warmup frames can't be negative")
+    try:
+        viewport = tuple(int(dim) for dim in options.viewport.split("x"))
+        if len(viewport) != 2 or min(viewport) < 64:
+            raise ValueError
+    except ValueError:
+        parser.error("the viewport must be WIDTHxHEIGHT, at least 64x64")
+    
+    try:
+        from xVBench import RenderBenchmarks
+    except ImportError as err:
+        print >> sys.stderr, "Could not import the renderer: %s" % err
+        return 1
+    
+    # Work out what to render.
+    if options.maps:
+        try:
+            specs = [RenderBenchmarks.ParseMapSpec(text)
+                     for text in options.maps]
+        except ValueError as err:
+            parser.error("bad map: %s" % err)
+    else:
+        specs = RenderBenchmarks.MapSpecs
+    if options.list:
+        for spec in specs:
+            print spec.Name
+        return 0
+    
+    # Load the baseline first, so a bad path doesn't waste a whole run.
+    baseline = None
+    if options.compare:
+        try:
+            baseline = Harness.LoadResults(options.compare)
+        except (IOError, ValueError) as err:
+            print >> sys.stderr, "Could not load %s: %s" % (options.compare,
+                                                            err)
+            return 1
+    
+    # Get something to render with.
+    if RenderBenchmarks.NeedsXServer():
+        RestartUnderXvfb()
+        print >> sys.stderr, ("No X server to render with; set DISPLAY or "
+                              "install xvfb-run.")
+        return 1
+    app = RenderBenchmarks.StartApplication()
+    
+    # Render.
+    print "%-44s %10s %10s %10s %10s %8s" % ("benchmark", "median", "p90",
+                                              "p99", "max", "fps")
+    results = []
+    skipped = []
+    for spec in specs:
+        try:
+            found, missed = RenderBenchmarks.Measure(spec, options.frames,
+                                                     options.warmup, viewport,
+                                                     options.keyword)
+        except Exception:
+            print "%-44s failed:" % spec.Name
+            traceback.print_exc()
+            skipped.append((spec.Name, "failed: %s" % sys.exc_info()[1]))
+            continue
+        for name, reason in missed:
+            print "%-44s skipped: %s" % (name, reason)
+        for result in found:
+            print FormatRow(result)
+        results += found
+        skipped += missed
+        sys.stdout.flush()
+    
+    # Write out the results.
+    if options.output:
+        settings = {"frames": options.frames, "warmup": options.warmup,
+                    "viewport": list(viewport), "keywords": options.keyword,
+                    "maps": [spec.Name for spec in specs]}
+        environment = Harness.Environment()
+        environment["qt"] = RenderBenchmarks.QtCore.QT_VERSION_STR
+        environment["qt_platform"] = os.environ.get("QT_QPA_PLATFORM")
+        try:
+            Harness.WriteResults(options.output, environment, settings,
+                                 results, skipped)
+        except IOError as err:
+            print >> sys.stderr, "Could not write %s: %s" % (options.output,
+                                                             err)
+            return 1
+        print "Results written to %s." % options.output
+    
+    # Compare them.
+    status = 0
+    if baseline is not None:
+        rows = Harness.Compare(baseline, results, options.threshold / 100.0)
+        if Harness.PrintComparison(options.compare, rows):
+            status = 1
+    del app
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(Main())
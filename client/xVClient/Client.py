@@ -45,6 +45,11 @@ class ClientApplication(object):
         '''Background task processor.'''
         self.Connection = None
         '''Handler for the connection to the server.'''
+        self.LoginToken = None
+        '''
+        Last login token issued by a server, as a tuple (address, token).  Used
+        to log back in quickly after the connection drops.
+        '''
     
     def LoadDefaultTheme(self):
         '''
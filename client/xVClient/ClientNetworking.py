@@ -49,6 +49,8 @@ class ClientConnectionHandler(Networking.BaseConnectionHandler):
         # Declare attributes.
         self.KeepAliveSent = False
         '''Flag used to track if a KeepAlive packet has already been sent.'''
+        self.ServerAddress = None
+        '''Network address of the server as a tuple C{(host, port)}.'''
     
     ##
     ## High-level callbacks
@@ -61,8 +63,42 @@ class ClientConnectionHandler(Networking.BaseConnectionHandler):
         @type packet: xVLib.Packets.Packet
         @param packet: Packet that was received.
         '''
+        # Hold on to login tokens in case we need to reconnect.
+        if packet.PacketType == Packets.LoginToken:
+            App = ClientGlobals.Application
+            App.LoginToken = (self.ServerAddress, packet.Token)
+            return
+        
+        # Find out why the server is disconnecting us.
+        if packet.PacketType == Packets.Disconnect:
+            self.OnDisconnect(packet)
+            return
+        
         pass    # TODO: Implement
     
+    def OnDisconnect(self, packet):
+        '''
+        Called when the server says it is closing the connection.
+        
+        If the server is only restarting, we connect again straight away; the
+        login token lets us skip the login.
+        
+        @type packet: xVLib.Packets.DisconnectPacket
+        @param packet: Disconnect packet sent by the server.
+        '''
+        # Show the server's message.
+        if packet.Message:
+            mainlog.info(packet.Message)
+        
+        # Close the connection, and reconnect if we can.
+        address = self.ServerAddress
+        self.close()
+        if packet.Reason == packet.Reason_Restart:
+            try:
+                ConnectToServer(address)
+            except ConnectionFailed:
+                pass
+    
     def OnCorruptPacket(self):
         '''
         Called when a corrupt packet is received.
@@ -113,6 +149,12 @@ class ClientConnectionHandler(Networking.BaseConnectionHandler):
         '''
         # Start the connection negotiation.
         ConnPacket = Packets.NegotiateConnectionPacket(self)
+        
+        # Skip the login if we were just connected to this server.
+        App = ClientGlobals.Application
+        if App.LoginToken and App.LoginToken[0] == self.ServerAddress:
+            ConnPacket.ResumeToken = App.LoginToken[1]
+            App.LoginToken = None
         self.SendPacket(ConnPacket)
     
     def handle_error(self):
@@ -187,6 +229,7 @@ def ConnectToServer(address):
     # Try to connect.
     try:
         conn = ClientConnectionHandler()
+        conn.ServerAddress = address
         conn.create_socket(socket.AF_INET, socket.SOCK_STREAM)
         conn.connect(address)
     except socket.error as err:
@@ -230,7 +230,7 @@ class AnimatedSprite(Sprite):
     def __init__(self, width, height, delay=10):
         '''Initializes a blank animated sprite.'''
         # set up the underlying sprite infrastructure
-        super(self, AnimatedSprite).__init__(width, height)
+        super(AnimatedSprite, self).__init__(width, height)
         
         # set our time-control variables
         self.delay = delay
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# xVector Engine Server
+# Copyright (c) 2012 James Buchwald
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+'''
+Database throughput benchmark.
+
+Measures account registration and login lookup throughput through the
+database executor under several engine settings.  By default a scratch sqlite
+database is used, comparing the stock sqlite settings against the tuned ones.
+Pass the Database settings of a network database (see --help) to compare
+connection pool settings against it instead.
+
+The benchmark creates and fills the accounts table, so never point it at a
+live database.
+'''
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import optparse
+from xVServer import ServerConfig, Database, Accounts, Callbacks
+
+
+SQLiteVariants = [
+    ("sqlite stock", {'Database/SQLite/WAL': False,
+                      'Database/SQLite/Synchronous': u'FULL',
+                      'Database/SQLite/MmapSize': 0}),
+    ("sqlite WAL", {'Database/SQLite/WAL': True,
+                    'Database/SQLite/Synchronous': u'FULL',
+                    'Database/SQLite/MmapSize': 0}),
+    ("sqlite tuned", {'Database/SQLite/WAL': True,
+                      'Database/SQLite/Synchronous': u'NORMAL',
+                      'Database/SQLite/MmapSize': 268435456}),
+]
+'''Settings compared when benchmarking sqlite.'''
+
+PoolVariants = [
+    ("pool 1/0", {'Database/Pool/Size': 1,
+                  'Database/Pool/MaxOverflow': 0,
+                  'Database/Pool/PrePing': False}),
+    ("pool 5/10", {'Database/Pool/Size': 5,
+                   'Database/Pool/MaxOverflow': 10,
+                   'Database/Pool/PrePing': False}),
+    ("pool 5/10 pre-ping", {'Database/Pool/Size': 5,
+                            'Database/Pool/MaxOverflow': 10,
+                            'Database/Pool/PrePing': True}),
+]
+'''Settings compared when benchmarking a network database.'''
+
+
+def Ignore(result):
+    '''
+    Callback which discards a job's result.
+    '''
+    pass
+
+
+def WaitForJobs(count):
+    '''
+    Runs main loop callbacks until count of them have run.
+    '''
+    while count > 0:
+        ran = Callbacks.RunCallbacks()
+        if not ran:
+            time.sleep(0.001)
+        count -= ran
+
+
+def RunVariant(config, accounts, batch):
+    '''
+    Benchmarks one set of settings.
+    
+    @return: Tuple (registrations/sec, single lookups/sec, batched
+    lookups/sec).
+    '''
+    Database.InitDB(config)
+    Database.Base.metadata.drop_all(Database.Engine)
+    Database.Base.metadata.create_all(Database.Engine)
+    Database.StartExecutor(config)
+    Accounts.Cache.MaxSize = 0
+    names = ["bench%i" % i for i in xrange(accounts)]
+    phash = "\0" * 64
+    salt = "\0" * 16
+    failures = []
+    try:
+        # Registration: one write job per account.
+        start = time.time()
+        for name in names:
+            job = lambda session, name=name: Accounts.Register(
+                    name, phash, salt, name + "@example.com", "127.0.0.1",
+                    session)
+            Database.Submit(job, Ignore, failures.append, write=True)
+        WaitForJobs(accounts)
+        registers = accounts / (time.time() - start)
+        
+        # Logins, the old way: one lookup job per account.
+        start = time.time()
+        for name in names:
+            job = lambda session, name=name: Accounts.Lookup(name, session)
+            Database.Submit(job, Ignore, failures.append)
+        WaitForJobs(accounts)
+        singles = accounts / (time.time() - start)
+        
+        # Logins, batched the way the main loop does it.
+        start = time.time()
+        jobs = 0
+        for i in xrange(0, accounts, batch):
+            chunk = names[i:i + batch]
+            job = lambda session, chunk=chunk: Accounts.LookupMany(chunk,
+                                                                   session)
+            Database.Submit(job, Ignore, failures.append)
+            jobs += 1
+        WaitForJobs(jobs)
+        batched = accounts / (time.time() - start)
+    finally:
+        Database.StopExecutor()
+        Database.MainSession.close()
+        Database.Engine.dispose()
+    if failures:
+        print "  %i jobs failed, first error: %s" % (len(failures),
+                                                     failures[0])
+    return (registers, singles, batched)
+
+
+def Main():
+    '''
+    Entry point of the benchmark.
+    '''
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-n", "--accounts", type="int", default=2000,
+                      help="number of accounts to register and look up")
+    parser.add_option("-b", "--batch", type="int", default=50,
+                      help="usernames per batched lookup")
+    parser.add_option("-t", "--threads", type="int", default=2,
+                      help="number of database worker threads")
+    parser.add_option("--type", default="sqlite",
+                      help="database type (sqlite, mysql, postgresql...)")
+    parser.add_option("--host", default="", help="database host")
+    parser.add_option("--port", type="int", default=0, help="database port")
+    parser.add_option("--name", default="", help="database name")
+    parser.add_option("--username", default="", help="database username")
+    parser.add_option("--password", default="", help="database password")
+    options, args = parser.parse_args()
+    
+    # Build the configuration.
+    base = dict(ServerConfig.DefaultValues)
+    base['Database/Type'] = options.type
+    base['Database/Host'] = options.host
+    base['Database/Port'] = options.port
+    base['Database/Username'] = options.username
+    base['Database/Password'] = options.password
+    base['Database/Threads'] = options.threads
+    scratch = None
+    if options.type == "sqlite":
+        variants = SQLiteVariants
+        scratch = tempfile.mkdtemp(prefix="xvdbbench")
+    else:
+        variants = PoolVariants
+        base['Database/Name'] = options.name
+    
+    # Run the benchmarks.
+    print "%-20s %12s %12s %12s" % ("settings", "register/s", "lookup/s",
+                                     "batched/s")
+    try:
+        for name, overrides in variants:
+            config = dict(base)
+            config.update(overrides)
+            if scratch:
+                dbfile = "%s.sqlite" % name.replace(" ", "_")
+                config['Database/Name'] = os.path.join(scratch, dbfile)
+            results = RunVariant(config, options.accounts, options.batch)
+            print "%-20s %12.1f %12.1f %12.1f" % ((name,) + results)
+    finally:
+        if scratch:
+            shutil.rmtree(scratch, ignore_errors=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(Main())
@@ -0,0 +1,635 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# xVector Engine Server
+# Copyright (c) 2012 James Buchwald
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+'''
+Load generator for xVector servers.
+
+Opens a swarm of simulated clients against a server and runs a scripted
+scenario on each of them.  The bots speak the real protocol through
+xVLib.Networking and xVLib.Packets, all from a single process using poll(),
+so thousands of them can run from one machine.  The scenarios are:
+
+  - negotiate: connect, negotiate the connection, disconnect.
+  - register: also register a new account (which logs it in).
+  - login: log into an existing account, registering it first if needed.
+  - keepalive: log in, then exchange keep-alives until the run ends.
+  - churn: log in, then repeatedly drop the connection and resume the
+    session with the login token.
+
+Bots which are asked to reconnect because the server is restarting (see the
+server's Upgrade module) do so and carry on with their scenario.
+
+At the end, the tool prints the connection rate, the latency percentiles of
+each step, the client-side traffic and the errors seen.  If the server's
+metrics endpoint is enabled (Metrics/HTTP in the server configuration), pass
+its URL with --metrics to also report the server's own packet throughput.
+
+A stock server only accepts a few connections per IP address and a limited
+number of new connections per second (see Network/Connections/PerIP and
+Network/Admission/AcceptRate).  Against a local server, --sources spreads the
+bots over several loopback addresses (127.0.0.1, 127.0.0.2, ...), but the
+server's limits should still be raised for large runs.  Each bot uses a file
+descriptor, so the open file limit (ulimit -n) may need raising too.
+'''
+
+import sys
+import time
+import errno
+import socket
+import random
+import hashlib
+import asyncore
+import optparse
+import urllib2
+from xVLib import Networking, Packets
+
+Scenarios = ("negotiate", "register", "login", "keepalive", "churn")
+'''Names of the scenarios the bots can run.'''
+
+Password = "loadtest"
+'''Password of every bot account.'''
+
+
+class SwarmStats(object):
+    '''
+    Results collected from the bots.
+    '''
+    
+    def __init__(self):
+        self.Latencies = {}
+        '''Maps step names to lists of latencies in seconds.'''
+        self.Errors = {}
+        '''Maps error descriptions to the number of times they happened.'''
+        self.Completed = 0
+        '''Number of bots which finished their scenario.'''
+        self.Connections = 0
+        '''Number of connections established.'''
+        self.PacketsIn = 0
+        '''Packets received from the server.'''
+        self.PacketsOut = 0
+        '''Packets sent to the server.'''
+        self.BytesIn = 0
+        '''Bytes received from the server.'''
+        self.BytesOut = 0
+        '''Bytes sent to the server.'''
+        self.Restarts = 0
+        '''Number of times bots were asked to reconnect by a restart.'''
+    
+    def Time(self, step, elapsed):
+        '''
+        Records the latency of a step.
+        '''
+        self.Latencies.setdefault(step, []).append(elapsed)
+    
+    def Error(self, description):
+        '''
+        Records an error.
+        '''
+        self.Errors[description] = self.Errors.get(description, 0) + 1
+
+
+class Bot(Networking.BaseConnectionHandler):
+    '''
+    Simulated client running one scenario.
+    '''
+    
+    def __init__(self, swarm, index):
+        '''
+        Creates a bot.  Call Start() to connect it.
+        
+        @type swarm: Swarm
+        @param swarm: Swarm running the bot.
+        
+        @type index: integer
+        @param index: Number of the bot within the swarm.
+        '''
+        # Inherit base class behavior.
+        Networking.BaseConnectionHandler.__init__(self)
+        
+        # Declare attributes.
+        self.Swarm = swarm
+        '''Swarm running the bot.'''
+        self.Index = index
+        '''Number of the bot within the swarm.'''
+        self.Stats = swarm.Stats
+        '''Where the bot's results go.'''
+        self.Username = u"%s%i" % (swarm.Prefix, index)
+        '''Account name used by the bot.'''
+        self.Salt = hashlib.md5(self.Username.encode("utf-8")).digest()
+        '''Password salt of the bot's account.'''
+        self.PasswordHash = hashlib.sha512(self.Salt + Password).digest()
+        '''Password hash of the bot's account.'''
+        self.Step = None
+        '''Name of the step the bot is waiting on.'''
+        self.StepStart = 0
+        '''Time at which the current step started.'''
+        self.Serial = 0
+        '''Serial number of the last request sent.'''
+        self.Token = None
+        '''Login token received from the server, if any.'''
+        self.Cycles = 0
+        '''Number of times the bot has reconnected.'''
+        self.HoldUntil = None
+        '''Time at which the bot moves on from idling, if it is idle.'''
+        self.Done = False
+        '''True once the bot has finished (or failed) its scenario.'''
+    
+    ##
+    ## Scenario steps
+    ##
+    
+    def Start(self):
+        '''
+        Connects to the server.
+        '''
+        self.BeginStep("connect")
+        try:
+            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            source = self.Swarm.NextSource()
+            if source:
+                self.bind((source, 0))
+            self.connect(self.Swarm.Address)
+        except socket.error as err:
+            self.Fail("connect: %s" % errno.errorcode.get(err.args[0],
+                                                          err.args[0]))
+    
+    def BeginStep(self, step):
+        '''
+        Starts timing a step.
+        '''
+        self.Step = step
+        self.StepStart = time.time()
+    
+    def EndStep(self):
+        '''
+        Records the time the current step took.
+        '''
+        self.Stats.Time(self.Step, time.time() - self.StepStart)
+        self.Step = None
+    
+    def Fail(self, description):
+        '''
+        Gives up on the scenario after an error.
+        '''
+        if self.Done:
+            return
+        self.Stats.Error(description)
+        self.Finish(False)
+    
+    def Finish(self, success=True):
+        '''
+        Disconnects and reports back to the swarm.
+        '''
+        if self.Done:
+            return
+        self.Done = True
+        if success:
+            self.Stats.Completed += 1
+        self.close()
+        self.Swarm.BotFinished(self)
+    
+    def Negotiate(self):
+        '''
+        Sends the NegotiateConnection packet.
+        '''
+        self.BeginStep("negotiate")
+        packet = Packets.NegotiateConnectionPacket(self)
+        if self.Token:
+            packet.ResumeToken = self.Token
+            self.Token = None
+            self.Step = "resume"
+        self.SendPacket(packet)
+    
+    def StartLogin(self):
+        '''
+        Sends the StartLogin packet.
+        '''
+        self.BeginStep("login")
+        packet = Packets.StartLoginPacket(self)
+        packet.Username = self.Username
+        self.SendPacket(packet)
+    
+    def Register(self):
+        '''
+        Sends the Register packet.
+        '''
+        self.BeginStep("register")
+        self.Serial += 1
+        packet = Packets.RegisterPacket(self)
+        packet.RequestSerial = self.Serial
+        packet.Username = self.Username
+        packet.Salt = self.Salt
+        packet.PasswordHash = self.PasswordHash
+        packet.Email = self.Username + u"@example.com"
+        self.SendPacket(packet)
+    
+    def LoggedIn(self):
+        '''
+        Moves on once the bot is logged in.
+        '''
+        scenario = self.Swarm.Scenario
+        if scenario == "keepalive":
+            self.SendKeepAlive()
+        elif scenario == "churn":
+            self.HoldUntil = time.time() + self.Swarm.Hold
+        else:
+            self.Finish()
+    
+    def SendKeepAlive(self):
+        '''
+        Sends a KeepAlive packet and times the reply.
+        '''
+        self.BeginStep("keepalive")
+        self.SendPacket(Packets.KeepAlivePacket(self))
+    
+    def Tick(self, now):
+        '''
+        Checks for timeouts and idle steps.  Called by the swarm regularly.
+        '''
+        if self.Step and now - self.StepStart > self.Swarm.Timeout:
+            self.Fail("timeout: %s" % self.Step)
+            return
+        if self.HoldUntil is None or now < self.HoldUntil:
+            return
+        self.HoldUntil = None
+        scenario = self.Swarm.Scenario
+        if scenario == "keepalive" and now < self.Swarm.Deadline:
+            self.SendKeepAlive()
+        elif scenario == "churn" and self.Cycles < self.Swarm.Cycles:
+            # Drop the connection and come back with the token.
+            if not self.Token:
+                self.Fail("churn: no login token")
+                return
+            self.Done = True
+            self.close()
+            self.Swarm.Reconnect(self)
+        else:
+            self.Finish()
+    
+    ##
+    ## Packet handling
+    ##
+    
+    def PacketReceived(self, packet):
+        ptype = packet.PacketType
+        if ptype == Packets.ConnectionAccepted:
+            resumed = self.Step == "resume"
+            self.EndStep()
+            if resumed:
+                if not packet.Resumed:
+                    self.Fail("resume: token rejected")
+                    return
+                self.LoggedIn()
+            elif self.Swarm.Scenario == "negotiate":
+                self.Finish()
+            elif self.Swarm.Scenario == "register":
+                self.Register()
+            else:
+                self.StartLogin()
+        elif ptype == Packets.ConnectionRejected:
+            self.Fail("rejected: code %i" % packet.RejectionCode)
+        elif ptype == Packets.BadLogin:
+            if packet.Reason == packet.Reason_BadUsername:
+                # First run against this database; create the account.
+                self.Register()
+            else:
+                self.Fail("bad login: reason %i" % packet.Reason)
+        elif ptype == Packets.LoginChallenge:
+            self.Serial += 1
+            reply = Packets.FinishLoginPacket(self)
+            reply.RequestSerial = self.Serial
+            reply.ChallengeSolution = hashlib.sha256(
+                    self.PasswordHash + packet.Challenge).digest()
+            self.SendPacket(reply)
+        elif ptype == Packets.Success:
+            if packet.RequestSerial != self.Serial:
+                self.Fail("success: wrong request serial")
+                return
+            self.EndStep()
+            self.LoggedIn()
+        elif ptype == Packets.Failed:
+            self.Fail("%s failed: reason %i" % (self.Step, packet.ReasonCode))
+        elif ptype == Packets.LoginToken:
+            self.Token = packet.Token
+        elif ptype == Packets.Disconnect:
+            if packet.Reason != packet.Reason_Restart:
+                self.Fail("disconnected: reason %i" % packet.Reason)
+                return
+            # The server is being replaced; carry on with the new one.
+            self.Stats.Restarts += 1
+            self.Done = True
+            self.close()
+            self.Swarm.Reconnect(self, restart=True)
+        elif ptype == Packets.KeepAlive:
+            # Reply to ours; send another after a pause.
+            if self.Step == "keepalive":
+                self.EndStep()
+                self.HoldUntil = time.time() + self.Swarm.Hold
+    
+    def OnPacketSent(self, packet, size):
+        self.Stats.PacketsOut += 1
+        self.Stats.BytesOut += size
+    
+    def OnPacketDecoded(self, packet, size):
+        self.Stats.PacketsIn += 1
+        self.Stats.BytesIn += size
+    
+    def OnCorruptPacket(self):
+        self.Fail("corrupt packet")
+    
+    def OnTimeout(self):
+        self.Fail("network timeout")
+    
+    ##
+    ## asyncore callbacks
+    ##
+    
+    def handle_connect(self):
+        self.EndStep()
+        self.Stats.Connections += 1
+        self.Negotiate()
+    
+    def handle_close(self):
+        if not self.Done:
+            self.Fail("disconnected by server (%s)" % (self.Step or "idle"))
+    
+    def handle_error(self):
+        err = sys.exc_info()[1]
+        if isinstance(err, socket.error) and err.args:
+            code = errno.errorcode.get(err.args[0], err.args[0])
+            self.Fail("socket error: %s" % code)
+        else:
+            self.Fail("%s: %s" % (type(err).__name__, err))
+
+
+class Swarm(object):
+    '''
+    Starts the bots and keeps them running.
+    '''
+    
+    def __init__(self, options):
+        '''
+        Creates a swarm from the command line options.
+        '''
+        self.Address = (options.host, options.port)
+        '''Address of the server.'''
+        self.Scenario = options.scenario
+        '''Scenario run by the bots.'''
+        self.Prefix = options.prefix
+        '''Prefix of the bots' account names.'''
+        self.Count = options.bots
+        '''Number of bots to run.'''
+        self.Rate = options.rate
+        '''Number of bots started per second.'''
+        self.Concurrency = options.concurrency
+        '''Maximum number of bots connected at once.'''
+        self.Timeout = options.timeout
+        '''Seconds a bot may wait on a single step.'''
+        self.Hold = options.hold
+        '''Seconds a bot idles between keep-alives or reconnects.'''
+        self.Cycles = options.cycles
+        '''Number of reconnects made by each churn bot.'''
+        self.Sources = options.sources
+        '''Number of loopback source addresses to spread the bots over.'''
+        self.Duration = options.duration
+        '''Seconds the keep-alive scenario runs for.'''
+        self.Deadline = None
+        '''Time at which the keep-alive scenario ends.'''
+        self.Stats = SwarmStats()
+        '''Results collected from the bots.'''
+        self.Active = {}
+        '''Maps bot numbers to the bots which haven't finished yet.'''
+        self.Started = 0
+        '''Number of bots started so far.'''
+        self._NextSource = 0
+        '''Index of the next source address to use.'''
+    
+    def NextSource(self):
+        '''
+        Picks the local address for the next connection.
+        
+        @return: Source address, or None to let the system choose.
+        '''
+        if self.Sources <= 1:
+            return None
+        n = self._NextSource % self.Sources
+        self._NextSource += 1
+        return "127.%i.%i.%i" % ((n >> 16) & 255, (n >> 8) & 255,
+                                 (n & 255) + 1)
+    
+    def BotFinished(self, bot):
+        '''
+        Called when a bot is done with its scenario.
+        '''
+        # Keyed by number: asyncore dispatchers take their hash from their
+        # socket, which changes once it's closed.
+        if self.Active.get(bot.Index) is bot:
+            del self.Active[bot.Index]
+    
+    def Reconnect(self, old, restart=False):
+        '''
+        Replaces a bot which dropped its connection with a new one which will
+        resume the session.
+        
+        @type restart: bool
+        @param restart: If True, the server asked for the reconnect, so it
+        doesn't count as one of the bot's own.
+        '''
+        bot = Bot(self, old.Index)
+        bot.Token = old.Token
+        bot.Cycles = old.Cycles if restart else old.Cycles + 1
+        self.Active[bot.Index] = bot
+        bot.Start()
+    
+    def Run(self):
+        '''
+        Runs the whole swarm.
+        
+        @return: Seconds the run took.
+        '''
+        start = time.time()
+        self.Deadline = start + self.Duration
+        lastcheck = 0
+        while self.Started < self.Count or self.Active:
+            now = time.time()
+            
+            # Start more bots, keeping to the ramp rate.
+            due = min(self.Count, int((now - start) * self.Rate) + 1)
+            while (self.Started < due
+                   and len(self.Active) < self.Concurrency):
+                bot = Bot(self, self.Started)
+                self.Started += 1
+                self.Active[bot.Index] = bot
+                bot.Start()
+            
+            # Handle network events.
+            if asyncore.socket_map:
+                asyncore.loop(timeout=0.01, count=1, use_poll=True)
+            else:
+                time.sleep(0.01)
+            
+            # Check on the bots a few times a second.
+            if now - lastcheck > 0.1:
+                lastcheck = now
+                for bot in self.Active.values():
+                    bot.Tick(now)
+                    if not bot.Done:
+                        bot.CheckTimeout()
+        return time.time() - start
+
+
+def Percentiles(values):
+    '''
+    Describes a list of latencies.
+    '''
+    values = sorted(values)
+    n = len(values)
+    pick = lambda q: values[min(n - 1, int(q * n))] * 1000
+    return "%7i %9.1f %9.1f %9.1f %9.1f" % (n, pick(0.5), pick(0.9),
+                                            pick(0.99), values[-1] * 1000)
+
+
+def ScrapeServer(url):
+    '''
+    Reads the packet counters from the server's metrics endpoint.
+    
+    @return: Tuple (packets received, packets sent), or None on failure.
+    '''
+    try:
+        text = urllib2.urlopen(url, timeout=5).read()
+    except (urllib2.URLError, socket.error) as err:
+        print "Could not read server metrics from %s: %s" % (url, err)
+        return None
+    received = 0
+    sent = 0
+    for line in text.splitlines():
+        if line.startswith("xvector_packets_received_total"):
+            received += float(line.rsplit(" ", 1)[1])
+        elif line.startswith("xvector_packets_sent_total"):
+            sent += float(line.rsplit(" ", 1)[1])
+    return (received, sent)
+
+
+def Report(swarm, elapsed, server):
+    '''
+    Prints the results of a run.
+    '''
+    stats = swarm.Stats
+    print
+    print "Scenario %s: %i bots in %.1f seconds." % (swarm.Scenario,
+                                                     swarm.Started, elapsed)
+    print "  %i completed, %i failed." % (stats.Completed,
+                                           swarm.Started - stats.Completed)
+    print "  %i connections, %.1f per second." % (stats.Connections,
+                                                  stats.Connections / elapsed)
+    if stats.Restarts:
+        print "  %i reconnects asked for by a server restart." % stats.Restarts
+    print
+    print "  %-10s %7s %9s %9s %9s %9s" % ("step (ms)", "count", "p50", "p90",
+                                           "p99", "max")
+    for step in ("connect", "negotiate", "register", "login", "resume",
+                 "keepalive"):
+        if step in stats.Latencies:
+            print "  %-10s %s" % (step, Percentiles(stats.Latencies[step]))
+    print
+    msg = "  Client traffic: in %.1f pkt/s %.1f KB/s, out %.1f pkt/s %.1f KB/s"
+    print msg % (stats.PacketsIn / elapsed, stats.BytesIn / elapsed / 1024.0,
+                 stats.PacketsOut / elapsed,
+                 stats.BytesOut / elapsed / 1024.0)
+    if server:
+        msg = "  Server throughput: received %.1f pkt/s, sent %.1f pkt/s"
+        print msg % (server[0] / elapsed, server[1] / elapsed)
+    if stats.Errors:
+        print
+        print "  Errors:"
+        for description, count in sorted(stats.Errors.iteritems(),
+                                         key=lambda item: -item[1]):
+            print "  %7i  %s" % (count, description)
+
+
+def Main():
+    '''
+    Entry point of the load generator.
+    '''
+    usage = "%prog [options] [host [port]]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("-s", "--scenario", default="login",
+                      choices=Scenarios,
+                      help="scenario to run: %s" % ", ".join(Scenarios))
+    parser.add_option("-n", "--bots", type="int", default=100,
+                      help="number of bots to run")
+    parser.add_option("-r", "--rate", type="float", default=20.0,
+                      help="bots started per second")
+    parser.add_option("-c", "--concurrency", type="int", default=1000,
+                      help="maximum number of bots connected at once")
+    parser.add_option("--prefix", default=None,
+                      help="account name prefix (default: loadbot, or a "
+                      "random one for the register scenario)")
+    parser.add_option("--timeout", type="float", default=30.0,
+                      help="seconds a bot may wait for a reply")
+    parser.add_option("--hold", type="float", default=5.0,
+                      help="seconds between keep-alives or reconnects")
+    parser.add_option("--cycles", type="int", default=3,
+                      help="reconnects made by each churn bot")
+    parser.add_option("--duration", type="float", default=60.0,
+                      help="length of the keepalive scenario in seconds")
+    parser.add_option("--sources", type="int", default=1,
+                      help="number of loopback addresses to connect from")
+    parser.add_option("--metrics", default=None,
+                      help="URL of the server's metrics endpoint")
+    options, args = parser.parse_args()
+    options.host = "127.0.0.1"
+    options.port = 24020
+    if args:
+        options.host = args[0]
+    if len(args) > 1:
+        options.port = int(args[1])
+    if options.prefix is None:
+        if options.scenario == "register":
+            options.prefix = "bot%06x_" % random.getrandbits(24)
+        else:
+            options.prefix = "loadbot"
+    if len(options.prefix) + len(str(options.bots)) > 32:
+        parser.error("account name prefix is too long")
+    
+    # Run the swarm.
+    swarm = Swarm(options)
+    before = after = None
+    if options.metrics:
+        before = ScrapeServer(options.metrics)
+    print "Running %i %s bots against %s port %i..." % (
+            options.bots, options.scenario, options.host, options.port)
+    try:
+        elapsed = swarm.Run()
+    except KeyboardInterrupt:
+        print "Interrupted."
+        elapsed = time.time() - (swarm.Deadline - swarm.Duration)
+        asyncore.close_all()
+    if options.metrics:
+        after = ScrapeServer(options.metrics)
+    server = None
+    if before and after:
+        server = (after[0] - before[0], after[1] - before[1])
+    Report(swarm, elapsed, server)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(Main())
@@ -0,0 +1,527 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# xVector Engine Server
+# Copyright (c) 2012 James Buchwald
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+'''
+Network condition emulator.
+
+A TCP proxy which sits between clients (or xVLoadTest.py bots) and a server
+and makes the connection between them behave like a bad network, so the
+protocol can be tried out at WAN latencies without a WAN.  Point the clients
+at the proxy's port instead of the server's:
+
+    xVNetEmu.py --latency 100 --jitter 20 --listen 24021 127.0.0.1 24020
+
+Data read from either side is cut into chunks of at most --chunk bytes, and
+each chunk is held back before it is passed on:
+
+  - --latency adds a fixed one-way delay, so 100 ms gives a 200 ms round
+    trip.  --jitter adds a random amount of up to that much either way.
+  - --bandwidth caps each direction of each connection to so many kilobytes
+    per second; chunks queue up behind each other as on a slow link.
+  - --reorder holds back that percentage of chunks by an extra round trip,
+    as if they had been lost and sent again.  TCP delivers in order, so the
+    data behind a held-back chunk waits for it too; this is how reordering
+    and loss show up to an application on top of TCP.
+  - --stall-interval and --stall freeze connections completely now and then,
+    for the given number of milliseconds, at random intervals averaging the
+    given number of seconds.
+
+The proxy stops reading from a side when too much of its data is waiting to
+be passed on, so a capped or stalled connection pushes back on the sender as
+a real one would.
+
+When a connection closes, its statistics are printed: the bytes and chunks
+passed each way, the delay added to them, and the number of stalls.  Totals
+are printed when the proxy is stopped with Ctrl-C.
+'''
+
+import sys
+import time
+import errno
+import heapq
+import random
+import socket
+import asyncore
+import optparse
+from collections import deque
+
+QueueLimit = 262144
+'''Bytes waiting in one direction of a connection before reading stops.'''
+
+
+class Conditions(object):
+    '''
+    Network conditions applied to every connection.
+    '''
+    
+    def __init__(self, options):
+        '''
+        Reads the conditions from the command line options.
+        '''
+        self.Latency = options.latency / 1000.0
+        '''One-way delay in seconds.'''
+        self.Jitter = options.jitter / 1000.0
+        '''Largest random change to the delay, in seconds.'''
+        self.Bandwidth = options.bandwidth * 1024.0
+        '''Bytes per second in each direction, or 0 for no limit.'''
+        self.Reorder = options.reorder / 100.0
+        '''Chance of a chunk being held back by an extra round trip.'''
+        self.StallInterval = options.stall_interval
+        '''Average seconds between stalls, or 0 for no stalls.'''
+        self.Stall = options.stall / 1000.0
+        '''Length of a stall in seconds.'''
+        self.Chunk = options.chunk
+        '''Largest chunk of data passed on at once.'''
+    
+    def Delay(self):
+        '''
+        Picks the delay for a chunk.
+        '''
+        delay = self.Latency
+        if self.Jitter:
+            delay += random.uniform(-self.Jitter, self.Jitter)
+        if self.Reorder and random.random() < self.Reorder:
+            delay += 2 * self.Latency + self.Jitter
+        return max(delay, 0.0)
+    
+    def NextStall(self, now):
+        '''
+        Picks the time of the next stall.
+        '''
+        if not self.StallInterval or not self.Stall:
+            return None
+        return now + random.expovariate(1.0 / self.StallInterval)
+
+
+class Pipe(object):
+    '''
+    One direction of a connection, holding the chunks on their way across.
+    '''
+    
+    def __init__(self, flow, name):
+        self.Flow = flow
+        '''Connection the pipe belongs to.'''
+        self.Name = name
+        '''Name of the direction, for the statistics.'''
+        self.Sink = None
+        '''Endpoint the chunks are delivered to.'''
+        self.Queue = deque()
+        '''Chunks in flight, as (due time, arrival time, data) tuples.'''
+        self.Queued = 0
+        '''Bytes in flight.'''
+        self.LinkFree = 0
+        '''Time at which the bandwidth cap lets the next chunk start.'''
+        self.LastDue = 0
+        '''Due time of the last chunk queued.'''
+        self.Closing = False
+        '''If True, the sink is closed once everything is delivered.'''
+        self.Bytes = 0
+        '''Bytes delivered.'''
+        self.Chunks = 0
+        '''Chunks delivered.'''
+        self.DelaySum = 0.0
+        '''Total delay added to the delivered chunks.'''
+        self.DelayMax = 0.0
+        '''Largest delay added to a chunk.'''
+    
+    def Push(self, data, now):
+        '''
+        Sends data into the pipe.
+        '''
+        cond = self.Flow.Proxy.Conditions
+        for i in xrange(0, len(data), cond.Chunk):
+            chunk = data[i:i + cond.Chunk]
+            sent = now
+            if cond.Bandwidth:
+                # Wait for the link, then for the chunk to cross it.
+                sent = max(now, self.LinkFree) + len(chunk) / cond.Bandwidth
+                self.LinkFree = sent
+            
+            # TCP keeps everything in order, whatever the delay.
+            due = max(sent + cond.Delay(), self.LastDue)
+            self.LastDue = due
+            self.Queue.append((due, now, chunk))
+            self.Queued += len(chunk)
+            self.Flow.Proxy.Schedule(due, self)
+    
+    def Full(self):
+        '''
+        Checks if the sender should be held off.
+        '''
+        return self.Queued >= QueueLimit
+    
+    def Deliver(self, now):
+        '''
+        Passes on every chunk which is due.
+        '''
+        if self.Flow.StallUntil > now:
+            self.Flow.Proxy.Schedule(self.Flow.StallUntil, self)
+            return
+        while self.Queue and self.Queue[0][0] <= now:
+            due, arrived, chunk = self.Queue.popleft()
+            self.Queued -= len(chunk)
+            if self.Sink is not None:
+                self.Sink.Send(chunk)
+            delay = now - arrived
+            self.Bytes += len(chunk)
+            self.Chunks += 1
+            self.DelaySum += delay
+            self.DelayMax = max(self.DelayMax, delay)
+        if self.Closing and not self.Queue and self.Sink is not None:
+            self.Sink.Finish()
+    
+    def Describe(self):
+        '''
+        Summarizes the pipe's statistics.
+        '''
+        mean = self.DelaySum / self.Chunks if self.Chunks else 0.0
+        return "%s %i B in %i chunks, delay avg %.1f ms max %.1f ms" % (
+                self.Name, self.Bytes, self.Chunks, mean * 1000,
+                self.DelayMax * 1000)
+
+
+class Endpoint(asyncore.dispatcher):
+    '''
+    One side of a proxied connection.
+    '''
+    
+    def __init__(self, flow, outgoing, sock=None):
+        '''
+        Wraps a socket, or creates one if none is given.
+        
+        @type flow: Flow
+        @param flow: Connection the endpoint belongs to.
+        
+        @type outgoing: Pipe
+        @param outgoing: Pipe which data read from this side is sent into.
+        '''
+        # Inherit base class behavior.
+        asyncore.dispatcher.__init__(self, sock)
+        
+        # Declare attributes.
+        self.Flow = flow
+        '''Connection the endpoint belongs to.'''
+        self.Outgoing = outgoing
+        '''Pipe which data read from this side is sent into.'''
+        self.OutBuffer = b""
+        '''Data waiting to be written to this side.'''
+        self.Finishing = False
+        '''If True, the endpoint closes once its buffer is written.'''
+        self.Closed = False
+        '''True once the endpoint has been closed.'''
+    
+    def Send(self, data):
+        '''
+        Queues data to be written to this side.
+        '''
+        self.OutBuffer += data
+    
+    def Finish(self):
+        '''
+        Closes the endpoint once its buffer is written.
+        '''
+        self.Finishing = True
+        if not self.OutBuffer:
+            self.Close()
+    
+    def Close(self):
+        '''
+        Closes the endpoint, and lets the other side finish up.
+        '''
+        if self.Closed:
+            return
+        self.Closed = True
+        self.close()
+        self.Outgoing.Closing = True
+        self.Outgoing.Deliver(time.time())
+        self.Flow.EndpointClosed()
+    
+    def readable(self):
+        return not self.Outgoing.Full()
+    
+    def writable(self):
+        return self.connecting or bool(self.OutBuffer)
+    
+    def handle_connect(self):
+        pass
+    
+    def handle_read(self):
+        data = self.recv(65536)
+        if data:
+            self.Outgoing.Push(data, time.time())
+    
+    def handle_write(self):
+        sent = self.send(self.OutBuffer)
+        self.OutBuffer = self.OutBuffer[sent:]
+        if self.Finishing and not self.OutBuffer:
+            self.Close()
+    
+    def handle_close(self):
+        self.Close()
+    
+    def handle_error(self):
+        err = sys.exc_info()[1]
+        if isinstance(err, socket.error) and err.args:
+            code = errno.errorcode.get(err.args[0], err.args[0])
+            print "flow %i: socket error: %s" % (self.Flow.Number, code)
+        else:
+            print "flow %i: %s: %s" % (self.Flow.Number,
+                                       type(err).__name__, err)
+        self.Close()
+
+
+class Flow(object):
+    '''
+    A proxied connection between a client and the server.
+    '''
+    
+    def __init__(self, proxy, number, sock, peer):
+        '''
+        Sets up a newly accepted client.  Call Connect() to connect it to the
+        server.
+        '''
+        now = time.time()
+        self.Proxy = proxy
+        '''Proxy the connection runs through.'''
+        self.Number = number
+        '''Number of the connection.'''
+        self.Peer = peer
+        '''Address of the client.'''
+        self.Started = now
+        '''Time at which the client connected.'''
+        self.Up = Pipe(self, "up")
+        '''Pipe from the client to the server.'''
+        self.Down = Pipe(self, "down")
+        '''Pipe from the server to the client.'''
+        self.StallUntil = 0
+        '''Time at which the current stall ends.'''
+        self.NextStall = proxy.Conditions.NextStall(now)
+        '''Time of the next stall, or None for no stalls.'''
+        self.Stalls = 0
+        '''Number of stalls so far.'''
+        self.Open = 2
+        '''Number of endpoints still open.'''
+        
+        # Join up the two sides.
+        self.Client = Endpoint(self, self.Up, sock)
+        '''Endpoint facing the client.'''
+        self.Server = Endpoint(self, self.Down)
+        '''Endpoint facing the server.'''
+        self.Up.Sink = self.Server
+        self.Down.Sink = self.Client
+    
+    def Connect(self):
+        '''
+        Connects to the server on the client's behalf.
+        '''
+        try:
+            self.Server.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.Server.connect(self.Proxy.Target)
+        except socket.error as err:
+            print "flow %i: could not connect to the server: %s" % (
+                    self.Number, err)
+            self.Server.Close()
+    
+    def Tick(self, now):
+        '''
+        Starts a stall if one is due.
+        '''
+        if self.NextStall is None or now < self.NextStall:
+            return
+        cond = self.Proxy.Conditions
+        self.StallUntil = now + cond.Stall
+        self.NextStall = cond.NextStall(self.StallUntil)
+        self.Stalls += 1
+    
+    def EndpointClosed(self):
+        '''
+        Called when one of the endpoints closes.
+        '''
+        self.Open -= 1
+        if self.Open == 0:
+            self.Proxy.FlowFinished(self)
+    
+    def Describe(self):
+        '''
+        Summarizes the connection's statistics.
+        '''
+        return "flow %i from %s, %.1f s: %s; %s; %i stalls" % (
+                self.Number, self.Peer[0], time.time() - self.Started,
+                self.Up.Describe(), self.Down.Describe(), self.Stalls)
+
+
+class Proxy(asyncore.dispatcher):
+    '''
+    Listening socket of the proxy.
+    '''
+    
+    def __init__(self, options):
+        # Inherit base class behavior.
+        asyncore.dispatcher.__init__(self)
+        
+        # Declare attributes.
+        self.Conditions = Conditions(options)
+        '''Network conditions applied to every connection.'''
+        self.Target = (options.host, options.port)
+        '''Address of the server.'''
+        self.Flows = {}
+        '''Maps connection numbers to the open connections.'''
+        self.Finished = []
+        '''Connections which have closed.'''
+        self.Timers = []
+        '''Heap of (due time, pipe) pairs waiting to be delivered.'''
+        self._NextNumber = 0
+        '''Number of the next connection.'''
+        
+        # Start listening.
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((options.interface, options.listen))
+        self.listen(128)
+    
+    def writable(self):
+        return False
+    
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None:
+            return
+        sock, peer = pair
+        number = self._NextNumber
+        self._NextNumber += 1
+        flow = Flow(self, number, sock, peer)
+        self.Flows[number] = flow
+        flow.Connect()
+    
+    def Schedule(self, due, pipe):
+        '''
+        Arranges for a pipe to deliver its chunks at the given time.
+        '''
+        heapq.heappush(self.Timers, (due, id(pipe), pipe))
+    
+    def FlowFinished(self, flow):
+        '''
+        Called when both sides of a connection have closed.
+        '''
+        if self.Flows.pop(flow.Number, None) is not None:
+            self.Finished.append(flow)
+            print flow.Describe()
+    
+    def Run(self):
+        '''
+        Runs the proxy until interrupted.
+        '''
+        lasttick = 0
+        while 1:
+            # Wait for network events, or the next chunk to come due.
+            timeout = 0.05
+            if self.Timers:
+                timeout = min(timeout, max(self.Timers[0][0] - time.time(),
+                                           0.0))
+            asyncore.loop(timeout=timeout, count=1, use_poll=True)
+            
+            # Deliver what's due.
+            now = time.time()
+            while self.Timers and self.Timers[0][0] <= now:
+                due, key, pipe = heapq.heappop(self.Timers)
+                pipe.Deliver(now)
+            
+            # Start any stalls.
+            if now - lasttick > 0.01:
+                lasttick = now
+                for flow in self.Flows.values():
+                    flow.Tick(now)
+    
+    def Report(self):
+        '''
+        Prints the statistics of every connection.
+        '''
+        flows = self.Finished + self.Flows.values()
+        if not flows:
+            print "No connections."
+            return
+        for flow in self.Flows.values():
+            print flow.Describe()
+        up = sum(flow.Up.Bytes for flow in flows)
+        down = sum(flow.Down.Bytes for flow in flows)
+        stalls = sum(flow.Stalls for flow in flows)
+        print "%i connections, %i B up, %i B down, %i stalls." % (
+                len(flows), up, down, stalls)
+
+
+def Main():
+    '''
+    Entry point of the emulator.
+    '''
+    usage = "%prog [options] [host [port]]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("-p", "--listen", type="int", default=24021,
+                      help="port to accept clients on (default: %default)")
+    parser.add_option("-i", "--interface", default="127.0.0.1",
+                      help="address to accept clients on (default: "
+                      "%default)")
+    parser.add_option("-l", "--latency", type="float", default=0.0,
+                      help="one-way delay in milliseconds")
+    parser.add_option("-j", "--jitter", type="float", default=0.0,
+                      help="random change to the delay, in milliseconds")
+    parser.add_option("-b", "--bandwidth", type="float", default=0.0,
+                      help="KB/s in each direction of each connection")
+    parser.add_option("-r", "--reorder", type="float", default=0.0,
+                      help="percent of chunks held back by a round trip")
+    parser.add_option("--stall-interval", type="float", default=0.0,
+                      help="average seconds between stalls")
+    parser.add_option("--stall", type="float", default=0.0,
+                      help="length of a stall in milliseconds")
+    parser.add_option("--chunk", type="int", default=1460,
+                      help="largest chunk passed on at once, in bytes "
+                      "(default: %default)")
+    parser.add_option("--seed", type="int", default=None,
+                      help="random seed, to repeat a run's conditions")
+    options, args = parser.parse_args()
+    options.host = "127.0.0.1"
+    options.port = 24020
+    if args:
+        options.host = args[0]
+    if len(args) > 1:
+        options.port = int(args[1])
+    if options.chunk < 1:
+        parser.error("the chunk size must be at least 1 byte")
+    if options.seed is not None:
+        random.seed(options.seed)
+    
+    # Run the proxy.
+    try:
+        proxy = Proxy(options)
+    except socket.error as err:
+        print >> sys.stderr, "Could not listen on port %i: %s" % (
+                options.listen, err)
+        return 1
+    print "Forwarding %s port %i to %s port %i..." % (
+            options.interface, options.listen, options.host, options.port)
+    try:
+        proxy.Run()
+    except KeyboardInterrupt:
+        print
+        proxy.Report()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(Main())
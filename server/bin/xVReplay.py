@@ -0,0 +1,585 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# xVector Engine Server
+# Copyright (c) 2012 James Buchwald
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+'''
+Packet capture replayer.
+
+Plays back a capture recorded by the server (see Diagnostics/Capture in the
+server configuration), sending the same packets on the same connections in
+the same order.  There are two ways to replay a capture:
+
+  - Over the network (the default): every captured connection is opened
+    against a server and sent its packets, as the original clients did.
+    The server's replies are read and thrown away.
+  - Directly (--direct): the server code is loaded into this process with the
+    given configuration file, and the packets are fed straight into the
+    connection handlers and packet routers without any sockets.  This
+    measures the server's packet handling alone, and the time spent on each
+    packet type is reported.
+
+By default the capture is replayed as fast as possible; --speed 1 keeps the
+original timing, --speed 2 plays it twice as fast, and so on.
+
+The packets are sent exactly as they were recorded, but the server's side of
+the conversation can't be: login challenges and login tokens are random, so
+the logins and session resumes in a capture fail when it is replayed.
+
+A direct replay uses the database in the configuration file, and registers
+every account registered in the capture.  Point it at a scratch copy of the
+database, never a live one.
+'''
+
+import sys
+import time
+import errno
+import socket
+import asyncore
+import logging
+import optparse
+from xVLib import Capture, Packets
+
+Batch = 100
+'''Records handled between network polls when replaying at full speed.'''
+
+
+class ReplayStats(object):
+    '''
+    Results of a replay.
+    '''
+    
+    def __init__(self):
+        self.Connections = 0
+        '''Number of connections opened.'''
+        self.Frames = 0
+        '''Number of packets replayed.'''
+        self.BytesOut = 0
+        '''Bytes of packets replayed.'''
+        self.BytesIn = 0
+        '''Bytes received from the server.'''
+        self.Timings = {}
+        '''Maps packet class names to lists of handling times in seconds.'''
+        self.Errors = {}
+        '''Maps error descriptions to the number of times they happened.'''
+    
+    def Error(self, description):
+        '''
+        Records an error.
+        '''
+        self.Errors[description] = self.Errors.get(description, 0) + 1
+
+
+##
+## Network replay
+##
+
+class ReplayClient(asyncore.dispatcher):
+    '''
+    Connection replaying one captured connection against a server.
+    '''
+    
+    def __init__(self, replay, connid):
+        '''
+        Opens the connection.
+        
+        @type replay: NetworkReplay
+        @param replay: Replay the connection belongs to.
+        
+        @type connid: integer
+        @param connid: Number of the connection within the capture.
+        '''
+        # Inherit base class behavior.
+        asyncore.dispatcher.__init__(self)
+        
+        # Declare attributes.
+        self.Replay = replay
+        '''Replay the connection belongs to.'''
+        self.ConnID = connid
+        '''Number of the connection within the capture.'''
+        self.OutBuffer = b""
+        '''Data waiting to be sent.'''
+        self.Finishing = False
+        '''If True, the connection closes once the buffer is sent.'''
+        self.Closed = False
+        '''True once the connection has been closed.'''
+        
+        # Connect.
+        try:
+            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            source = replay.NextSource()
+            if source:
+                self.bind((source, 0))
+            self.connect(replay.Address)
+        except socket.error as err:
+            self.Fail(err)
+    
+    def Send(self, data):
+        '''
+        Queues a packet to be sent.
+        '''
+        self.OutBuffer += data
+    
+    def Finish(self):
+        '''
+        Closes the connection once everything queued has been sent.
+        '''
+        self.Finishing = True
+        if not self.OutBuffer:
+            self.Close()
+    
+    def Close(self):
+        '''
+        Closes the connection.
+        '''
+        self.Closed = True
+        self.close()
+        self.Replay.ClientClosed(self)
+    
+    def Fail(self, err):
+        '''
+        Records a socket error and closes the connection.
+        '''
+        code = err.args[0] if err.args else err
+        self.Replay.Stats.Error("socket error: %s"
+                                % errno.errorcode.get(code, code))
+        self.Close()
+    
+    def writable(self):
+        return self.connecting or bool(self.OutBuffer)
+    
+    def handle_connect(self):
+        self.Replay.Stats.Connections += 1
+    
+    def handle_write(self):
+        sent = self.send(self.OutBuffer)
+        self.OutBuffer = self.OutBuffer[sent:]
+        if self.Finishing and not self.OutBuffer:
+            self.Close()
+    
+    def handle_read(self):
+        self.Replay.Stats.BytesIn += len(self.recv(65536))
+    
+    def handle_close(self):
+        if not self.Finishing:
+            self.Replay.Stats.Error("disconnected by server")
+        self.Close()
+    
+    def handle_error(self):
+        err = sys.exc_info()[1]
+        if isinstance(err, socket.error):
+            self.Fail(err)
+        else:
+            self.Replay.Stats.Error("%s: %s" % (type(err).__name__, err))
+            self.Close()
+
+
+class NetworkReplay(object):
+    '''
+    Replays a capture against a server over the network.
+    '''
+    
+    def __init__(self, options):
+        self.Address = (options.host, options.port)
+        '''Address of the server.'''
+        self.Speed = options.speed
+        '''Playback speed, or 0 to replay as fast as possible.'''
+        self.Sources = options.sources
+        '''Number of loopback source addresses to spread connections over.'''
+        self.Stats = ReplayStats()
+        '''Results of the replay.'''
+        self.Clients = {}
+        '''Maps capture connection numbers to their open connections.'''
+        self._NextSource = 0
+        '''Index of the next source address to use.'''
+    
+    def NextSource(self):
+        '''
+        Picks the local address for the next connection.
+        
+        @return: Source address, or None to let the system choose.
+        '''
+        if self.Sources <= 1:
+            return None
+        n = self._NextSource % self.Sources
+        self._NextSource += 1
+        return "127.%i.%i.%i" % ((n >> 16) & 255, (n >> 8) & 255,
+                                 (n & 255) + 1)
+    
+    def ClientClosed(self, client):
+        '''
+        Called when a connection closes.
+        '''
+        if self.Clients.get(client.ConnID) is client:
+            del self.Clients[client.ConnID]
+    
+    def Handle(self, kind, connid, data):
+        '''
+        Replays a single record.
+        '''
+        if kind == Capture.Record_Open:
+            client = ReplayClient(self, connid)
+            if not client.Closed:
+                self.Clients[connid] = client
+            return
+        client = self.Clients.get(connid)
+        if client is None:
+            # Dropped by the server already.
+            return
+        if kind == Capture.Record_Frame:
+            client.Send(data)
+            self.Stats.Frames += 1
+            self.Stats.BytesOut += len(data)
+        elif kind == Capture.Record_Close:
+            client.Finish()
+    
+    def Run(self, reader):
+        '''
+        Replays a capture.
+        
+        @return: Seconds the replay took.
+        '''
+        start = time.time()
+        records = iter(reader)
+        record = next(records, None)
+        while record is not None or self.Clients:
+            # Replay whatever is due.
+            handled = 0
+            now = time.time()
+            while record is not None and handled < Batch:
+                kind, connid, offset, data = record
+                if self.Speed and start + offset / self.Speed > now:
+                    break
+                self.Handle(kind, connid, data)
+                record = next(records, None)
+                handled += 1
+                if record is None:
+                    # A capture cut short can leave connections open.
+                    for client in self.Clients.values():
+                        client.Finish()
+            
+            # Handle network events.
+            if asyncore.socket_map:
+                asyncore.loop(timeout=0.001, count=1, use_poll=True)
+            else:
+                time.sleep(0.001)
+        return time.time() - start
+
+
+##
+## Direct replay
+##
+
+class NullSocket(object):
+    '''
+    Stands in for the socket of a directly replayed connection.
+    '''
+    
+    def close(self):
+        pass
+
+
+def DirectReplayConnection(stats):
+    '''
+    Builds the connection class used for direct replays.
+    
+    The server package is only imported for direct replays, so the class is
+    built once it has been.
+    '''
+    from xVServer.ServerNetworking import ServerConnection
+    
+    class ReplayConnection(ServerConnection):
+        '''
+        Server connection fed from a capture instead of a socket.
+        '''
+        
+        def __init__(self, address):
+            self.ReplayAddress = (address, 0)
+            '''Address the connection was recorded from.'''
+            self.Closed = False
+            '''True once the connection has been closed.'''
+            ServerConnection.__init__(self)
+        
+        @property
+        def Address(self):
+            return self.ReplayAddress
+        
+        def __hash__(self):
+            # Dispatchers hash their socket, and there isn't one.
+            return id(self)
+        
+        def Feed(self, data):
+            '''
+            Passes a recorded packet to the connection.
+            '''
+            self.RecvBuffer += data
+            try:
+                while not self.Closed:
+                    self.PacketReceived(self._TryPacketBuild())
+            except Packets.IncompletePacket:
+                pass
+            except Packets.CorruptPacket:
+                self.OnCorruptPacket()
+        
+        def PacketReceived(self, packet):
+            start = time.time()
+            try:
+                ServerConnection.PacketReceived(self, packet)
+            except:
+                self.handle_error()
+            elapsed = time.time() - start
+            name = type(packet).__name__
+            stats.Timings.setdefault(name, []).append(elapsed)
+        
+        def send(self, data):
+            # Replies go nowhere.
+            stats.BytesIn += len(data)
+        
+        def close(self):
+            if self.Closed:
+                return
+            self.Closed = True
+            self.socket = NullSocket()
+            ServerConnection.close(self)
+    
+    return ReplayConnection
+
+
+class DirectReplay(object):
+    '''
+    Replays a capture straight into the server code.
+    '''
+    
+    def __init__(self, options):
+        self.ConfigPath = options.config
+        '''Path of the server configuration file to use.'''
+        self.Speed = options.speed
+        '''Playback speed, or 0 to replay as fast as possible.'''
+        self.Stats = ReplayStats()
+        '''Results of the replay.'''
+        self.Connections = {}
+        '''Maps capture connection numbers to their open connections.'''
+        self.ConnectionClass = None
+        '''Class of the replayed connections.'''
+    
+    def StartServer(self):
+        '''
+        Sets up the parts of the server that handle packets.
+        
+        @return: True on success, False otherwise.
+        '''
+        from xVServer import ServerCore, ServerGlobals, ServerNetworking
+        from xVServer import Database, IPBans, PacketCapture
+        app = ServerCore.ServerApplication()
+        ServerGlobals.Application = app
+        if self.ConfigPath:
+            app.ConfigFilePath = self.ConfigPath
+        app.Config = app.LoadConfig()
+        if app.Config is None:
+            return False
+        try:
+            Database.InitDB(app.Config)
+        except Exception:
+            return False
+        IPBans.LoadBans()
+        app.ApplyConfig()
+        
+        # Don't capture the replay itself.
+        PacketCapture.StopCapture()
+        Database.StartExecutor(app.Config)
+        app.Connections = ServerNetworking.ConnectionManager()
+        self.ConnectionClass = DirectReplayConnection(self.Stats)
+        return True
+    
+    def StopServer(self):
+        '''
+        Waits for the database to catch up, then shuts it down.
+        '''
+        from xVServer import Database, Persistence
+        self.Drain()
+        Database.StopExecutor()
+        Persistence.FlushNow()
+    
+    def Service(self):
+        '''
+        Runs the main loop's housekeeping once.
+        
+        @return: Number of callbacks run.
+        '''
+        from xVServer import Accounts, Persistence, Callbacks
+        Accounts.FlushLookups()
+        Persistence.Tick()
+        return Callbacks.RunCallbacks()
+    
+    def Drain(self):
+        '''
+        Services the main loop until the database has gone quiet.
+        '''
+        from xVServer import Database
+        quiet = time.time()
+        while time.time() - quiet < 0.5:
+            if self.Service() or Database.Executor.PendingJobs():
+                quiet = time.time()
+            else:
+                time.sleep(0.01)
+    
+    def Handle(self, kind, connid, data):
+        '''
+        Replays a single record.
+        '''
+        if kind == Capture.Record_Open:
+            conn = self.ConnectionClass(data.decode("utf-8"))
+            self.Connections[connid] = conn
+            self.Stats.Connections += 1
+            return
+        conn = self.Connections.get(connid)
+        if conn is None:
+            return
+        if kind == Capture.Record_Frame:
+            self.Stats.Frames += 1
+            self.Stats.BytesOut += len(data)
+            if not conn.Closed:
+                conn.Feed(data)
+        elif kind == Capture.Record_Close:
+            del self.Connections[connid]
+            conn.close()
+    
+    def Run(self, reader):
+        '''
+        Replays a capture.
+        
+        @return: Seconds the replay took.
+        '''
+        start = time.time()
+        for kind, connid, offset, data in reader:
+            if self.Speed:
+                # Keep the main loop going until the record is due.
+                due = start + offset / self.Speed
+                while time.time() < due:
+                    if not self.Service():
+                        time.sleep(min(0.001, max(0, due - time.time())))
+            self.Handle(kind, connid, data)
+            self.Service()
+        elapsed = time.time() - start
+        
+        # Close anything the capture left open.
+        for conn in self.Connections.values():
+            conn.close()
+        self.Connections.clear()
+        return elapsed
+
+
+##
+## Reporting
+##
+
+def Report(stats, elapsed, direct):
+    '''
+    Prints the results of a replay.
+    '''
+    print
+    print "Replayed %i packets on %i connections in %.2f seconds." % (
+            stats.Frames, stats.Connections, elapsed)
+    if elapsed > 0:
+        print "  %.1f packets per second, %.1f KB/s sent, %.1f KB/s " \
+              "received." % (stats.Frames / elapsed,
+                             stats.BytesOut / elapsed / 1024.0,
+                             stats.BytesIn / elapsed / 1024.0)
+    if direct and stats.Timings:
+        print
+        print "  %-28s %8s %10s %9s %9s %9s" % ("handler (us)", "count",
+                                                "total ms", "mean", "p99",
+                                                "max")
+        rows = sorted(stats.Timings.iteritems(), key=lambda item:
+                      -sum(item[1]))
+        for name, times in rows:
+            times = sorted(times)
+            n = len(times)
+            p99 = times[min(n - 1, int(0.99 * n))]
+            print "  %-28s %8i %10.1f %9.1f %9.1f %9.1f" % (
+                    name, n, sum(times) * 1000, sum(times) / n * 1e6,
+                    p99 * 1e6, times[-1] * 1e6)
+    if stats.Errors:
+        print
+        print "  Errors:"
+        for description, count in sorted(stats.Errors.iteritems(),
+                                         key=lambda item: -item[1]):
+            print "  %7i  %s" % (count, description)
+
+
+def Main():
+    '''
+    Entry point of the replayer.
+    '''
+    usage = "%prog [options] capture [host [port]]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("-s", "--speed", type="float", default=0.0,
+                      help="playback speed relative to the original timing "
+                      "(default: 0, as fast as possible)")
+    parser.add_option("-d", "--direct", action="store_true", default=False,
+                      help="feed the packets into the server code in this "
+                      "process instead of a server over the network")
+    parser.add_option("-c", "--config", default=None,
+                      help="server configuration file for --direct")
+    parser.add_option("-v", "--verbose", action="store_true", default=False,
+                      help="show the server's log messages with --direct")
+    parser.add_option("--sources", type="int", default=1,
+                      help="number of loopback addresses to connect from")
+    options, args = parser.parse_args()
+    if not args:
+        parser.error("no capture file given")
+    if options.speed < 0:
+        parser.error("the speed can't be negative")
+    options.host = "127.0.0.1"
+    options.port = 24020
+    if len(args) > 1:
+        options.host = args[1]
+    if len(args) > 2:
+        options.port = int(args[2])
+    
+    # Open the capture.
+    try:
+        reader = Capture.CaptureReader(args[0])
+    except (IOError, Capture.CaptureFormatError) as err:
+        print >> sys.stderr, "Could not open capture: %s" % err
+        return 1
+    
+    # Replay it.
+    if options.direct:
+        replay = DirectReplay(options)
+        if not replay.StartServer():
+            return 1
+        if not options.verbose:
+            logging.getLogger("Server.Main").setLevel(logging.WARNING)
+        print "Replaying %s into the server code..." % args[0]
+    else:
+        replay = NetworkReplay(options)
+        print "Replaying %s against %s port %i..." % (args[0], options.host,
+                                                      options.port)
+    try:
+        elapsed = replay.Run(reader)
+    finally:
+        reader.Close()
+        if options.direct:
+            replay.StopServer()
+    Report(replay.Stats, elapsed, options.direct)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(Main())
@@ -20,14 +20,26 @@ Account management code.
 '''
 
 from sqlalchemy import Column, Integer, String, Boolean, DateTime
+from sqlalchemy.exc import IntegrityError
+from collections import OrderedDict
 import base64
 import datetime
-from . import Database
+import functools
+import logging
+import threading
+import time
+import traceback
+from . import Database, Persistence
+
+mainlog = logging.getLogger("Server.Main")
 
 ##
 ## A few constants...
 ##
 
+LookupBatchSize = 500
+'''Maximum number of usernames to put in a single IN clause.'''
+
 UsernameMaxLength = 32
 '''Maximum length of username.'''
 EmailMaxLength = 64
@@ -107,7 +119,312 @@ class UsernameTaken(Exception): pass
 '''Raised during registration if the username is already taken.'''
 
 
-def Register(username, passwordhash, salt, email, creator):
+class AccountCache(object):
+    '''
+    In-memory cache of accounts, keyed by username.
+    
+    Entries expire after a fixed time-to-live, and the least recently used
+    entries are evicted once the cache is full.  Unknown usernames are cached
+    too (as None, with a shorter time-to-live) so that repeated attempts to
+    log into a nonexistent account don't reach the database.
+    
+    Cached accounts are detached from any session.  Anything that changes an
+    account in the database must call Invalidate() for its username.
+    
+    A lookup which reads the database races with any change committed on
+    another thread while it runs, so its result must not be cached if an
+    invalidation happened in between.  Lookups take the Generation() before
+    querying and pass it to Put(), which drops the result if it has changed.
+    
+    The cache is shared by the main loop and the database workers, so all of
+    its methods are thread-safe.
+    '''
+    
+    def __init__(self, maxsize=10000, ttl=300.0, negativettl=30.0):
+        '''
+        Creates an empty cache.
+        
+        @type maxsize: integer
+        @param maxsize: Maximum number of usernames to cache.
+        
+        @type ttl: number
+        @param ttl: Number of seconds to cache an account for.
+        
+        @type negativettl: number
+        @param negativettl: Number of seconds to cache an unknown username for.
+        '''
+        self.MaxSize = maxsize
+        '''Maximum number of usernames to cache.'''
+        self.TTL = ttl
+        '''Number of seconds to cache an account for.'''
+        self.NegativeTTL = negativettl
+        '''Number of seconds to cache an unknown username for.'''
+        self._Entries = OrderedDict()
+        '''Maps usernames to (account, expiry time), least recent first.'''
+        self._Lock = threading.Lock()
+        '''Lock protecting the entries.'''
+        self._Generation = 0
+        '''Number of invalidations so far.'''
+    
+    def Get(self, username):
+        '''
+        Looks up a username in the cache.
+        
+        @type username: string
+        @param username: Username to look up.
+        
+        @return: A tuple (hit, account).  If hit is False, the username is not
+        cached and the database must be checked.  Otherwise account is the
+        cached account, or None if the username is known not to exist.
+        '''
+        with self._Lock:
+            try:
+                account, expires = self._Entries.pop(username)
+            except KeyError:
+                return (False, None)
+            if time.time() > expires:
+                return (False, None)
+            # Move it to the most recently used end.
+            self._Entries[username] = (account, expires)
+            return (True, account)
+    
+    def Generation(self):
+        '''
+        Gets the current invalidation generation, to be passed to Put() with
+        the result of a database lookup started after this call.
+        '''
+        with self._Lock:
+            return self._Generation
+    
+    def Put(self, username, account, generation=None):
+        '''
+        Adds a lookup result to the cache.
+        
+        @type username: string
+        @param username: Username that was looked up.
+        
+        @type account: Account
+        @param account: Detached account, or None if the username is unknown.
+        
+        @type generation: integer
+        @param generation: Value of Generation() from before the lookup.  If
+        anything has been invalidated since then, the result may be out of
+        date and is not cached.  If None, the result is always cached.
+        '''
+        if account is None:
+            expires = time.time() + self.NegativeTTL
+        else:
+            expires = time.time() + self.TTL
+        with self._Lock:
+            if generation is not None and generation != self._Generation:
+                return
+            self._Entries.pop(username, None)
+            self._Entries[username] = (account, expires)
+            while len(self._Entries) > self.MaxSize:
+                self._Entries.popitem(last=False)
+    
+    def Invalidate(self, username):
+        '''
+        Removes a username from the cache.
+        
+        @type username: string
+        @param username: Username to remove.
+        '''
+        with self._Lock:
+            self._Entries.pop(username, None)
+            self._Generation += 1
+    
+    def Clear(self):
+        '''
+        Removes everything from the cache.
+        '''
+        with self._Lock:
+            self._Entries.clear()
+            self._Generation += 1
+
+
+Cache = AccountCache()
+'''Shared account cache.'''
+
+
+def ConfigureCache(config):
+    '''
+    Applies the cache settings from the configuration file.
+    
+    @type config: xVLib.ConfigurationFile.ConfigurationFile
+    @param config: Handle to the main configuration file object.
+    '''
+    Cache.MaxSize = config['Database/AccountCache/Size']
+    Cache.TTL = config['Database/AccountCache/TTL']
+    Cache.NegativeTTL = config['Database/AccountCache/NegativeTTL']
+
+
+def Lookup(username, session=None):
+    '''
+    Looks up an account by username, using the cache if possible.
+    
+    The account is detached from the session before it is returned.
+    
+    @type username: string
+    @param username: Username to look up.
+    
+    @type session: sqlalchemy.orm.Session
+    @param session: Session to query with.  Defaults to the main session.
+    
+    @return: The matching Account, or None if there isn't one.
+    '''
+    hit, account = Cache.Get(username)
+    if hit:
+        return account
+    
+    # Not cached; check the database.
+    if session is None:
+        session = Database.MainSession
+    generation = Cache.Generation()
+    query = session.query(Account).filter(Account.Username == username)
+    account = query.first()
+    if account is not None:
+        session.expunge(account)
+    Cache.Put(username, account, generation)
+    return account
+
+
+def LookupMany(usernames, session=None):
+    '''
+    Looks up several accounts at once.
+    
+    Usernames which aren't cached are fetched with as few queries as possible
+    (one per LookupBatchSize usernames).  The accounts are detached from the
+    session before they are returned.
+    
+    @type usernames: list of strings
+    @param usernames: Usernames to look up.
+    
+    @type session: sqlalchemy.orm.Session
+    @param session: Session to query with.  Defaults to the main session.
+    
+    @return: A dict mapping each username to its Account, or to None if there
+    is no such account.
+    '''
+    results = {}
+    missing = []
+    for username in usernames:
+        hit, account = Cache.Get(username)
+        if hit:
+            results[username] = account
+        else:
+            missing.append(username)
+    if not missing:
+        return results
+    
+    # Fetch the rest from the database.
+    if session is None:
+        session = Database.MainSession
+    # MySQL compares usernames without regard to case by default, in which
+    # case the rows must be matched to the usernames the same way.
+    foldcase = session.get_bind(Account).dialect.name == "mysql"
+    for i in xrange(0, len(missing), LookupBatchSize):
+        chunk = missing[i:i + LookupBatchSize]
+        generation = Cache.Generation()
+        query = session.query(Account)
+        query = query.filter(Account.Username.in_(chunk))
+        found = {}
+        for account in query:
+            session.expunge(account)
+            if foldcase:
+                found[account.Username.lower()] = account
+            else:
+                found[account.Username] = account
+        for username in chunk:
+            if foldcase:
+                account = found.get(username.lower())
+            else:
+                account = found.get(username)
+            results[username] = account
+            Cache.Put(username, account, generation)
+    return results
+
+
+_PendingLookups = OrderedDict()
+'''Maps usernames to lists of (callback, errback) waiting on a lookup.'''
+
+
+def RequestLookup(username, callback, errback):
+    '''
+    Asks for an account to be looked up in the background.
+    
+    Lookups which miss the cache are held until the next call to
+    FlushLookups(), so that every lookup requested during a cycle of the main
+    loop is resolved by a single query.  This must only be called from the
+    main loop.
+    
+    @type username: string
+    @param username: Username to look up.
+    
+    @type callback: callable
+    @param callback: Called with the Account (or None) once it is known.  If
+    the account is cached, this is called before RequestLookup() returns.
+    
+    @type errback: callable
+    @param errback: Called with the exception if the lookup fails.
+    '''
+    hit, account = Cache.Get(username)
+    if hit:
+        callback(account)
+        return
+    _PendingLookups.setdefault(username, []).append((callback, errback))
+
+
+def FlushLookups():
+    '''
+    Submits all of the held lookups as a single database job.
+    
+    This should be called once per cycle of the main loop.
+    
+    @return: Number of distinct usernames submitted.
+    '''
+    if not _PendingLookups:
+        return 0
+    waiters = _PendingLookups.copy()
+    _PendingLookups.clear()
+    job = functools.partial(LookupMany, waiters.keys())
+    Database.Submit(job, functools.partial(_LookupsDone, waiters),
+                    functools.partial(_LookupsFailed, waiters))
+    return len(waiters)
+
+
+def _LookupsDone(waiters, results):
+    '''
+    Hands the results of a batched lookup to everyone waiting on it.
+    '''
+    for username, callbacks in waiters.iteritems():
+        account = results.get(username)
+        for callback, errback in callbacks:
+            _RunLookupCallback(callback, account)
+
+
+def _LookupsFailed(waiters, err):
+    '''
+    Reports a failed batched lookup to everyone waiting on it.
+    '''
+    for callbacks in waiters.itervalues():
+        for callback, errback in callbacks:
+            _RunLookupCallback(errback, err)
+
+
+def _RunLookupCallback(callback, arg):
+    '''
+    Runs a single lookup callback, so that one failure doesn't stop the rest.
+    '''
+    try:
+        callback(arg)
+    except:
+        msg = "Unhandled exception in account lookup callback.\n\n"
+        msg += traceback.format_exc()
+        mainlog.error(msg)
+
+
+def Register(username, passwordhash, salt, email, creator, session=None):
     '''
     Registers a new account using the provided information.
     
@@ -126,6 +443,9 @@ def Register(username, passwordhash, salt, email, creator):
     @type creator: string (max length=45 characters)
     @param creator: IP address that this registration is occurring from.
     
+    @type session: sqlalchemy.orm.Session
+    @param session: Session to register with.  Defaults to the main session.
+    
     @raise UsernameTaken: Raised if the username is already in use.
     @raise ValueError: Raised if any values are invalid.
     
@@ -143,12 +463,19 @@ def Register(username, passwordhash, salt, email, creator):
     if len(creator) < 1 or len(creator) > 45:
         raise ValueError("Invalid creator IP address length")
     
-    # Check if the username is already in use.
-    session = Database.MainSession
-    query = session.query(Account).filter(Account.Username == username)
-    if query.count() > 0:
+    # Check if the username is already in use.  The unique index catches
+    # any race, so a cached answer is good enough here.
+    if session is None:
+        session = Database.MainSession
+    hit, cached = Cache.Get(username)
+    if hit and cached is not None:
         # Username is already in use
         raise UsernameTaken
+    elif not hit:
+        query = session.query(Account).filter(Account.Username == username)
+        if query.count() > 0:
+            # Username is already in use
+            raise UsernameTaken
     
     # Do a (very simple) check of the email address
     if email.find('@') <= 0:
@@ -164,5 +491,86 @@ def Register(username, passwordhash, salt, email, creator):
     NewAccount.CreationTime = datetime.datetime.utcnow()
     
     session.add(NewAccount)
-    session.commit()
+    try:
+        session.commit()
+    except IntegrityError:
+        # Someone else got the username first.
+        session.rollback()
+        raise UsernameTaken
+    finally:
+        Cache.Invalidate(username)
     return NewAccount
+
+
+def MarkDirty(account, *attributes):
+    '''
+    Queues changes to an account to be written back by the write-behind
+    persistence layer.  Main loop only.
+    
+    The cache is pointed at the changed account, since the database won't
+    have the changes until the next flush.
+    
+    @type account: Account
+    @param account: Detached account which has been changed.
+    
+    @param attributes: Names of the attributes which were changed, e.g.
+    "Email".  Only these are written back.
+    '''
+    Cache.Put(account.Username, account)
+    Persistence.MarkDirty(account, attributes)
+
+
+def Update(account, session=None):
+    '''
+    Saves changes to an account and drops it from the cache.
+    
+    @type account: Account
+    @param account: Account to save.  May be detached.
+    
+    @type session: sqlalchemy.orm.Session
+    @param session: Session to save with.  Defaults to the main session.
+    
+    @return: The account as attached to the session.
+    '''
+    if session is None:
+        session = Database.MainSession
+    try:
+        merged = session.merge(account)
+        session.commit()
+    finally:
+        Cache.Invalidate(account.Username)
+    return merged
+
+
+def Ban(username, expires=None, session=None):
+    '''
+    Bans an account, and revokes its login tokens so that it can't resume a
+    session.  Main loop only.
+    
+    @type username: string
+    @param username: Username of the account to ban.
+    
+    @type expires: datetime.datetime
+    @param expires: Time at which the ban expires, or None for a permanent ban.
+    
+    @type session: sqlalchemy.orm.Session
+    @param session: Session to save with.  Defaults to the main session.
+    
+    @raise KeyError: Raised if the account does not exist.
+    '''
+    if session is None:
+        session = Database.MainSession
+    query = session.query(Account).filter(Account.Username == username)
+    account = query.first()
+    if account is None:
+        raise KeyError(username)
+    account.Banned = True
+    account.BanExpires = expires
+    try:
+        session.commit()
+    finally:
+        Cache.Invalidate(username)
+    
+    # (In-function import, since Login imports this module.)
+    from .Login import RevokeTokens
+    RevokeTokens(username)
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+
+# xVector Engine Server
+# Copyright (c) 2012 James Buchwald
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+'''
+Admission control for new connections.
+
+The admission controller keeps a flood of new connections from hurting the
+players who are already in the game.  New connections are always accepted
+from the listening sockets at a limited rate; anything beyond that waits in
+the operating system's listen backlog.
+
+The controller also watches how long each cycle of the main loop takes and
+how much work is queued up for the background threads.  When either gets too
+high the server is considered overloaded, and connections which haven't
+logged in yet pay for it first:
+
+  1. New connections are accepted at a much lower rate (or not at all).
+  2. Connections still negotiating or waiting to log in stop being read
+     from, so their packets wait until the load drops.
+  3. If the overload lasts, those connections are closed.
+
+Players who are logged in are never deferred or closed by the controller.
+'''
+
+import logging
+import time
+from . import ServerGlobals, Database, Callbacks
+
+mainlog = logging.getLogger("Server.Main")
+
+
+class AdmissionController(object):
+    '''
+    Decides when new connections may be accepted and served.
+    '''
+    
+    Smoothing = 0.05
+    '''Weight given to each new cycle time in the moving average.'''
+    
+    ShedBatch = 10
+    '''Maximum number of connections closed at once while shedding.'''
+    
+    ShedInterval = 1.0
+    '''Number of seconds between rounds of shedding.'''
+    
+    def __init__(self):
+        '''
+        Creates an admission controller with the default settings.
+        '''
+        # Declare settings.
+        self.CycleBudget = 0.05
+        '''Average cycle time, in seconds, above which we're overloaded.'''
+        self.QueueLimit = 200
+        '''Queued background work above which we're overloaded.'''
+        self.AcceptRate = 50.0
+        '''New connections accepted per second normally.'''
+        self.AcceptBurst = 20.0
+        '''Number of new connections which may be accepted at once.'''
+        self.OverloadAcceptRate = 2.0
+        '''New connections accepted per second while overloaded.'''
+        self.ShedDelay = 5.0
+        '''Seconds of overload after which waiting connections are closed.'''
+        
+        # Declare state.
+        self.CycleTime = 0.0
+        '''Moving average of the main loop cycle time, in seconds.'''
+        self.QueueDepth = 0
+        '''Amount of background work queued as of the last cycle.'''
+        self.Overloaded = False
+        '''True if the server is currently overloaded.'''
+        self.OverloadedSince = None
+        '''Time at which the current overload began.'''
+        self.Tokens = self.AcceptBurst
+        '''Number of connections which may currently be accepted.'''
+        self.LastRefill = time.time()
+        '''Time at which Tokens was last topped up.'''
+        self.Shed = 0
+        '''Number of connections closed by load shedding so far.'''
+        self.LastShed = 0
+        '''Time of the last round of shedding.'''
+    
+    def Configure(self, config):
+        '''
+        Applies the admission settings from the configuration file.
+        
+        @type config: xVLib.ConfigurationFile.ConfigurationFile
+        @param config: Handle to the main configuration file object.
+        '''
+        self.CycleBudget = config['Network/Admission/CycleBudget'] / 1000.0
+        self.QueueLimit = config['Network/Admission/QueueLimit']
+        self.AcceptRate = float(config['Network/Admission/AcceptRate'])
+        self.AcceptBurst = float(config['Network/Admission/AcceptBurst'])
+        rate = config['Network/Admission/OverloadAcceptRate']
+        self.OverloadAcceptRate = float(rate)
+        self.ShedDelay = float(config['Network/Admission/ShedDelay'])
+        self.Tokens = self.AcceptBurst
+    
+    def Update(self, cycletime):
+        '''
+        Updates the load measurements.  Called once per main loop cycle.
+        
+        @type cycletime: number
+        @param cycletime: Length of the cycle that just finished, in seconds.
+        '''
+        # Measure the load.
+        weight = self.Smoothing
+        self.CycleTime += weight * (cycletime - self.CycleTime)
+        depth = Callbacks.PendingCount()
+        if Database.Executor:
+            depth += Database.Executor.PendingJobs()
+        self.QueueDepth = depth
+        
+        # Check for a change in state.  The thresholds for leaving the
+        # overloaded state are lower, so we don't flap back and forth.
+        now = time.time()
+        if not self.Overloaded:
+            if (self.CycleTime > self.CycleBudget
+                    or depth > self.QueueLimit):
+                self.Overloaded = True
+                self.OverloadedSince = now
+                msg = "Server overloaded (cycle %.1f ms, %i jobs queued); "
+                msg += "deferring new connections."
+                mainlog.warning(msg % (self.CycleTime * 1000, depth))
+        elif (self.CycleTime < self.CycleBudget / 2
+              and depth < self.QueueLimit / 2):
+            self.Overloaded = False
+            self.OverloadedSince = None
+            mainlog.info("Server load is back to normal.")
+        
+        # Shed waiting connections if this has gone on too long.
+        if self.Overloaded and now - self.OverloadedSince > self.ShedDelay:
+            if now - self.LastShed >= self.ShedInterval:
+                self.LastShed = now
+                self.ShedConnections()
+    
+    def CanAccept(self):
+        '''
+        Checks whether a new connection may be accepted right now.
+        
+        @return: Boolean.
+        '''
+        # Top up the bucket.
+        now = time.time()
+        if self.Overloaded:
+            rate = self.OverloadAcceptRate
+        else:
+            rate = self.AcceptRate
+        self.Tokens += (now - self.LastRefill) * rate
+        if self.Tokens > self.AcceptBurst:
+            self.Tokens = self.AcceptBurst
+        self.LastRefill = now
+        return self.Tokens >= 1.0
+    
+    def Accepted(self):
+        '''
+        Records that a new connection was accepted.
+        '''
+        self.Tokens -= 1.0
+    
+    def IsDeferred(self, conn):
+        '''
+        Checks whether a connection should be left unread for now.
+        
+        @type conn: xVServer.ServerNetworking.ServerConnection
+        @param conn: Connection to check.
+        
+        @return: True if the connection's packets should wait.
+        '''
+        return self.Overloaded and conn.State <= conn.State_WaitForLogin
+    
+    def ShedConnections(self):
+        '''
+        Closes some of the connections which haven't logged in yet.
+        '''
+        App = ServerGlobals.Application
+        count = 0
+        for conn in list(App.Connections.ConnectionSet):
+            if conn.State > conn.State_WaitForLogin:
+                continue
+            msg = "%s - Server overloaded, closing connection."
+            mainlog.info(msg % conn.Address[0])
+            conn.close()
+            count += 1
+            if count >= self.ShedBatch:
+                break
+        self.Shed += count
+
+
+Controller = AdmissionController()
+'''Shared admission controller.'''
+
+
+def InitAdmission(config):
+    '''
+    Applies the admission settings from the configuration file.
+    
+    @type config: xVLib.ConfigurationFile.ConfigurationFile
+    @param config: Handle to the main configuration file object.
+    '''
+    Controller.Configure(config)
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+# xVector Engine Server
+# Copyright (c) 2012 James Buchwald
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+'''
+Queue of callbacks to be run on the main loop.
+
+Background threads must never touch connections or other server state
+directly.  Instead, they post a callback here and the main loop runs it on the
+next cycle.
+'''
+
+import logging
+import traceback
+from collections import deque
+
+mainlog = logging.getLogger("Server.Main")
+
+
+_Pending = deque()
+'''Queue of (callback, args) pairs waiting to be run.'''
+
+
+def PostCallback(callback, *args):
+    '''
+    Queues a callback to be run on the main loop.
+    
+    This is safe to call from any thread.
+    
+    @type callback: callable
+    @param callback: Function to call.
+    
+    @param args: Positional arguments to pass to the callback.
+    '''
+    _Pending.append((callback, args))
+
+
+def PendingCount():
+    '''
+    Gets the number of callbacks waiting to be run.
+    '''
+    return len(_Pending)
+
+
+def RunCallbacks():
+    '''
+    Runs all of the callbacks that are currently queued.
+    
+    This should be called once per cycle of the main loop.  Callbacks which
+    are posted while this is running will be run on the next cycle.
+    
+    @return: Number of callbacks that were run.
+    '''
+    count = len(_Pending)
+    for i in xrange(count):
+        callback, args = _Pending.popleft()
+        try:
+            callback(*args)
+        except:
+            msg = "Unhandled exception in main loop callback.\n\n"
+            msg += traceback.format_exc()
+            mainlog.error(msg)
+    return count
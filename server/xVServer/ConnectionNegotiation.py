@@ -22,7 +22,7 @@ Connection negotiation handlers for the server.
 '''
 
 import logging
-from . import ServerGlobals
+from . import ServerGlobals, Login
 from xVLib import Packets, Version
 from .ServerPacketRouter import BaseServerPacketRouter
 
@@ -31,7 +31,7 @@ mainlog = logging.getLogger("Server.Main")
 ##
 ## Basic packet handlers
 ##    
-    
+
 def ConnectionNegotiationHandler(packet):
     '''
     Handles the connection negotiation for a single connection.
@@ -88,14 +88,26 @@ def ConnectionNegotiationHandler(packet):
         packet.Connection.close()
         return
     
+    # Try to pick up where a dropped connection left off.
+    conn = packet.Connection
+    resumed = False
+    if packet.ResumeToken:
+        resumed = Login.ResumeSession(conn, packet.ResumeToken)
+    
     # Accept the connection
     App = ServerGlobals.Application
-    reply = Packets.ConnectionAcceptedPacket(packet.Connection)
+    reply = Packets.ConnectionAcceptedPacket(conn)
     reply.ServerName = App.Config['General/ServerName']
     reply.ServerNewsURL = App.Config['General/ServerNewsURL']
+    reply.Resumed = resumed
     # TODO: Add "no-register" flag support
     reply.SendPacket()
-    packet.Connection.SetState(packet.Connection.State_WaitForLogin)
+    if resumed:
+        # Skip the login entirely.
+        Login.IssueToken(conn)
+        conn.SetState(conn.State_CharacterSelect)
+    else:
+        conn.SetState(conn.State_WaitForLogin)
 
 
 ##
@@ -104,12 +116,10 @@ def ConnectionNegotiationHandler(packet):
 
 class ConnectionNegotiationRouter(BaseServerPacketRouter):
     '''
-    Single-connection packet router for the connection negotiation state.
+    Packet router for the connection negotiation state.
     
-    A separate object of this class should be created for each connection, as
-    these objects track internal state.  (Actually, they DON'T in this case
-    since the server only has a single task during the negotiation state, but
-    it's good practice anyway.)
+    Like all server packet routers, a single object of this class is shared
+    by every connection in this state.
     '''
     
     def __init__(self):
@@ -22,7 +22,14 @@ Code that manages the database engine.
 '''
 
 import logging
-from sqlalchemy import create_engine
+import threading
+import time
+import traceback
+import Queue
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import DisconnectionError
+from sqlalchemy.pool import SingletonThreadPool
+from . import Callbacks, Metrics
 
 mainlog = logging.getLogger("Server.Main")
 
@@ -58,10 +65,155 @@ bound to an engine following engine creation.
 '''
 
 
+Executor = None
+'''
+Worker thread pool for database queries.
+
+Packet handlers must not query the database directly, since a slow query would
+stall every connection on the server; submit the work here instead.
+'''
+
+
 class DatabaseStartupError(Exception): pass
 '''Raised if the database engine cannot be started.'''
 
 
+class DatabaseExecutor(object):
+    '''
+    Runs database jobs on a pool of worker threads.
+    
+    Each worker has its own session.  A job is a callable which takes the
+    session as its only argument; the session is committed after the job
+    returns, or rolled back if it raises.  The result (or exception) is then
+    handed to a callback on the main loop.
+    
+    Objects returned by a job are expunged from the worker's session before
+    the callback runs, so they can be used on the main loop as long as they
+    don't need to lazy-load anything.
+    
+    Jobs which write to the database should be submitted with write=True.
+    These all run in order on a single dedicated writer thread, which keeps
+    writers from contending with each other (SQLite only allows one at a
+    time) and keeps their commits in the order they were submitted.
+    '''
+    
+    def __init__(self, threads):
+        '''
+        Creates the executor and starts its worker threads.
+        
+        @type threads: integer
+        @param threads: Number of worker threads to start.
+        '''
+        # Declare attributes.
+        self.Jobs = Queue.Queue()
+        '''Queue of (job, callback, errback) tuples waiting to be run.'''
+        self.WriteJobs = Queue.Queue()
+        '''Queue of write jobs waiting for the writer thread.'''
+        self.Workers = []
+        '''List of worker threads.'''
+        self.Writer = None
+        '''Dedicated writer thread.'''
+        
+        # Start the workers.
+        for i in range(threads):
+            worker = threading.Thread(target=self._WorkerMain,
+                                      args=(self.Jobs,),
+                                      name="DatabaseWorker")
+            worker.daemon = True
+            worker.start()
+            self.Workers.append(worker)
+        self.Writer = threading.Thread(target=self._WorkerMain,
+                                       args=(self.WriteJobs,),
+                                       name="DatabaseWriter")
+        self.Writer.daemon = True
+        self.Writer.start()
+    
+    def Submit(self, job, callback=None, errback=None, write=False):
+        '''
+        Queues a job to be run on a worker thread.
+        
+        @type job: callable
+        @param job: Function taking a session as its only argument.
+        
+        @type callback: callable
+        @param callback: Called on the main loop with the job's return value.
+        
+        @type errback: callable
+        @param errback: Called on the main loop with the exception if the job
+        raises.  If not set, the exception is logged.
+        
+        @type write: boolean
+        @param write: If True, run the job on the writer thread.
+        '''
+        if write:
+            self.WriteJobs.put((job, callback, errback))
+        else:
+            self.Jobs.put((job, callback, errback))
+    
+    def PendingJobs(self):
+        '''
+        Gets the approximate number of jobs waiting to be run.
+        '''
+        return self.Jobs.qsize() + self.WriteJobs.qsize()
+    
+    def Stop(self):
+        '''
+        Finishes any queued jobs, then stops the worker threads.
+        '''
+        for worker in self.Workers:
+            self.Jobs.put(None)
+        self.WriteJobs.put(None)
+        for worker in self.Workers:
+            worker.join()
+        self.Writer.join()
+        del self.Workers[:]
+        self.Writer = None
+    
+    def _WorkerMain(self, jobs):
+        '''
+        Main function of the worker threads.
+        
+        @type jobs: Queue.Queue
+        @param jobs: Queue to take jobs from.
+        '''
+        session = Session(expire_on_commit=False)
+        if jobs is self.WriteJobs:
+            timer = Metrics.DatabaseJobTime.Labels("write")
+        else:
+            timer = Metrics.DatabaseJobTime.Labels("read")
+        while 1:
+            item = jobs.get()
+            if item is None:
+                # Shut down.
+                break
+            job, callback, errback = item
+            
+            # Run the job.
+            start = time.time()
+            try:
+                result = job(session)
+                session.commit()
+            except Exception as err:
+                session.rollback()
+                session.expunge_all()
+                timer.Observe(time.time() - start)
+                if errback:
+                    Callbacks.PostCallback(errback, err)
+                else:
+                    msg = "Unhandled exception in database job.\n\n"
+                    msg += traceback.format_exc()
+                    mainlog.error(msg)
+                continue
+            
+            timer.Observe(time.time() - start)
+            
+            # Detach the results and hand them back.
+            session.expunge_all()
+            if callback:
+                Callbacks.PostCallback(callback, result)
+        session.close()
+
+
 def _InitDB_sqlite(config):
     '''
     Initializes the sqlite database.
@@ -78,18 +230,59 @@ def _InitDB_sqlite(config):
         mainlog.critical(msg)
         raise DatabaseStartupError
     
+    # Each thread keeps its own connection, so every database worker (and
+    # the writer in particular) holds onto a dedicated connection.
+    poolsize = config['Database/Threads'] + 2
+    
     # Connect to the database.
     global Engine, MainSession
     try:
-        Engine = create_engine(uri)
+        Engine = create_engine(uri, poolclass=SingletonThreadPool,
+                               pool_size=poolsize)
     except Exception as err:
         msg = "Could not open sqlite database: %s" % err[0]
         mainlog.critical(msg)
         raise DatabaseStartupError
+    event.listen(Engine, "connect", _SQLitePragmas(config))
     Session.configure(bind=Engine)
     MainSession = Session()
 
 
+SQLiteSyncModes = ("OFF", "NORMAL", "FULL", "EXTRA")
+'''Valid values for the Database/SQLite/Synchronous setting.'''
+
+
+def _SQLitePragmas(config):
+    '''
+    Builds a connect listener which tunes new SQLite connections.
+    
+    @type config: xVLib.ConfigurationFile.ConfigurationFile
+    @param config: Handle to the main configuration file object.
+    
+    @return: Function to be registered for the engine's connect event.
+    '''
+    pragmas = []
+    if config['Database/SQLite/WAL']:
+        # Readers don't block the writer (or each other) in WAL mode.
+        pragmas.append("PRAGMA journal_mode=WAL")
+    sync = config['Database/SQLite/Synchronous'].upper()
+    if sync in SQLiteSyncModes:
+        pragmas.append("PRAGMA synchronous=%s" % sync)
+    else:
+        msg = "Ignoring unknown SQLite synchronous mode %s." % sync
+        mainlog.warning(msg)
+    mmapsize = config['Database/SQLite/MmapSize']
+    if mmapsize > 0:
+        pragmas.append("PRAGMA mmap_size=%i" % mmapsize)
+    
+    def OnConnect(dbapi_conn, conn_record):
+        cursor = dbapi_conn.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+    return OnConnect
+
+
 def _InitDB_other(config):
     '''
     Initializes network database servers.
@@ -122,18 +315,41 @@ def _InitDB_other(config):
     # Put it all together.
     uri = "%s://%s%s/%s" % (type, auth, address, dbname)
     
+    # Pool settings.
+    poolargs = {'pool_size': config['Database/Pool/Size'],
+                'max_overflow': config['Database/Pool/MaxOverflow'],
+                'pool_recycle': config['Database/Pool/Recycle']}
+    
     # Connect to database.
     global Engine, MainSession
     try:
-        Engine = create_engine(uri)
+        Engine = create_engine(uri, **poolargs)
     except Exception as err:
         msg = "Error connecting to database: %s" % err[0]
         mainlog.critical(msg)
         raise DatabaseStartupError
+    if config['Database/Pool/PrePing']:
+        # Test connections before use so dropped ones are replaced quietly.
+        event.listen(Engine.pool, "checkout", _PrePing)
     Session.configure(bind=Engine)
     MainSession = Session()
 
 
+def _PrePing(dbapi_conn, conn_record, conn_proxy):
+    '''
+    Checkout listener which tests a pooled connection before it is used.
+    
+    @raise DisconnectionError: Raised if the connection has been dropped, so
+    that the pool throws it away and checks out another.
+    '''
+    try:
+        cursor = dbapi_conn.cursor()
+        cursor.execute("SELECT 1")
+        cursor.close()
+    except Exception:
+        raise DisconnectionError
+
+
 def InitDB(config):
     '''
     Initializes the database connection.
@@ -148,6 +364,36 @@ def InitDB(config):
         _InitDB_other(config)
 
 
+def StartExecutor(config):
+    '''
+    Starts the database worker threads.
+    
+    @type config: xVLib.ConfigurationFile.ConfigurationFile
+    @param config: Handle to the main configuration file object.
+    '''
+    global Executor
+    Executor = DatabaseExecutor(config['Database/Threads'])
+
+
+def StopExecutor():
+    '''
+    Stops the database worker threads once their queued jobs are done.
+    '''
+    global Executor
+    if Executor:
+        Executor.Stop()
+        Executor = None
+
+
+def Submit(job, callback=None, errback=None, write=False):
+    '''
+    Convenience function that queues a job on the database executor.
+    
+    See DatabaseExecutor.Submit() for details.
+    '''
+    Executor.Submit(job, callback, errback, write)
+
+
 def CreateTables():
     '''
     Creates the tables.
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+# xVector Engine Server
+# Copyright (c) 2012 James Buchwald
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+'''
+Players in the game world.
+
+A connection enters the game once its player has chosen a character; its
+character is put on the map through the area of interest manager (see the
+Interest module), which tells the player about everything around them and
+tells everyone nearby about the new arrival.  The character leaves the game
+when the connection is closed.
+'''
+
+import logging
+from xVLib import Packets
+from . import Interest
+from .ServerPacketRouter import BaseServerPacketRouter
+
+mainlog = logging.getLogger("Server.Main")
+
+
+class GameRouter(BaseServerPacketRouter):
+    '''
+    Packet router for connections in the game.
+    
+    There are no movement or interaction packets yet, so connections in
+    State_Game only have their KeepAlive and Disconnect packets answered;
+    any other packet is rejected and closes the connection.
+    '''
+    
+    def __init__(self):
+        # Inherit base class behavior.
+        super(GameRouter, self).__init__()
+
+
+def EnterGame(conn, name, sprite, mapname, x, y):
+    '''
+    Puts a connection's character into the game.
+    
+    @type conn: ServerNetworking.ServerConnection
+    @param conn: Connection of the player.
+    
+    @type name: unicode
+    @param name: Name of the character.
+    
+    @type sprite: integer
+    @param sprite: ID of the character's sprite.
+    
+    @type mapname: string
+    @param mapname: Name of the map to put the character on.
+    
+    @type x: integer
+    @param x: Horizontal tile coordinate.
+    
+    @type y: integer
+    @param y: Vertical tile coordinate.
+    
+    @return: The character's Interest.GameObject.
+    '''
+    obj = Interest.GameObject(Packets.AddObjectPacket.Type_Player, name,
+                              sprite, conn)
+    conn.GameObject = obj
+    conn.SetState(conn.State_Game)
+    Interest.Manager.Add(obj, mapname, x, y)
+    msg = "%s - Entered the game as %s." % (conn.Address[0], name)
+    mainlog.info(msg)
+    return obj
+
+
+def LeaveGame(conn):
+    '''
+    Takes a connection's character out of the game, if it is in it.
+    
+    @type conn: ServerNetworking.ServerConnection
+    @param conn: Connection of the player.
+    '''
+    obj = conn.GameObject
+    if obj is None:
+        return
+    conn.GameObject = None
+    Interest.Manager.Remove(obj)
@@ -25,15 +25,93 @@ the ban.  IP bans utilize CIDR notation to allow bans on ranges of addresses.
 
 import socket
 import struct
+import logging
 import datetime
+import heapq
+import gc
 from sqlalchemy import Column, Boolean, DateTime, String, BigInteger, Integer
 from sqlalchemy import SmallInteger
 from . import Database
 
+mainlog = logging.getLogger("Server.Main")
+
 _IPv4Struct = struct.Struct("!I")
 _IPv6Struct = struct.Struct("!QII")
 
 
+def _ParseCIDR(address):
+    '''
+    Parses an address in CIDR notation into the IPBanRecord storage format.
+    
+    Any address bits past the prefix are cleared.
+    
+    @type address: string
+    @param address: CIDR notation address to parse.
+    
+    @raise ValueError: Raised if an invalid address is supplied.
+    
+    @return: Tuple (Family, Low64, Mid32, High32, CIDR), where Family is
+    either socket.AF_INET or socket.AF_INET6.  Low64 and Mid32 are zero for
+    IPv4 addresses.
+    '''
+    # IPv4 or IPv6?
+    if address.find(":") == -1:
+        # IPv4
+        parts = address.split("/")
+        if len(parts) > 2: raise ValueError
+        elif len(parts) == 2: addr, cidr = parts
+        else:
+            # no CIDR prefix specified, assuming /32
+            addr = parts[0]
+            cidr = 32
+        try:
+            high = _IPv4Struct.unpack(socket.inet_aton(addr))[0]
+        except: raise ValueError
+        cidr = int(cidr)
+        if cidr < 0 or cidr > 32: raise ValueError
+        high &= ~((1 << (32 - cidr)) - 1)
+        return (socket.AF_INET, 0, 0, high, cidr)
+    else:
+        # IPv6
+        parts = address.split("/")
+        if len(parts) > 2: raise ValueError
+        elif len(parts) == 2: addr, cidr = parts
+        else:
+            # no CIDR prefix specified, assuming /128
+            addr = parts[0]
+            cidr = 128
+        try:
+            chunk = socket.inet_pton(socket.AF_INET6, addr)
+        except: raise ValueError
+        low, mid, high = _IPv6Struct.unpack(chunk)
+        cidr = int(cidr)
+        if cidr < 0 or cidr > 128: raise ValueError
+        mask = (1 << (128 - cidr)) - 1
+        whole = ((low << 64) | (mid << 32) | high) & ~mask
+        low = whole >> 64
+        mid = (whole >> 32) & 0xffffffff
+        high = whole & 0xffffffff
+        return (socket.AF_INET6, low, mid, high, cidr)
+
+
+def _StoredFamily(low64, mid32, high32, cidr):
+    '''
+    Works out the address family of a ban in the IPBanRecord storage format.
+    
+    IPv4 bans are stored with Low64 and Mid32 set to None.  Older versions
+    stored zeros there instead, which looks just like an IPv6 ban inside
+    ::/64; such rows are taken as IPv4 only when they can't be a valid IPv6
+    ban (a prefix of 32 bits or less, but with bits set past it).
+    
+    @return: socket.AF_INET or socket.AF_INET6.
+    '''
+    if low64 is None:
+        return socket.AF_INET
+    if low64 or mid32 or cidr > 32 or not high32:
+        return socket.AF_INET6
+    return socket.AF_INET
+
+
 class IPBanRecord(Database.Base):
     '''
     Record for a single IP ban.
@@ -73,6 +151,17 @@ class IPBanRecord(Database.Base):
     Comment = Column(String(64))
     '''Optional comment explaining the reason for the ban.'''
     
+    ##
+    ## Address family
+    ##
+    
+    @property
+    def Family(self):
+        '''
+        Address family of the ban, either socket.AF_INET or socket.AF_INET6.
+        '''
+        return _StoredFamily(self.Low64, self.Mid32, self.High32, self.CIDR)
+    
     ##
     ## String conversion functions
     ##
@@ -82,7 +171,7 @@ class IPBanRecord(Database.Base):
         Returns the banned address in CIDR notation.
         '''
         # IPv4 or IPv6?
-        if self.Low64 != 0 or self.Mid32 != 0:
+        if self.Family == socket.AF_INET6:
             # IPv6
             packed = _IPv6Struct.pack(self.Low64, self.Mid32, self.High32)
             address = socket.inet_ntop(socket.AF_INET6, packed)
@@ -102,41 +191,14 @@ class IPBanRecord(Database.Base):
         
         @raise ValueError: Raised if an invalid address is supplied.
         '''
-        # IPv4 or IPv6?
-        if address.find(":") == -1:
-            # IPv4
-            parts = address.split("/")
-            if len(parts) > 2: raise ValueError
-            elif len(parts) == 2: addr, cidr = parts
-            else:
-                # no CIDR prefix specified, assuming /32
-                addr = parts[0]
-                cidr = 32
-            try:
-                self.High32 = _IPv4Struct.unpack(socket.inet_aton(addr))[0]
-            except: raise ValueError
-            self.Low64 = 0
-            self.Mid32 = 0
-            self.CIDR = int(cidr)
-                
-        else:
-            # IPv6
-            parts = address.split("/")
-            if len(parts) > 2: raise ValueError
-            elif len(parts) == 2: addr, cidr = parts
-            else:
-                # no CIDR prefix specified, assuming /128
-                addr = parts[0]
-                cidr = 128
-            try:
-                chunk = socket.inet_pton(socket.AF_INET6, addr)
-            except: raise ValueError
-            self.Low64, self.Mid32, self.High32 = _IPv6Struct.unpack(chunk)
-            self.CIDR = int(cidr)
+        family, low, mid, high, cidr = _ParseCIDR(address)
+        if family == socket.AF_INET:
+            low = mid = None
+        self.Low64, self.Mid32, self.High32, self.CIDR = low, mid, high, cidr
     
     def __repr__(self):
         return "<IPBanRecord (%s)>" % self.ToString()
-
+    
     ##
     ## Ban check methods
     ##
@@ -184,7 +246,7 @@ class IPBanRecord(Database.Base):
         @return: Boolean, True if the address matches this ban.
         '''
         # If this is an IPv6 address ban, automatically dematch.
-        if self.Low64 > 0 or self.Mid32 > 0: return False
+        if self.Family != socket.AF_INET: return False
         
         # Extract address information.
         addr = _IPv4Struct.unpack(packed)[0]
@@ -206,7 +268,7 @@ class IPBanRecord(Database.Base):
         @return: Boolean, True if the address matches this ban.
         '''
         # If this is an IPv4 address an, automatically dematch.
-        if self.Low64 == 0 and self.Mid32 == 0: return False
+        if self.Family != socket.AF_INET6: return False
         
         # Extract address information.
         low, mid, high = _IPv6Struct.unpack(packed)
@@ -238,53 +300,549 @@ class IPBanRecord(Database.Base):
         return high == self.High32 and mid == self.Mid32 and low == self.Low64
 
 
-def _IsBanned_IPv4(address):
+##
+## In-memory ban index
+##
+
+class _TrieNode(object):
+    '''
+    Node of a ban prefix trie.
     '''
-    Checks the database for a matching IPv4 ban record.
     
-    @type address: string
-    @param address: IPv4 address to check.
+    __slots__ = ('Prefix', 'Length', 'Children', 'Bans')
     
-    @return: Boolean.
+    def __init__(self, prefix, length):
+        self.Prefix = prefix
+        '''Network prefix, with all bits past Length cleared.'''
+        self.Length = length
+        '''Prefix length in bits.'''
+        self.Children = [None, None]
+        '''Subtrees for the next bit being 0 or 1.'''
+        self.Bans = None
+        '''Maps ban IDs on exactly this prefix to their expiry, or None.'''
+
+
+class PrefixTrie(object):
+    '''
+    Path-compressed binary (PATRICIA) trie of banned network prefixes.
+    
+    Addresses are handled as integers of a fixed bit width (32 for IPv4, 128
+    for IPv6).  A lookup walks at most one node per prefix bit, and usually
+    far fewer since chains of single-child nodes are collapsed.
+    '''
+    
+    def __init__(self, width):
+        '''
+        Creates an empty trie.
+        
+        @type width: integer
+        @param width: Address size in bits.
+        '''
+        self.Width = width
+        '''Address size in bits.'''
+        self.Root = _TrieNode(0, 0)
+        '''Root node, matching every address.'''
+        self._Masks = [((1 << n) - 1) << (width - n)
+                       for n in xrange(width + 1)]
+        '''Network masks, indexed by prefix length.'''
+    
+    def Insert(self, prefix, length, banid, expires):
+        '''
+        Adds a ban to the trie.
+        
+        @type prefix: integer
+        @param prefix: Banned network.  Host bits are ignored.
+        
+        @type length: integer
+        @param length: Prefix length in bits.
+        
+        @param banid: ID of the ban record.
+        
+        @type expires: datetime.datetime
+        @param expires: Time at which the ban expires, or None if permanent.
+        '''
+        masks = self._Masks
+        width = self.Width
+        prefix &= masks[length]
+        node = self.Root
+        while node.Length < length:
+            bit = (prefix >> (width - node.Length - 1)) & 1
+            child = node.Children[bit]
+            if child is None:
+                # Nothing down this way yet.
+                node.Children[bit] = child = _TrieNode(prefix, length)
+                node = child
+                break
+            clen = child.Length
+            diff = (child.Prefix ^ prefix) & masks[min(clen, length)]
+            if not diff:
+                common = min(clen, length)
+            else:
+                common = width - diff.bit_length()
+            if common == clen:
+                # The child covers this prefix; keep going.
+                node = child
+                continue
+            
+            # Split the edge to the child.
+            split = _TrieNode(prefix & masks[common], common)
+            split.Children[(child.Prefix >> (width - common - 1)) & 1] = child
+            node.Children[bit] = split
+            node = split
+        if node.Bans is None:
+            node.Bans = {}
+        node.Bans[banid] = expires
+    
+    def Remove(self, prefix, length, banid):
+        '''
+        Removes a ban from the trie.  Does nothing if it isn't there.
+        
+        @type prefix: integer
+        @param prefix: Banned network.
+        
+        @type length: integer
+        @param length: Prefix length in bits.
+        
+        @param banid: ID of the ban record.
+        '''
+        prefix &= self._Masks[length]
+        width = self.Width
+        path = []
+        node = self.Root
+        while node is not None and node.Length < length:
+            path.append(node)
+            node = node.Children[(prefix >> (width - node.Length - 1)) & 1]
+        if node is None or node.Prefix != prefix or node.Length != length:
+            return
+        if not node.Bans or banid not in node.Bans:
+            return
+        del node.Bans[banid]
+        if node.Bans:
+            return
+        node.Bans = None
+        
+        # Prune nodes which no longer do anything.
+        while path and node.Bans is None:
+            parent = path.pop()
+            slot = parent.Children.index(node)
+            children = [c for c in node.Children if c is not None]
+            if len(children) > 1:
+                break
+            parent.Children[slot] = children[0] if children else None
+            node = parent
+    
+    def Build(self, entries):
+        '''
+        Replaces the contents of the trie with a list of bans.
+        
+        This is much faster than inserting the bans one at a time.  The
+        entries are sorted so that the trie can be built in a single pass
+        from left to right, keeping only the current rightmost path.
+        
+        @type entries: list
+        @param entries: List of (prefix, length, banid, expires) tuples, as
+        would be passed to Insert().
+        '''
+        masks = self._Masks
+        width = self.Width
+        entries = [(prefix & masks[length], length, banid, expires)
+                   for prefix, length, banid, expires in entries]
+        entries.sort()
+        self.Root = root = _TrieNode(0, 0)
+        stack = [root]
+        for prefix, length, banid, expires in entries:
+            # Climb back up to the closest node covering this prefix.
+            while True:
+                top = stack[-1]
+                if top.Length <= length:
+                    if prefix & masks[top.Length] == top.Prefix:
+                        break
+                stack.pop()
+            
+            if top.Length == length:
+                # Same prefix as an existing node.
+                node = top
+            else:
+                bit = (prefix >> (width - top.Length - 1)) & 1
+                child = top.Children[bit]
+                node = _TrieNode(prefix, length)
+                if child is None:
+                    top.Children[bit] = node
+                else:
+                    # Sorting guarantees the child doesn't overlap this
+                    # prefix, so they just need a common parent.
+                    diff = (child.Prefix ^ prefix)
+                    common = width - diff.bit_length()
+                    split = _TrieNode(prefix & masks[common], common)
+                    cbit = (child.Prefix >> (width - common - 1)) & 1
+                    split.Children[cbit] = child
+                    split.Children[1 - cbit] = node
+                    top.Children[bit] = split
+                    stack.append(split)
+                stack.append(node)
+            if node.Bans is None:
+                node.Bans = {}
+            node.Bans[banid] = expires
+    
+    def Match(self, address, now):
+        '''
+        Checks whether an address is covered by an unexpired ban.
+        
+        @type address: integer
+        @param address: Address to check.
+        
+        @type now: datetime.datetime
+        @param now: Current time.
+        
+        @return: Boolean.
+        '''
+        masks = self._Masks
+        width = self.Width
+        node = self.Root
+        while node is not None:
+            length = node.Length
+            if address & masks[length] != node.Prefix:
+                return False
+            if node.Bans:
+                for expires in node.Bans.itervalues():
+                    if expires is None or now < expires:
+                        return True
+            if length == width:
+                return False
+            node = node.Children[(address >> (width - length - 1)) & 1]
+        return False
+
+
+class BanIndex(object):
+    '''
+    In-memory index of every IP ban, for checking addresses without
+    touching the database.
+    
+    The index is built from the database at startup.  Bans added or removed
+    through this module update it as well; expired bans are swept out of it
+    as they are noticed.
+    '''
+    
+    def __init__(self):
+        self.IPv4 = PrefixTrie(32)
+        '''Trie of IPv4 bans.'''
+        self.IPv6 = PrefixTrie(128)
+        '''Trie of IPv6 bans.'''
+        self._Bans = {}
+        '''Maps ban IDs to (trie, prefix, length, expiry).'''
+        self._Expiry = []
+        '''Heap of (expires, ban ID) for temporary bans.'''
+    
+    def __len__(self):
+        return len(self._Bans)
+    
+    def _Entry(self, family, low64, mid32, high32, cidr):
+        '''
+        Converts the storage format of IPBanRecord to (trie, prefix, length).
+        
+        @raise ValueError: Raised if the ban can't be indexed.
+        '''
+        if family == socket.AF_INET6:
+            trie = self.IPv6
+            prefix = (low64 << 64) | (mid32 << 32) | high32
+        elif family == socket.AF_INET:
+            trie = self.IPv4
+            prefix = high32
+        else:
+            raise ValueError("unknown address family")
+        if cidr is None or cidr < 0 or cidr > trie.Width:
+            raise ValueError("invalid prefix length")
+        return (trie, prefix, cidr)
+    
+    def Add(self, banid, family, low64, mid32, high32, cidr, permanent,
+            expires):
+        '''
+        Adds a ban to the index, in the storage format of IPBanRecord.
+        
+        @raise ValueError: Raised if the ban can't be indexed.
+        '''
+        trie, prefix, cidr = self._Entry(family, low64, mid32, high32, cidr)
+        if permanent:
+            expires = None
+        if banid in self._Bans:
+            self.Remove(banid)
+        trie.Insert(prefix, cidr, banid, expires)
+        self._Bans[banid] = (trie, prefix, cidr, expires)
+        if expires is not None:
+            heapq.heappush(self._Expiry, (expires, banid))
+    
+    def Build(self, rows):
+        '''
+        Replaces the contents of the index with a list of bans.
+        
+        Bans which can't be indexed are logged and left out.
+        
+        @type rows: iterable
+        @param rows: (banid, family, low64, mid32, high32, cidr, permanent,
+        expires) tuples, in the storage format of IPBanRecord.
+        '''
+        self.Clear()
+        entries = {self.IPv4: [], self.IPv6: []}
+        for row in rows:
+            banid, family, low64, mid32, high32, cidr, permanent, expires = row
+            try:
+                trie, prefix, cidr = self._Entry(family, low64, mid32, high32,
+                                                 cidr)
+            except ValueError as err:
+                msg = "Skipping IP ban %s: %s." % (banid, err)
+                mainlog.error(msg)
+                continue
+            if permanent:
+                expires = None
+            else:
+                self._Expiry.append((expires, banid))
+            entries[trie].append((prefix, cidr, banid, expires))
+            self._Bans[banid] = (trie, prefix, cidr, expires)
+        heapq.heapify(self._Expiry)
+        
+        # Building creates a great many nodes at once, which sets off the
+        # cyclic garbage collector over and over for no benefit.
+        gcenabled = gc.isenabled()
+        gc.disable()
+        try:
+            for trie, items in entries.iteritems():
+                trie.Build(items)
+        finally:
+            if gcenabled:
+                gc.enable()
+    
+    def AddRecord(self, record):
+        '''
+        Adds an IPBanRecord to the index.
+        '''
+        self.Add(record.id, record.Family, record.Low64 or 0,
+                 record.Mid32 or 0, record.High32 or 0, record.CIDR,
+                 record.Permanent, record.Expires)
+    
+    def Remove(self, banid):
+        '''
+        Removes a ban from the index.  Does nothing if it isn't there.
+        '''
+        try:
+            trie, prefix, cidr, expires = self._Bans.pop(banid)
+        except KeyError:
+            return
+        trie.Remove(prefix, cidr, banid)
+    
+    def Clear(self):
+        '''
+        Removes every ban from the index.
+        '''
+        self.__init__()
+    
+    def Sweep(self, now=None):
+        '''
+        Removes expired bans from the index.
+        
+        @type now: datetime.datetime
+        @param now: Current time.  Defaults to now.
+        
+        @return: Number of bans removed.
+        '''
+        if now is None:
+            now = datetime.datetime.now()
+        count = 0
+        heap = self._Expiry
+        while heap and heap[0][0] <= now:
+            expires, banid = heapq.heappop(heap)
+            entry = self._Bans.get(banid)
+            if entry is None:
+                continue
+            if entry[3] != expires:
+                # The ban was replaced since this entry was queued.
+                continue
+            self.Remove(banid)
+            count += 1
+        return count
+    
+    def IsBanned(self, address, now=None):
+        '''
+        Checks an address against the index.
+        
+        @type address: string
+        @param address: Address to check (either IPv4 or IPv6).
+        
+        @type now: datetime.datetime
+        @param now: Current time.  Defaults to now.
+        
+        @raise ValueError: Raised if an invalid address is supplied.
+        
+        @return: Boolean.
+        '''
+        if now is None:
+            now = datetime.datetime.now()
+        if address.find(":") == -1:
+            # IPv4
+            try:
+                packed = socket.inet_aton(address)
+            except: raise ValueError
+            return self.IPv4.Match(_IPv4Struct.unpack(packed)[0], now)
+        else:
+            # IPv6
+            try:
+                packed = socket.inet_pton(socket.AF_INET6, address)
+            except: raise ValueError
+            first, mid, last = _IPv6Struct.unpack(packed)
+            return self.IPv6.Match((first << 64) | (mid << 32) | last, now)
+
+
+Index = BanIndex()
+'''Shared ban index.'''
+
+
+def LoadBans(session=None):
     '''
-    # Query.
-    session = Database.MainSession
-    query = session.query(IPBanRecord).filter(IPBanRecord.Low64 == 0).all()
-    for record in query:
-        if record.MatchString(address): return True
-    return False
+    Rebuilds the ban index from the database.
+    
+    Bans which can't be indexed are logged and left out, rather than keeping
+    the server from starting.
+    
+    @type session: sqlalchemy.orm.Session
+    @param session: Session to query with.  Defaults to the main session.
+    
+    @return: Number of bans loaded.
+    '''
+    if session is None:
+        session = Database.MainSession
+    
+    # Just fetch the columns; building full records is much slower.
+    query = session.query(IPBanRecord.id, IPBanRecord.Low64,
+                          IPBanRecord.Mid32, IPBanRecord.High32,
+                          IPBanRecord.CIDR, IPBanRecord.Permanent,
+                          IPBanRecord.Expires)
+    now = datetime.datetime.now()
+    rows = []
+    for banid, low, mid, high, cidr, permanent, expires in query:
+        if not permanent and (expires is None or expires <= now):
+            # Already expired.
+            continue
+        family = _StoredFamily(low, mid, high, cidr)
+        rows.append((banid, family, low or 0, mid or 0, high or 0, cidr,
+                     permanent, expires))
+    index = BanIndex()
+    index.Build(rows)
+    
+    # Swap it in all at once.
+    global Index
+    Index = index
+    return len(index)
 
 
-def _IsBanned_IPv6(address):
+def AddBan(address, expires=None, comment=u"", session=None):
     '''
-    Checks the database for a matching IPv6 ban record.
+    Bans an address or range of addresses.
     
     @type address: string
-    @param address: IPv6 address to check.
+    @param address: Address to ban, in CIDR notation.
     
-    @return: Boolean.
+    @type expires: datetime.datetime
+    @param expires: Time at which the ban expires, or None for a permanent
+    ban.
+    
+    @type comment: unicode
+    @param comment: Optional comment explaining the ban.
+    
+    @type session: sqlalchemy.orm.Session
+    @param session: Session to save with.  Defaults to the main session.
+    
+    @raise ValueError: Raised if an invalid address is supplied.
+    
+    @return: The new IPBanRecord.
     '''
-    # Query.
-    session = Database.MainSession
-    query = session.query(IPBanRecord).filter(IPBanRecord.Low64 != 0).all()
-    for record in query:
-        if record.MatchString(address): return True
-    return False
+    if session is None:
+        session = Database.MainSession
+    record = IPBanRecord()
+    record.FromString(address)
+    record.Created = datetime.datetime.now()
+    record.Permanent = expires is None
+    record.Expires = expires
+    record.Comment = comment
+    session.add(record)
+    session.commit()
+    Index.AddRecord(record)
+    return record
+
+
+def RemoveBan(record, session=None):
+    '''
+    Lifts a ban.
+    
+    @type record: IPBanRecord
+    @param record: Ban to lift.
+    
+    @type session: sqlalchemy.orm.Session
+    @param session: Session to save with.  Defaults to the main session.
+    '''
+    if session is None:
+        session = Database.MainSession
+    banid = record.id
+    session.delete(session.merge(record))
+    session.commit()
+    Index.Remove(banid)
+
+
+def ImportBans(addresses, expires=None, comment=u"", session=None):
+    '''
+    Bans a large list of addresses at once, such as a published blocklist.
+    
+    The records are inserted with a single bulk statement and the index is
+    rebuilt afterwards.
+    
+    @type addresses: iterable of strings
+    @param addresses: Addresses to ban, in CIDR notation.  Blank lines and
+    anything after a "#" are ignored.
+    
+    @type expires: datetime.datetime
+    @param expires: Time at which the bans expire, or None for permanent
+    bans.
+    
+    @type comment: unicode
+    @param comment: Optional comment explaining the bans.
+    
+    @type session: sqlalchemy.orm.Session
+    @param session: Session to save with.  Defaults to the main session.
+    
+    @raise ValueError: Raised if an invalid address is supplied.  Nothing is
+    imported in that case.
+    
+    @return: Number of bans imported.
+    '''
+    if session is None:
+        session = Database.MainSession
+    now = datetime.datetime.now()
+    rows = []
+    for line in addresses:
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            continue
+        family, low, mid, high, cidr = _ParseCIDR(line)
+        if family == socket.AF_INET:
+            low = mid = None
+        rows.append({'Low64': low, 'Mid32': mid, 'High32': high,
+                     'CIDR': cidr,
+                     'Created': now, 'Permanent': expires is None,
+                     'Expires': expires, 'Comment': comment})
+    if rows:
+        session.execute(IPBanRecord.__table__.insert(), rows)
+        session.commit()
+        LoadBans(session)
+    return len(rows)
 
 
 def IsBanned(address):
     '''
-    Convenience function that checks the database for any matching ban records.
+    Convenience function that checks the ban index for a matching ban.
     
     @type address: string
     @param address: Address to check (either IPv4 or IPv6)
     
     @return: Boolean.
     '''
-    # IPv4 or IPv6?
-    if address.find(":") == -1:
-        # IPv4
-        return _IsBanned_IPv4(address)
-    else:
-        # IPv6
-        return _IsBanned_IPv6(address)
+    Index.Sweep()
+    # Link-local IPv6 addresses may carry a zone index ("fe80::1%eth0").
+    return Index.IsBanned(address.split("%", 1)[0])
@@ -0,0 +1,460 @@
+# -*- coding: utf-8 -*-
+
+# xVector Engine Server
+# Copyright (c) 2012 James Buchwald
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+'''
+Area of interest management for game objects.
+
+Players are only told about the objects near them.  Every object in the game
+(characters, NPCs, items on the ground) is kept in a spatial hash of the map
+it is on: the map is divided into square cells, each holding the set of
+objects inside it, so finding the objects near a point only looks at the few
+cells around it.  The cost of anything done here depends on how crowded the
+area around an object is, not on how many objects are on the map.
+
+A player sees everything within their view radius (Game/Interest/ViewRadius
+tiles in every direction), their own character included.  The manager keeps
+track of who sees what in two sets:
+
+  - GameObject.Visible: the objects a player can see.
+  - GameObject.Observers: the players who can see an object.
+
+When an object is added, moves or is removed, both sets are brought up to
+date and the players concerned are sent the difference: AddObject to those
+who can now see the object and DeleteObject to those who no longer can.
+Players who can still see it get the change in the next round of updates
+(see the Replication module).  Changes which don't move an object go
+straight to its observers without looking at the map at all.
+'''
+
+import itertools
+from xVLib import Packets
+from . import Metrics, Replication
+
+
+class GameObject(object):
+    '''
+    An object in the game world.
+    
+    Objects controlled by a player have a connection; only they see other
+    objects.  Change the position of an object through the manager (see
+    InterestManager.Move()), never directly.
+    '''
+    
+    __slots__ = ('ObjectID', 'ObjectType', 'Name', 'Sprite', 'Map', 'X', 'Y',
+                 'Direction', 'Connection', 'ViewRadius', 'Cell', 'Visible',
+                 'Observers')
+    
+    def __init__(self, objtype, name=u"", sprite=0, connection=None):
+        '''
+        Creates an object which isn't in the game yet.
+        
+        @type objtype: integer
+        @param objtype: Type of the object (one of the Type_ constants of
+        Packets.AddObjectPacket).
+        
+        @type name: unicode
+        @param name: Name shown for the object.
+        
+        @type sprite: integer
+        @param sprite: ID of the object's sprite.
+        
+        @type connection: ServerNetworking.ServerConnection
+        @param connection: Connection of the player controlling the object,
+        or None.
+        '''
+        self.ObjectID = 0
+        '''Server-assigned ID, set when the object enters the game.'''
+        self.ObjectType = objtype
+        '''Type of the object.'''
+        self.Name = name
+        '''Name shown for the object.'''
+        self.Sprite = sprite
+        '''ID of the object's sprite.'''
+        self.Map = None
+        '''Name of the map the object is on, or None if not in the game.'''
+        self.X = 0
+        '''Horizontal tile coordinate of the object.'''
+        self.Y = 0
+        '''Vertical tile coordinate of the object.'''
+        self.Direction = 0
+        '''Direction faced (0 = north, 1 = east, 2 = south, 3 = west).'''
+        self.Connection = connection
+        '''Connection of the player controlling the object, or None.'''
+        self.ViewRadius = 0
+        '''Distance in tiles at which the object sees other objects.'''
+        self.Cell = None
+        '''Key of the spatial hash cell the object is in.'''
+        self.Visible = set()
+        '''Objects this object can see.'''
+        self.Observers = set()
+        '''Objects (controlled by players) which can see this object.'''
+    
+    def Sees(self, other):
+        '''
+        Checks whether another object on the same map is in view.
+        '''
+        radius = self.ViewRadius
+        return (abs(other.X - self.X) <= radius
+                and abs(other.Y - self.Y) <= radius)
+
+
+class SpatialHash(object):
+    '''
+    Uniform grid of cells holding the objects on a map.
+    
+    Cells are only created while there are objects in them, so the size of
+    the hash depends on the number of objects, not the size of the map.
+    '''
+    
+    def __init__(self, cellsize):
+        '''
+        Creates an empty spatial hash.
+        
+        @type cellsize: integer
+        @param cellsize: Width and height of a cell, in tiles.
+        '''
+        self.CellSize = cellsize
+        '''Width and height of a cell, in tiles.'''
+        self.Cells = {}
+        '''Maps (column, row) cell keys to sets of objects.'''
+    
+    def CellOf(self, x, y):
+        '''
+        Gets the key of the cell containing a tile.
+        '''
+        return (x // self.CellSize, y // self.CellSize)
+    
+    def Insert(self, obj, cell):
+        '''
+        Adds an object to a cell.
+        '''
+        try:
+            self.Cells[cell].add(obj)
+        except KeyError:
+            self.Cells[cell] = set((obj,))
+    
+    def Remove(self, obj, cell):
+        '''
+        Removes an object from a cell, dropping the cell if it is now empty.
+        '''
+        objects = self.Cells[cell]
+        objects.discard(obj)
+        if not objects:
+            del self.Cells[cell]
+    
+    def Query(self, x, y, radius):
+        '''
+        Finds the objects within a square around a tile.
+        
+        @type radius: integer
+        @param radius: Greatest distance in tiles along either axis.
+        
+        @return: List of the objects found.
+        '''
+        size = self.CellSize
+        cells = self.Cells
+        found = []
+        for column in xrange((x - radius) // size, (x + radius) // size + 1):
+            for row in xrange((y - radius) // size,
+                              (y + radius) // size + 1):
+                try:
+                    objects = cells[(column, row)]
+                except KeyError:
+                    continue
+                for obj in objects:
+                    if abs(obj.X - x) <= radius and abs(obj.Y - y) <= radius:
+                        found.append(obj)
+        return found
+
+
+class MapSpace(object):
+    '''
+    Spatial hashes of the objects on a single map.
+    '''
+    
+    def __init__(self, cellsize):
+        self.Objects = SpatialHash(cellsize)
+        '''Every object on the map.'''
+        self.Players = SpatialHash(cellsize)
+        '''Objects on the map which see other objects.'''
+
+
+class InterestManager(object):
+    '''
+    Keeps track of which players can see which objects, and tells them
+    when that changes.
+    '''
+    
+    def __init__(self):
+        '''
+        Creates an empty manager with the default settings.
+        '''
+        # Declare settings.
+        self.ViewRadius = 12
+        '''View radius given to players entering the game, in tiles.'''
+        self.CellSize = 16
+        '''Size of the cells of new spatial hashes, in tiles.'''
+        
+        # Declare state.
+        self.Maps = {}
+        '''Maps map names to the MapSpace of each map with objects on it.'''
+        self.Objects = {}
+        '''Maps object IDs to every object in the game.'''
+        self.MaxViewRadius = 0
+        '''Largest view radius of any player who has entered the game.'''
+        self._IDs = itertools.count(1)
+        '''Source of object IDs.'''
+        self.Replicator = Replication.Replicator()
+        '''Sends players what they can see.'''
+    
+    def Configure(self, config):
+        '''
+        Applies the area of interest settings from the configuration file.
+        
+        A new view radius applies to players entering the game from then on;
+        a new cell size applies to maps which have no objects on them.
+        
+        @type config: xVLib.ConfigurationFile.ConfigurationFile
+        @param config: Handle to the main configuration file object.
+        '''
+        self.ViewRadius = max(1, config['Game/Interest/ViewRadius'])
+        self.CellSize = max(1, config['Game/Interest/CellSize'])
+        self.Replicator.Configure(config)
+    
+    ##
+    ## Placing objects
+    ##
+    
+    def Add(self, obj, mapname, x, y):
+        '''
+        Puts an object into the game, telling the players who can see it.
+        
+        If the object is controlled by a player, the player is told about
+        their own character first, then everything around it.
+        
+        @type obj: GameObject
+        @param obj: Object which isn't in the game yet.
+        
+        @type mapname: string
+        @param mapname: Name of the map to put the object on.
+        
+        @type x: integer
+        @param x: Horizontal tile coordinate.
+        
+        @type y: integer
+        @param y: Vertical tile coordinate.
+        '''
+        obj.ObjectID = next(self._IDs)
+        self.Objects[obj.ObjectID] = obj
+        if obj.Connection is not None:
+            if not obj.ViewRadius:
+                obj.ViewRadius = self.ViewRadius
+            self.MaxViewRadius = max(self.MaxViewRadius, obj.ViewRadius)
+        self._Place(obj, mapname, x, y)
+    
+    def Remove(self, obj):
+        '''
+        Takes an object out of the game, telling the players who could see
+        it.  The object's own player isn't told anything.
+        
+        @type obj: GameObject
+        @param obj: Object in the game.
+        '''
+        self._Unplace(obj, False)
+        del self.Objects[obj.ObjectID]
+        if obj.Connection is not None:
+            self.Replicator.Forget(obj)
+    
+    def Move(self, obj, x, y, mapname=None):
+        '''
+        Moves an object, telling the players who see it come, go or move.
+        
+        @type obj: GameObject
+        @param obj: Object in the game.
+        
+        @type x: integer
+        @param x: New horizontal tile coordinate.
+        
+        @type y: integer
+        @param y: New vertical tile coordinate.
+        
+        @type mapname: string
+        @param mapname: Name of the map to move the object to, or None to
+        stay on the same map.
+        '''
+        if mapname is not None and mapname != obj.Map:
+            # Leave the old map behind entirely.
+            self._Unplace(obj, True)
+            self._Place(obj, mapname, x, y)
+            return
+        
+        space = self.Maps[obj.Map]
+        obj.X = x
+        obj.Y = y
+        cell = space.Objects.CellOf(x, y)
+        if cell != obj.Cell:
+            space.Objects.Remove(obj, obj.Cell)
+            space.Objects.Insert(obj, cell)
+            if obj.Connection is not None:
+                space.Players.Remove(obj, obj.Cell)
+                space.Players.Insert(obj, cell)
+            obj.Cell = cell
+        self._Refresh(space, obj, True)
+    
+    def Update(self, obj):
+        '''
+        Marks an object as having turned or changed its appearance.  The
+        players who can see it are told with the next round of updates.
+        
+        @type obj: GameObject
+        @param obj: Object in the game.
+        '''
+        self.Replicator.MarkChanged(obj)
+    
+    def _Place(self, obj, mapname, x, y):
+        '''
+        Puts an object on a map and works out who sees what.
+        '''
+        try:
+            space = self.Maps[mapname]
+        except KeyError:
+            space = MapSpace(self.CellSize)
+            self.Maps[mapname] = space
+        obj.Map = mapname
+        obj.X = x
+        obj.Y = y
+        obj.Cell = space.Objects.CellOf(x, y)
+        space.Objects.Insert(obj, obj.Cell)
+        if obj.Connection is not None:
+            space.Players.Insert(obj, obj.Cell)
+        self._Refresh(space, obj, False)
+    
+    def _Unplace(self, obj, notify):
+        '''
+        Takes an object off its map.
+        
+        @type notify: bool
+        @param notify: If True, the object's own player is told to forget
+        everything they could see, their own character included.
+        '''
+        for player in obj.Observers:
+            if player is not obj:
+                player.Visible.discard(obj)
+                self.Replicator.Delete(player, obj)
+        for other in obj.Visible:
+            other.Observers.discard(obj)
+            if notify:
+                self.Replicator.Delete(obj, other)
+        obj.Observers = set()
+        obj.Visible = set()
+        
+        space = self.Maps[obj.Map]
+        space.Objects.Remove(obj, obj.Cell)
+        if obj.Connection is not None:
+            space.Players.Remove(obj, obj.Cell)
+        if not space.Objects.Cells:
+            del self.Maps[obj.Map]
+        obj.Map = None
+        obj.Cell = None
+    
+    def _Refresh(self, space, obj, moved):
+        '''
+        Works out who can see an object and what it can see after it has
+        been placed or moved, and sends out the differences.
+        
+        @type moved: bool
+        @param moved: If True, players who could already see the object are
+        sent an update with the next round.
+        '''
+        # Who can see the object now?
+        observers = set(player for player in
+                        space.Players.Query(obj.X, obj.Y, self.MaxViewRadius)
+                        if player.Sees(obj))
+        old = obj.Observers
+        replicator = self.Replicator
+        for player in observers - old:
+            player.Visible.add(obj)
+            replicator.Add(player, obj)
+        for player in old - observers:
+            player.Visible.discard(obj)
+            replicator.Delete(player, obj)
+        if moved:
+            replicator.MarkChanged(obj)
+        obj.Observers = observers
+        
+        # What can the object see now?  (It has already been told about
+        # itself, so it isn't new here.)
+        if obj.Connection is None:
+            return
+        visible = set(space.Objects.Query(obj.X, obj.Y, obj.ViewRadius))
+        old = obj.Visible
+        for other in visible - old:
+            other.Observers.add(obj)
+            replicator.Add(obj, other)
+        for other in old - visible:
+            other.Observers.discard(obj)
+            replicator.Delete(obj, other)
+        obj.Visible = visible
+
+
+Manager = InterestManager()
+'''Shared area of interest manager.'''
+
+
+def InitInterest(config):
+    '''
+    Applies the area of interest settings from the configuration file.
+    
+    @type config: xVLib.ConfigurationFile.ConfigurationFile
+    @param config: Handle to the main configuration file object.
+    '''
+    Manager.Configure(config)
+
+
+def Tick():
+    '''
+    Sends out a round of object updates if it's time.  Called once per main
+    loop cycle.
+    '''
+    Manager.Replicator.Tick()
+
+
+TypeNames = {
+    Packets.AddObjectPacket.Type_Player: "player",
+    Packets.AddObjectPacket.Type_NPC: "npc",
+    Packets.AddObjectPacket.Type_Item: "item",
+}
+'''Maps object types to the names used in the metrics.'''
+
+
+def CountObjects():
+    '''
+    Counts the objects in the game of each type.
+    
+    @return: Dict mapping 1-tuples of type names to object counts.
+    '''
+    counts = dict(((name,), 0) for name in TypeNames.itervalues())
+    for obj in Manager.Objects.itervalues():
+        counts[(TypeNames[obj.ObjectType],)] += 1
+    return counts
+
+
+Metrics.Registry.GaugeFunction("xvector_game_objects",
+                               "Objects in the game world, by type.",
+                               CountObjects, ("type",))
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+
+# xVector Engine Server
+# Copyright (c) 2012 James Buchwald
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+'''
+Non-blocking logging.
+
+Log records are put on a bounded queue by a QueueHandler and written out by
+a QueueListener running on a background thread, so the main loop never waits
+on disk I/O (or log rotation) to log something.  The listener writes records
+in batches and flushes the files once per batch.
+
+If the writer falls so far behind that the queue fills up, new records are
+dropped rather than stalling the game; the listener logs how many were lost
+once it catches up.
+'''
+
+import logging
+import threading
+import Queue
+from logging import handlers
+
+
+class QueueHandler(logging.Handler):
+    '''
+    Log handler which puts records on a queue for a QueueListener.
+    '''
+    
+    def __init__(self, queue):
+        '''
+        Creates a handler feeding the given queue.
+        
+        @type queue: Queue.Queue
+        @param queue: Bounded queue shared with the QueueListener.
+        '''
+        # Inherit base class behavior.
+        logging.Handler.__init__(self)
+        
+        # Declare attributes.
+        self.Queue = queue
+        '''Queue that records are put on.'''
+        self.Dropped = 0
+        '''Number of records dropped because the queue was full.'''
+    
+    def Prepare(self, record):
+        '''
+        Makes a record safe to hand to another thread.
+        
+        The message is merged with its arguments and any traceback is
+        formatted now, since the objects they refer to may have changed by
+        the time the listener gets to the record.
+        '''
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(
+                        record.exc_info)
+            record.exc_info = None
+        return record
+    
+    def emit(self, record):
+        '''
+        Queues a record without blocking.
+        '''
+        try:
+            self.Queue.put_nowait(self.Prepare(record))
+        except Queue.Full:
+            self.Dropped += 1
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(threading.Thread):
+    '''
+    Background thread which writes out queued log records.
+    '''
+    
+    BatchSize = 256
+    '''Maximum number of records written between flushes.'''
+    
+    def __init__(self, queue, handler):
+        '''
+        Creates a listener.  Call start() to run it.
+        
+        @type queue: Queue.Queue
+        @param queue: Queue shared with the QueueHandler.
+        
+        @type handler: QueueHandler
+        @param handler: Handler feeding the queue, for its drop counter.
+        '''
+        # Inherit base class behavior.
+        threading.Thread.__init__(self, name="LogWriter")
+        self.daemon = True
+        
+        # Declare attributes.
+        self.Queue = queue
+        '''Queue of records to write.'''
+        self.Source = handler
+        '''Handler feeding the queue.'''
+        self.Handlers = []
+        '''Handlers which actually write the records.'''
+        self._Reported = 0
+        '''Number of dropped records already reported.'''
+    
+    def Stop(self):
+        '''
+        Writes out everything still queued, then stops the thread.
+        '''
+        self.Queue.put(None)
+        self.join()
+    
+    def run(self):
+        '''
+        Main loop of the writer thread.
+        '''
+        while 1:
+            # Wait for something to write, then take as much as we can.
+            batch = [self.Queue.get()]
+            try:
+                while len(batch) < self.BatchSize:
+                    batch.append(self.Queue.get_nowait())
+            except Queue.Empty:
+                pass
+            
+            # Write the batch.
+            stop = False
+            for record in batch:
+                if record is None:
+                    stop = True
+                    continue
+                self._Dispatch(record)
+            self._ReportDrops()
+            for handler in self.Handlers:
+                handler.ForceFlush()
+            if stop:
+                break
+    
+    def _Dispatch(self, record):
+        '''
+        Passes a record to each handler that wants it.
+        '''
+        for handler in self.Handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+    
+    def _ReportDrops(self):
+        '''
+        Logs a warning if any records have been dropped since last time.
+        '''
+        dropped = self.Source.Dropped
+        if dropped == self._Reported:
+            return
+        msg = "Log queue overflowed; %i messages were dropped."
+        record = logging.LogRecord("Server.Main", logging.WARNING, __file__,
+                                   0, msg, (dropped - self._Reported,), None)
+        self._Reported = dropped
+        self._Dispatch(record)
+
+
+class BufferedRotatingFileHandler(handlers.RotatingFileHandler):
+    '''
+    Rotating file handler which only flushes when told to.
+    
+    The QueueListener flushes it once per batch of records instead of after
+    every record.
+    '''
+    
+    def flush(self):
+        '''
+        Does nothing; see ForceFlush().
+        '''
+        pass
+    
+    def ForceFlush(self):
+        '''
+        Flushes the file.
+        '''
+        handlers.RotatingFileHandler.flush(self)
+
+
+Handler = None
+'''QueueHandler attached to the server's loggers, once logging is started.'''
+
+Listener = None
+'''QueueListener writing the server's logs, once logging is started.'''
+
+
+def StartLogging(filehandlers, queuesize):
+    '''
+    Starts the writer thread and creates the handler that feeds it.
+    
+    @type filehandlers: list of BufferedRotatingFileHandler
+    @param filehandlers: Handlers to write records to.  Each should have
+    whatever filters it needs to pick out its own records.
+    
+    @type queuesize: integer
+    @param queuesize: Maximum number of records waiting to be written.
+    
+    @return: The QueueHandler to attach to the loggers.
+    '''
+    global Handler, Listener
+    queue = Queue.Queue(queuesize)
+    Handler = QueueHandler(queue)
+    Listener = QueueListener(queue, Handler)
+    Listener.Handlers.extend(filehandlers)
+    Listener.start()
+    return Handler
+
+
+def StopLogging():
+    '''
+    Writes out any queued records and stops the writer thread.
+    
+    Safe to call more than once.
+    '''
+    global Listener
+    if Listener is None:
+        return
+    listener = Listener
+    Listener = None
+    listener.Stop()
+    for handler in listener.Handlers:
+        handler.close()
+
+
+def DroppedCount():
+    '''
+    Gets the number of log records dropped so far.
+    '''
+    if Handler is None:
+        return 0
+    return Handler.Dropped
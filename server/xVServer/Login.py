@@ -20,12 +20,20 @@ Login processing with network code to support it.
 '''
 
 import time
+import datetime
 import os
 import base64
+import hashlib
+import hmac
+import logging
+import functools
+from collections import deque
 from xVLib import Packets
-from . import ServerPacketRouter, Database, Accounts
+from . import ServerGlobals, ServerPacketRouter, Database, Accounts
 from .Accounts import Account
 
+mainlog = logging.getLogger("Server.Main")
+
 
 ##
 ## A few constants...
@@ -45,11 +53,31 @@ LoginDelay = 5
 class LoginToken(object):
     '''
     A login token for authentication.
+    
+    A token is issued to a connection after it logs in.  Once that connection
+    closes, the token can be used for TOKEN_VALID_LENGTH seconds; this lets a
+    client that loses its connection log straight back in without repeating
+    the challenge-response login.
+    
+    Tokens are sent in the clear, so they are kept on a short leash: a token
+    can only be used once, never while its account is still connected, and
+    never more than TOKEN_MAX_AGE seconds after it was issued.  Connections
+    which stay open are sent a fresh token every TOKEN_REFRESH_INTERVAL
+    seconds (see RefreshTokens()).
     '''
     
+    __slots__ = ('Value', 'IssuedAt', 'ReleasedAt', 'Account',
+                 'CharacterName')
+    
     TOKEN_VALID_LENGTH = 30.0
     '''Length of time the token is valid for, in seconds.'''
     
+    TOKEN_MAX_AGE = 600.0
+    '''Length of time after issue at which the token expires regardless.'''
+    
+    TOKEN_REFRESH_INTERVAL = 300.0
+    '''Age at which an open connection is sent a fresh token.'''
+    
     def __init__(self):
         '''
         Creates a new login token with a random value.
@@ -59,6 +87,20 @@ class LoginToken(object):
         '''Identifier value of the login token (32 characters)'''
         self.IssuedAt = time.time()
         '''Time at which the login token was issued.'''
+        self.ReleasedAt = None
+        '''Time at which the issuing connection closed, or None if open.'''
+        
+        # Declare the session state restored by the token.
+        self.Account = None
+        '''Account that the token logs into.'''
+        self.CharacterName = None
+        '''Character that the token restores.  (Not yet implemented.)'''
+    
+    def Release(self):
+        '''
+        Starts the expiration clock when the issuing connection closes.
+        '''
+        self.ReleasedAt = time.time()
     
     def IsValid(self):
         '''
@@ -66,7 +108,244 @@ class LoginToken(object):
         
         @return: True if the token is valid, False if it has expired.
         '''
-        return (time.time() - self.IssuedAt < self.TOKEN_VALID_LENGTH)
+        now = time.time()
+        if now - self.IssuedAt >= self.TOKEN_MAX_AGE:
+            return False
+        if self.ReleasedAt is None:
+            return True
+        return (now - self.ReleasedAt < self.TOKEN_VALID_LENGTH)
+
+
+_Tokens = {}
+'''Maps token values to their outstanding LoginToken objects.'''
+
+_ReleasedTokens = deque()
+'''Released tokens, oldest first, waiting to expire.'''
+
+_NextRefresh = 0
+'''Time at which RefreshTokens() is next run by Tick().'''
+
+
+def _SweepTokens():
+    '''
+    Forgets about any released tokens which have expired.
+    '''
+    while _ReleasedTokens and not _ReleasedTokens[0].IsValid():
+        token = _ReleasedTokens.popleft()
+        if _Tokens.get(token.Value) is token:
+            del _Tokens[token.Value]
+
+
+def IssueToken(conn):
+    '''
+    Issues a new login token to a logged-in connection and sends it.
+    
+    Any token previously issued to the connection is revoked.
+    
+    @type conn: xVServer.ServerNetworking.ServerConnection
+    @param conn: Connection to issue the token to.
+    '''
+    _SweepTokens()
+    
+    # Revoke the old token.
+    if conn.LoginToken:
+        _Tokens.pop(conn.LoginToken.Value, None)
+    
+    # Issue the new one.
+    token = LoginToken()
+    token.Account = conn.Account
+    _Tokens[token.Value] = token
+    conn.LoginToken = token
+    
+    reply = Packets.LoginTokenPacket(conn)
+    reply.Token = token.Value
+    reply.ValidFor = int(LoginToken.TOKEN_VALID_LENGTH)
+    reply.SendPacket()
+
+
+def RefreshTokens():
+    '''
+    Sends a fresh login token to every logged-in connection whose token is
+    older than TOKEN_REFRESH_INTERVAL, so that their tokens never reach
+    TOKEN_MAX_AGE.  Called periodically from the main loop.
+    
+    @return: Number of tokens refreshed.
+    '''
+    App = ServerGlobals.Application
+    stale = time.time() - LoginToken.TOKEN_REFRESH_INTERVAL
+    count = 0
+    for conn in App.Connections.ByAccountName.values():
+        token = conn.LoginToken
+        if token is not None and token.IssuedAt <= stale:
+            IssueToken(conn)
+            count += 1
+    return count
+
+
+def Tick():
+    '''
+    Refreshes the tokens of open connections if it's time.  Called once per
+    cycle of the main loop.
+    '''
+    global _NextRefresh
+    now = time.time()
+    if now < _NextRefresh:
+        return
+    _NextRefresh = now + LoginToken.TOKEN_REFRESH_INTERVAL / 10
+    RefreshTokens()
+
+
+def RevokeTokens(username):
+    '''
+    Revokes every outstanding login token for an account, e.g. when it is
+    banned.
+    
+    @type username: string
+    @param username: Name of the account.
+    
+    @return: Number of tokens revoked.
+    '''
+    count = 0
+    for value, token in _Tokens.items():
+        if token.Account is not None and token.Account.Username == username:
+            _Tokens.pop(value, None)
+            count += 1
+    return count
+
+
+def ReleaseToken(conn):
+    '''
+    Called when a connection closes to start its token's expiration clock.
+    
+    @type conn: xVServer.ServerNetworking.ServerConnection
+    @param conn: Connection which is closing.
+    '''
+    token = conn.LoginToken
+    if token is None:
+        return
+    conn.LoginToken = None
+    if _Tokens.get(token.Value) is token:
+        token.Release()
+        _ReleasedTokens.append(token)
+
+
+def ResumeSession(conn, value):
+    '''
+    Tries to restore a previous session from a login token.
+    
+    Tokens can only be redeemed once, and are refused (but left outstanding)
+    while their account is still held by a connection, so that a token seen
+    on the wire can't be used to take over a live session; a client whose
+    old connection died without the server noticing must wait for it to time
+    out.  Tokens for banned accounts are refused.  No database queries are
+    made.
+    
+    The caller must issue the connection a new token if this succeeds.
+    
+    @type conn: xVServer.ServerNetworking.ServerConnection
+    @param conn: Connection presenting the token.
+    
+    @type value: string
+    @param value: Token value presented by the client.
+    
+    @return: True if the session was restored, False otherwise.
+    '''
+    token = _Tokens.get(value)
+    if token is None:
+        return False
+    if not token.IsValid():
+        del _Tokens[value]
+        return False
+    
+    # Is the account still in use?
+    App = ServerGlobals.Application
+    account = token.Account
+    username = account.Username
+    if username in App.Connections.ByAccountName:
+        msg = "%s - Refused to resume session for account %s, which is "
+        msg += "still connected."
+        msg %= (conn.Address[0], username)
+        mainlog.warning(msg)
+        return False
+    del _Tokens[value]
+    
+    # Has it been banned?
+    if account.Banned:
+        expires = account.BanExpires
+        if expires is None or expires > datetime.datetime.now():
+            msg = "%s - Refused to resume session for banned account %s."
+            msg %= (conn.Address[0], username)
+            mainlog.info(msg)
+            return False
+    
+    # Restore the session.
+    conn.Account = account
+    App.Connections.UpdateConnection(conn)
+    msg = "%s - Resumed session for account %s."
+    msg %= (conn.Address[0], username)
+    mainlog.info(msg)
+    return True
+
+
+def ExportTokens(drain):
+    '''
+    Lists the outstanding login tokens so that a new server process can take
+    them over (see the Upgrade module).
+    
+    @type drain: number
+    @param drain: Number of seconds the connections still holding their
+    tokens may stay open in this process.
+    
+    @return: List of (token value, account name, seconds left) tuples.
+    '''
+    _SweepTokens()
+    now = time.time()
+    tokens = []
+    for token in _Tokens.itervalues():
+        if token.Account is None:
+            continue
+        if token.ReleasedAt is None:
+            left = drain + LoginToken.TOKEN_VALID_LENGTH
+        else:
+            left = token.ReleasedAt + LoginToken.TOKEN_VALID_LENGTH - now
+        left = min(left, token.IssuedAt + LoginToken.TOKEN_MAX_AGE - now)
+        if left > 0:
+            tokens.append((token.Value, token.Account.Username, left))
+    return tokens
+
+
+def ImportTokens(tokens):
+    '''
+    Takes over the login tokens of the server process being replaced.
+    
+    The tokens are treated as released, so they expire when the old process
+    would have expired them.  Their accounts are loaded straight away, so
+    this should only be called while the server is starting up.
+    
+    @type tokens: list
+    @param tokens: (token value, account name, seconds left) tuples, as
+    returned by ExportTokens() in the old process.
+    
+    @return: Number of tokens taken over.
+    '''
+    accounts = Accounts.LookupMany(set(username for value, username, left
+                                       in tokens))
+    now = time.time()
+    imported = []
+    for value, username, left in tokens:
+        if accounts.get(username) is None:
+            # The account has been deleted since.
+            continue
+        token = LoginToken()
+        token.Value = value
+        token.IssuedAt = now + left - LoginToken.TOKEN_MAX_AGE
+        token.ReleasedAt = now + left - LoginToken.TOKEN_VALID_LENGTH
+        token.Account = accounts[username]
+        _Tokens[value] = token
+        imported.append(token)
+    imported.sort(key=lambda token: token.ReleasedAt)
+    _ReleasedTokens.extend(imported)
+    return len(imported)
 
 
 ##
@@ -75,7 +354,7 @@ class LoginToken(object):
 
 class WaitForLoginRouter(ServerPacketRouter.BaseServerPacketRouter):
     '''
-    Single-connection packet router for the wait-for-login state.
+    Packet router for the wait-for-login state.
     '''
     
     def __init__(self):
@@ -98,69 +377,207 @@ def StartLoginHandler(packet):
     '''
     Packet handler for the StartLogin packet type.
     
+    The account lookup is done on a database worker; the challenge is sent
+    from _StartLoginLookupDone() once the lookup finishes.
+    
     @type packet: xVLib.Packets.StartLoginPacket
     @param packet: Packet to handle.
     '''
     # Check the timeout on the login.
-    delta = time.time() - packet.Connection.LastLogin
-    if delta < LoginDelay:
+    conn = packet.Connection
+    delta = time.time() - conn.LastLogin
+    if delta < LoginDelay or conn.LoginPending:
         # Timeout not complete.
-        reply = Packets.BadLoginPacket(packet.Connection)
+        reply = Packets.BadLoginPacket(conn)
         reply.Reason = Packets.BadLoginPacket.Reason_WaitForLogin
         reply.SendPacket()
         return
-    packet.Connection.LastLogin = time.time()
+    conn.LastLogin = time.time()
+    
+    # Look up the account.  Lookups from the same cycle are batched together.
+    conn.LoginPending = True
+    Accounts.RequestLookup(packet.Username,
+                           functools.partial(_StartLoginLookupDone, conn),
+                           functools.partial(_StartLoginLookupFailed, conn))
+
+
+def _StartLoginLookupDone(conn, account):
+    '''
+    Finishes a StartLogin request once the account lookup is done.
+    '''
+    conn.LoginPending = False
+    if not conn.connected or conn.State != conn.State_WaitForLogin:
+        # Connection went away (or moved on) while we were waiting.
+        return
     
     # Does the account exist?
-    session = Database.MainSession
-    query = session.query(Account)
-    account = query.filter(Account.Username==packet.Username).one()
     if not account:
         # Account does not exist, send BadLogin reply
-        reply = Packets.BadLoginPacket(packet.Connection)
+        reply = Packets.BadLoginPacket(conn)
         reply.Reason = Packets.BadLoginPacket.Reason_BadUsername
         reply.SendPacket()
         return
     
     # Generate login challenge and send reply.
-    packet.Connection.Account = account
-    reply = Packets.LoginChallengePacket(packet.Connection)
+    conn.Account = account
+    reply = Packets.LoginChallengePacket(conn)
     reply.Salt = account.PasswordSalt
     challenge = GenerateChallenge()
-    packet.Connection.LoginChallenge = challenge
+    conn.LoginChallenge = challenge
     reply.Challenge = challenge
     reply.SendPacket()
     
     # Adjust network state to accept challenge solutions.
-    packet.Connection.SetState(packet.Connection.State_Login)
+    conn.SetState(conn.State_Login)
+
+
+def _StartLoginLookupFailed(conn, err):
+    '''
+    Reports a database error during a StartLogin request.
+    '''
+    conn.LoginPending = False
+    msg = "Database error while looking up account: %s" % err
+    mainlog.error(msg)
+    if conn.connected:
+        reply = Packets.BadLoginPacket(conn)
+        reply.Reason = Packets.BadLoginPacket.Reason_GeneralFailure
+        reply.SendPacket()
 
 
 def RegisterHandler(packet):
     '''
     Packet handler for the Register packet type.
     
+    The account is created on a database worker; the reply is sent from
+    _RegisterDone() or _RegisterFailed() once that finishes.
+    
     @type packet: xVLib.Packets.RegisterPacket
     @param packet: Packet to handle.
     '''
+    # Only one request at a time.
+    conn = packet.Connection
+    if conn.LoginPending:
+        packet.ReplyFailed(Packets.RegisterPacket.Reason_GeneralFailure)
+        return
+    
+    # Don't bother the database if we already know the name is taken.
+    hit, account = Accounts.Cache.Get(packet.Username)
+    if hit and account is not None:
+        packet.ReplyFailed(Packets.RegisterPacket.Reason_UsernameTaken)
+        return
+    
     # Go ahead and try to register
-    creator_ip = packet.Connection.Address[0]
+    conn.LoginPending = True
+    creator_ip = conn.Address[0]
+    job = functools.partial(Accounts.Register, packet.Username,
+                            packet.PasswordHash, packet.Salt, packet.Email,
+                            creator_ip)
+    Database.Submit(job, functools.partial(_RegisterDone, packet),
+                    functools.partial(_RegisterFailed, packet), write=True)
+
+
+def _RegisterDone(packet, account):
+    '''
+    Finishes a Register request once the account has been created.
+    '''
+    conn = packet.Connection
+    conn.LoginPending = False
+    msg = "%s - Registered account %s." % (conn.Address[0], account.Username)
+    mainlog.info(msg)
+    if not conn.connected or conn.State != conn.State_WaitForLogin:
+        return
+    
+    # Log the new account in.
+    conn.Account = account
+    if not _CompleteLogin(packet):
+        conn.Account = None
+        packet.ReplyFailed(Packets.RegisterPacket.Reason_GeneralFailure)
+
+
+def _RegisterFailed(packet, err):
+    '''
+    Reports a failed Register request.
+    '''
+    conn = packet.Connection
+    conn.LoginPending = False
+    if isinstance(err, Accounts.UsernameTaken):
+        reason = Packets.RegisterPacket.Reason_UsernameTaken
+    elif isinstance(err, ValueError):
+        reason = Packets.RegisterPacket.Reason_InvalidValue
+    else:
+        msg = "Database error while registering account: %s" % err
+        mainlog.error(msg)
+        reason = Packets.RegisterPacket.Reason_GeneralFailure
+    if conn.connected:
+        packet.ReplyFailed(reason)
+
+
+def _CompleteLogin(packet):
+    '''
+    Finishes logging a connection into the account set on it.
+    
+    On success, this replies to the request with Success and sends a login
+    token.  On failure, no reply is sent.
+    
+    @type packet: xVLib.Packets.RequestPacketMixin
+    @param packet: Request whose connection has just been authenticated.
+    
+    @return: True on success, False if the account is already logged in.
+    '''
+    conn = packet.Connection
+    
+    # Register the login with the connection manager.
+    # (In-function import, since ServerNetworking imports this module.)
+    from .ServerNetworking import NameAlreadyInUse
+    App = ServerGlobals.Application
     try:
-        NewAccount = Accounts.Register(packet.Username,
-                                       packet.PasswordHash,
-                                       packet.Salt,
-                                       packet.Email,
-                                       creator_ip)
-    except ValueError:
-        pass
-    except Accounts.UsernameTaken:
-        pass
-    except:
-        pass
+        App.Connections.UpdateConnection(conn)
+    except NameAlreadyInUse:
+        return False
+    
+    # Logged in.
+    msg = "%s - Logged in as %s." % (conn.Address[0], conn.Account.Username)
+    mainlog.info(msg)
+    packet.ReplySuccess(0)
+    IssueToken(conn)
+    conn.SetState(conn.State_CharacterSelect)
+    return True
+
+
+def FinishLoginHandler(packet):
+    '''
+    Packet handler for the FinishLogin packet type.
+    
+    @type packet: xVLib.Packets.FinishLoginPacket
+    @param packet: Packet to handle.
+    '''
+    conn = packet.Connection
+    
+    # Check the challenge solution.
+    challenge = conn.LoginChallenge
+    conn.LoginChallenge = None
+    expected = hashlib.sha256(conn.Account.PasswordHash + challenge).digest()
+    if not hmac.compare_digest(packet.ChallengeSolution, expected):
+        # Wrong password.
+        msg = "%s - Failed login for account %s."
+        msg %= (conn.Address[0], conn.Account.Username)
+        mainlog.info(msg)
+        conn.Account = None
+        packet.ReplyFailed(Packets.FinishLoginPacket.Reason_BadSolution)
+        conn.SetState(conn.State_WaitForLogin)
+        return
+    
+    # Log in.
+    if not _CompleteLogin(packet):
+        conn.Account = None
+        reason = Packets.FinishLoginPacket.Reason_AlreadyLoggedIn
+        packet.ReplyFailed(reason)
+        conn.SetState(conn.State_WaitForLogin)
 
 
 class LoginRouter(ServerPacketRouter.BaseServerPacketRouter):
     '''
-    Single-connection packet router for the login state.
+    Packet router for the login state.
     '''
     
     def __init__(self):
@@ -168,4 +585,4 @@ class LoginRouter(ServerPacketRouter.BaseServerPacketRouter):
         super(LoginRouter, self).__init__()
         
         # Set up login handlers.
-        # TODO: Implement
+        self.Handlers[Packets.FinishLogin] = FinishLoginHandler
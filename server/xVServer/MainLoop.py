@@ -26,9 +26,12 @@ to other green threads at least once per cycle.
 '''
 
 import logging
+import time
 import traceback
 
-from xVServer import ServerNetworking
+from xVServer import ServerNetworking, Callbacks, Accounts, Persistence
+from xVServer import Admission, Metrics, ServerGlobals, Watchdog, Profiler
+from xVServer import Memory, Upgrade, Interest, Login
 
 class MainLoopEnd(Exception): pass
 '''Raised when the main loop is gracefully terminated.'''
@@ -42,9 +45,46 @@ def MainLoop():
     # enter loop
     mainlog.info("Server started.")
     try:
+        cyclestart = time.time()
         while 1:
             # poll the network
             ServerNetworking.PollNetwork()
+            
+            # send off the account lookups requested this cycle
+            Accounts.FlushLookups()
+            
+            # write back dirty records if it's time
+            Persistence.Tick()
+            
+            # send out the changes to game objects if it's time
+            Interest.Tick()
+            
+            # send fresh login tokens to long-lived connections if it's time
+            Login.Tick()
+            
+            # run anything posted by background threads
+            Callbacks.RunCallbacks()
+            
+            # pick up configuration changes
+            ServerGlobals.Application.PollReload()
+            
+            # check the load
+            now = time.time()
+            Admission.Controller.Update(now - cyclestart)
+            Metrics.CycleTime.Observe(now - cyclestart)
+            cyclestart = now
+            Watchdog.Heartbeat(now)
+            
+            # log the metrics summary if it's time
+            Metrics.Tick()
+            
+            # start a profile or memory report if one was asked for
+            Profiler.Poll()
+            Memory.Poll()
+            
+            # stop once the players have moved to the new server process
+            if Upgrade.Poll():
+                raise MainLoopEnd
     except KeyboardInterrupt:
         # server interrupted... clean up after the try block
         pass
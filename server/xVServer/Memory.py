@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+
+# xVector Engine Server
+# Copyright (c) 2012 James Buchwald
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+'''
+Memory accounting by subsystem.
+
+Sending the server SIGUSR2 writes a memory report to the main log.  The
+report measures how much memory is held by each part of the server:
+
+  - Maps: loaded maps and their tiles.
+  - Game: the objects in the game world and the area of interest index.
+  - Networking: connections, with their buffers and packet routers.  The
+    average footprint of a single connection is reported too.
+  - ConnectionManager: the lookup tables of the connection manager.
+  - Packets: packet objects which are still alive.
+  - Database: the main session's identity map, the account cache, the
+    write-behind queue and the IP ban index.
+
+Each report also compares a census of every object the garbage collector
+knows about against the previous report, listing the types whose numbers grew
+the most.  Types that keep growing between reports are the place to look for
+leaks.
+
+Sizes are measured by walking the objects reachable from each subsystem and
+adding up sys.getsizeof(), so they are estimates: memory held by C libraries
+(zlib, OpenSSL, the database driver) isn't seen, and an object reachable from
+two subsystems is only counted for the first.  The walk runs on the main loop
+and can take a moment on a busy server.
+'''
+
+import asyncore
+import gc
+import logging
+import sys
+import time
+import types
+from xVLib import Maps, Packets
+from . import ServerGlobals, Database, Accounts, Persistence, IPBans
+from . import Interest
+
+mainlog = logging.getLogger("Server.Main")
+
+
+SharedTypes = (type, types.ModuleType, types.FunctionType,
+               types.BuiltinFunctionType, types.CodeType, types.FrameType,
+               types.ClassType)
+'''Types which are shared by everything, and so never counted.'''
+
+TopTypes = 15
+'''Number of growing types listed in each report.'''
+
+
+def _IsShared(obj):
+    '''
+    Checks whether an object belongs to the program rather than its data.
+    
+    Classes, modules and functions are shared by everything, and SQLAlchemy's
+    internal objects (mappers, instance states and so on) would otherwise
+    pull in the whole ORM.
+    '''
+    if isinstance(obj, SharedTypes):
+        return True
+    return type(obj).__module__.startswith("sqlalchemy")
+
+
+def DeepSize(roots, seen):
+    '''
+    Measures the memory held by a set of objects.
+    
+    @type roots: list
+    @param roots: Objects to measure.
+    
+    @type seen: set
+    @param seen: Ids of objects which have already been counted.  They are
+    skipped, and everything counted now is added.
+    
+    @return: Tuple (number of objects, total size in bytes).
+    '''
+    count = 0
+    size = 0
+    pending = list(roots)
+    while pending:
+        obj = pending.pop()
+        key = id(obj)
+        if key in seen or _IsShared(obj):
+            continue
+        seen.add(key)
+        count += 1
+        size += sys.getsizeof(obj)
+        pending.extend(gc.get_referents(obj))
+    return (count, size)
+
+
+def _Instances(cls):
+    '''
+    Finds every live instance of a class.
+    '''
+    return [obj for obj in gc.get_objects() if isinstance(obj, cls)]
+
+
+def Measure():
+    '''
+    Measures the memory held by each subsystem.
+    
+    @return: Tuple (list of (subsystem, objects, bytes), connection count).
+    '''
+    App = ServerGlobals.Application
+    connections = []
+    manager = None
+    if App is not None and App.Connections is not None:
+        manager = App.Connections
+        connections = list(manager.ConnectionSet)
+    
+    # The application and the asyncore socket map lead to everything, so
+    # they're marked as seen to keep each walk inside its own subsystem.
+    seen = set(id(obj) for obj in (App, asyncore.socket_map))
+    
+    results = []
+    results.append(("Maps",) + DeepSize(_Instances(Maps.BaseMap), seen))
+    
+    # Players' objects lead to their connections, which are left for the
+    # Networking walk.
+    hidden = set(id(conn) for conn in connections) - seen
+    seen |= hidden
+    results.append(("Game",) + DeepSize([Interest.Manager], seen))
+    seen -= hidden
+    results.append(("Networking",) + DeepSize(connections, seen))
+    roots = []
+    if manager is not None:
+        roots.append(manager)
+    results.append(("ConnectionManager",) + DeepSize(roots, seen))
+    results.append(("Packets",) + DeepSize(_Instances(Packets.Packet),
+                                            seen))
+    
+    # SQLAlchemy's internal objects are never counted, so this only picks up
+    # the column data of the records.
+    roots = [Accounts.Cache, Persistence.Work, IPBans.Index]
+    if Database.MainSession is not None:
+        roots.extend(Database.MainSession.identity_map.values())
+    results.append(("Database",) + DeepSize(roots, seen))
+    return (results, len(connections))
+
+
+def Census():
+    '''
+    Counts the live objects of each type known to the garbage collector.
+    
+    @return: Dict mapping type names to counts.
+    '''
+    counts = {}
+    for obj in gc.get_objects():
+        cls = type(obj)
+        name = "%s.%s" % (cls.__module__, cls.__name__)
+        counts[name] = counts.get(name, 0) + 1
+    return counts
+
+
+LastCensus = None
+'''Object census taken by the previous report, if any.'''
+
+Requested = False
+'''Set when a memory report has been requested.'''
+
+
+def Report():
+    '''
+    Builds a memory report, and remembers its census for the next one.
+    
+    @return: The report, as a multi-line string.
+    '''
+    global LastCensus
+    start = time.time()
+    results, connections = Measure()
+    census = Census()
+    lines = ["Memory report:"]
+    
+    # Subsystem sizes.
+    for name, count, size in results:
+        line = "  %-18s %10i objects %12.1f KB" % (name, count,
+                                                   size / 1024.0)
+        if name == "Networking" and connections:
+            line += " (%.1f KB per connection)" % (size / 1024.0
+                                                    / connections)
+        lines.append(line)
+    
+    # Growth since the last report.
+    if LastCensus is None:
+        lines.append("  Object census taken; the next report will show "
+                     "which types grew.")
+    else:
+        growth = []
+        for name, count in census.iteritems():
+            delta = count - LastCensus.get(name, 0)
+            if delta > 0:
+                growth.append((delta, name, count))
+        growth.sort(reverse=True)
+        lines.append("  Types which grew the most since the last report:")
+        for delta, name, count in growth[:TopTypes]:
+            lines.append("    %+8i %8i %s" % (delta, count, name))
+        if not growth:
+            lines.append("    (none)")
+    LastCensus = census
+    lines.append("  Report took %.2f seconds." % (time.time() - start))
+    return "\n".join(lines)
+
+
+def RequestReport(signum=None, frame=None):
+    '''
+    Requests a memory report.  Usable as a signal handler.
+    
+    The report is taken at the end of the current main loop cycle.
+    '''
+    global Requested
+    Requested = True
+
+
+def Poll():
+    '''
+    Writes a requested memory report.  Called once per main loop cycle.
+    '''
+    global Requested
+    if not Requested:
+        return
+    Requested = False
+    mainlog.info(Report())
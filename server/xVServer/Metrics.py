@@ -0,0 +1,835 @@
+# -*- coding: utf-8 -*-
+
+# xVector Engine Server
+# Copyright (c) 2012 James Buchwald
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+'''
+Performance metrics.
+
+The server keeps a registry of counters, gauges and histograms which the rest
+of the server updates as it works.  The registry can be read in two ways:
+
+  1. A summary is written to the main log every few minutes.
+  2. If enabled, a small HTTP endpoint serves every metric in the Prometheus
+     text format at /metrics.  The endpoint runs on the main loop alongside
+     the game's own sockets, and by default only listens on the loopback
+     interface.
+
+Metrics may be updated from any thread.  Gauges whose values are computed
+when read (see MetricsRegistry.GaugeFunction) are only evaluated on the main
+loop.
+'''
+
+import asyncore
+import bisect
+import logging
+import socket
+import sys
+import threading
+import time
+
+mainlog = logging.getLogger("Server.Main")
+
+
+DefaultBuckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                  0.25, 0.5, 1.0, 2.5, 5.0)
+'''Default histogram bucket upper bounds, in seconds.'''
+
+
+class _CounterChild(object):
+    '''
+    Value of a counter for one set of label values.
+    '''
+    
+    __slots__ = ('Value', '_Lock')
+    
+    def __init__(self, lock):
+        self.Value = 0
+        self._Lock = lock
+    
+    def Inc(self, amount=1):
+        '''
+        Adds to the counter.
+        '''
+        with self._Lock:
+            self.Value += amount
+
+
+class _GaugeChild(object):
+    '''
+    Value of a gauge for one set of label values.
+    '''
+    
+    __slots__ = ('Value', '_Lock')
+    
+    def __init__(self, lock):
+        self.Value = 0
+        self._Lock = lock
+    
+    def Set(self, value):
+        '''
+        Sets the gauge.
+        '''
+        self.Value = value
+    
+    def Inc(self, amount=1):
+        '''
+        Adds to the gauge.
+        '''
+        with self._Lock:
+            self.Value += amount
+    
+    def Dec(self, amount=1):
+        '''
+        Subtracts from the gauge.
+        '''
+        with self._Lock:
+            self.Value -= amount
+
+
+class _HistogramChild(object):
+    '''
+    Observations of a histogram for one set of label values.
+    '''
+    
+    __slots__ = ('Buckets', 'Counts', 'Sum', 'Count', '_Lock')
+    
+    def __init__(self, lock, buckets):
+        self.Buckets = buckets
+        self.Counts = [0] * (len(buckets) + 1)
+        self.Sum = 0.0
+        self.Count = 0
+        self._Lock = lock
+    
+    def Observe(self, value):
+        '''
+        Records an observation.
+        '''
+        i = bisect.bisect_left(self.Buckets, value)
+        with self._Lock:
+            self.Counts[i] += 1
+            self.Sum += value
+            self.Count += 1
+    
+    def Snapshot(self):
+        '''
+        Copies the current observations.
+        
+        @return: Tuple (bucket counts, sum, count).  The bucket counts are not
+        cumulative; the last one counts observations above every bucket.
+        '''
+        with self._Lock:
+            return (list(self.Counts), self.Sum, self.Count)
+
+
+class Metric(object):
+    '''
+    Base class for metrics.
+    
+    A metric with labels keeps a separate value for each combination of
+    label values; use Labels() to get at one.  A metric without labels can be
+    updated directly.
+    '''
+    
+    Type = None
+    '''Prometheus type name of the metric.'''
+    
+    def __init__(self, name, help, labels=()):
+        '''
+        Creates a metric.  Use the MetricsRegistry methods instead of calling
+        this directly.
+        
+        @type name: string
+        @param name: Name of the metric.
+        
+        @type help: string
+        @param help: One-line description of the metric.
+        
+        @type labels: tuple of strings
+        @param labels: Names of the metric's labels.
+        '''
+        self.Name = name
+        '''Name of the metric.'''
+        self.Help = help
+        '''One-line description of the metric.'''
+        self.LabelNames = tuple(labels)
+        '''Names of the metric's labels.'''
+        self._Lock = threading.Lock()
+        '''Lock guarding updates to the metric.'''
+        self._Children = {}
+        '''Maps tuples of label values to their values.'''
+        self._Default = None
+        '''Value of a metric without labels.'''
+        if not self.LabelNames:
+            self._Default = self.Labels()
+    
+    def Labels(self, *values):
+        '''
+        Gets the value for a combination of label values, creating it if this
+        is the first time it's been used.
+        '''
+        try:
+            return self._Children[values]
+        except KeyError:
+            if len(values) != len(self.LabelNames):
+                raise ValueError("%s takes labels %s" % (self.Name,
+                                                         self.LabelNames))
+            with self._Lock:
+                return self._Children.setdefault(values, self._NewChild())
+    
+    def Children(self):
+        '''
+        Gets a list of (label values, value) pairs.
+        '''
+        return self._Children.items()
+    
+    def _NewChild(self):
+        '''
+        Creates the value for a new combination of label values.
+        '''
+        raise NotImplementedError
+    
+    def Render(self, out):
+        '''
+        Writes the metric in the Prometheus text format.
+        
+        @type out: list
+        @param out: List of lines to append to.
+        '''
+        out.append("# HELP %s %s" % (self.Name, self.Help))
+        out.append("# TYPE %s %s" % (self.Name, self.Type))
+        for values, child in sorted(self.Children()):
+            labels = _FormatLabels(self.LabelNames, values)
+            out.append("%s%s %s" % (self.Name, labels,
+                                    _FormatValue(child.Value)))
+
+
+class Counter(Metric):
+    '''
+    Value which only goes up.
+    '''
+    
+    Type = "counter"
+    
+    def _NewChild(self):
+        return _CounterChild(self._Lock)
+    
+    def Inc(self, amount=1):
+        '''
+        Adds to a counter without labels.
+        '''
+        self._Default.Inc(amount)
+    
+    def Total(self):
+        '''
+        Gets the sum of the counter over every combination of labels.
+        '''
+        return sum(child.Value for values, child in self.Children())
+
+
+class Gauge(Metric):
+    '''
+    Value which can go up and down.
+    '''
+    
+    Type = "gauge"
+    
+    def _NewChild(self):
+        return _GaugeChild(self._Lock)
+    
+    def Set(self, value):
+        '''
+        Sets a gauge without labels.
+        '''
+        self._Default.Set(value)
+    
+    def Inc(self, amount=1):
+        '''
+        Adds to a gauge without labels.
+        '''
+        self._Default.Inc(amount)
+    
+    def Dec(self, amount=1):
+        '''
+        Subtracts from a gauge without labels.
+        '''
+        self._Default.Dec(amount)
+
+
+class GaugeFunction(Metric):
+    '''
+    Gauge whose value is computed whenever it is read.
+    '''
+    
+    Type = "gauge"
+    
+    def __init__(self, name, help, func, labels=()):
+        '''
+        Creates a computed gauge.  Use MetricsRegistry.GaugeFunction() instead.
+        
+        @type func: callable
+        @param func: Function taking no arguments.  If the gauge has no
+        labels, it returns the value; otherwise it returns a dict mapping
+        tuples of label values to values.
+        '''
+        self.Function = func
+        '''Function computing the value of the gauge.'''
+        Metric.__init__(self, name, help, labels)
+    
+    def _NewChild(self):
+        return _GaugeChild(self._Lock)
+    
+    def Children(self):
+        '''
+        Computes the current value(s) of the gauge.
+        '''
+        result = self.Function()
+        if not self.LabelNames:
+            result = {(): result}
+        children = []
+        for values, value in result.iteritems():
+            child = _GaugeChild(self._Lock)
+            child.Value = value
+            children.append((values, child))
+        return children
+
+
+class Histogram(Metric):
+    '''
+    Distribution of observed values, counted in buckets.
+    '''
+    
+    Type = "histogram"
+    
+    def __init__(self, name, help, labels=(), buckets=DefaultBuckets):
+        '''
+        Creates a histogram.  Use MetricsRegistry.Histogram() instead.
+        
+        @type buckets: sequence of numbers
+        @param buckets: Upper bounds of the buckets, in increasing order.
+        '''
+        self.Buckets = tuple(buckets)
+        '''Upper bounds of the buckets.'''
+        Metric.__init__(self, name, help, labels)
+    
+    def _NewChild(self):
+        return _HistogramChild(self._Lock, self.Buckets)
+    
+    def Observe(self, value):
+        '''
+        Records an observation in a histogram without labels.
+        '''
+        self._Default.Observe(value)
+    
+    def Render(self, out):
+        out.append("# HELP %s %s" % (self.Name, self.Help))
+        out.append("# TYPE %s %s" % (self.Name, self.Type))
+        bounds = [_FormatValue(b) for b in self.Buckets] + ["+Inf"]
+        for values, child in sorted(self.Children()):
+            counts, total, count = child.Snapshot()
+            names = self.LabelNames + ("le",)
+            cumulative = 0
+            for bound, n in zip(bounds, counts):
+                cumulative += n
+                labels = _FormatLabels(names, values + (bound,))
+                out.append("%s_bucket%s %i" % (self.Name, labels, cumulative))
+            labels = _FormatLabels(self.LabelNames, values)
+            out.append("%s_sum%s %s" % (self.Name, labels,
+                                        _FormatValue(total)))
+            out.append("%s_count%s %i" % (self.Name, labels, count))
+
+
+class MetricsRegistry(object):
+    '''
+    Collection of every metric the server exports.
+    '''
+    
+    def __init__(self):
+        self.Metrics = []
+        '''Registered metrics, in the order they were created.'''
+    
+    def Counter(self, name, help, labels=()):
+        '''
+        Creates and registers a counter.
+        '''
+        return self.Register(Counter(name, help, labels))
+    
+    def Gauge(self, name, help, labels=()):
+        '''
+        Creates and registers a gauge.
+        '''
+        return self.Register(Gauge(name, help, labels))
+    
+    def GaugeFunction(self, name, help, func, labels=()):
+        '''
+        Creates and registers a gauge computed by a function when read.
+        
+        The function is only called on the main loop.
+        '''
+        return self.Register(GaugeFunction(name, help, func, labels))
+    
+    def Histogram(self, name, help, labels=(), buckets=DefaultBuckets):
+        '''
+        Creates and registers a histogram.
+        '''
+        return self.Register(Histogram(name, help, labels, buckets))
+    
+    def Register(self, metric):
+        '''
+        Adds a metric to the registry.
+        
+        @return: The metric.
+        '''
+        self.Metrics.append(metric)
+        return metric
+    
+    def Render(self):
+        '''
+        Writes every metric in the Prometheus text format.
+        
+        @return: String containing the exposition.
+        '''
+        out = []
+        for metric in self.Metrics:
+            metric.Render(out)
+        out.append("")
+        return "\n".join(out)
+
+
+def _FormatLabels(names, values):
+    '''
+    Formats a set of labels for the Prometheus text format.
+    '''
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = unicode(value).replace("\\", "\\\\").replace('"', '\\"')
+        pairs.append('%s="%s"' % (name, value.encode("utf-8")))
+    return "{%s}" % ",".join(pairs)
+
+
+def _FormatValue(value):
+    '''
+    Formats a sample value for the Prometheus text format.
+    '''
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def Quantile(buckets, counts, q):
+    '''
+    Estimates a quantile from histogram bucket counts.
+    
+    @type buckets: sequence of numbers
+    @param buckets: Upper bounds of the buckets.
+    
+    @type counts: list of integers
+    @param counts: Non-cumulative bucket counts, as from Snapshot().
+    
+    @type q: number
+    @param q: Quantile to estimate, between 0 and 1.
+    
+    @return: Upper bound of the bucket holding the quantile, or None if there
+    are no observations.  Observations above every bucket give infinity.
+    '''
+    total = sum(counts)
+    if not total:
+        return None
+    rank = q * total
+    cumulative = 0
+    for i, n in enumerate(counts):
+        cumulative += n
+        if cumulative >= rank:
+            if i < len(buckets):
+                return buckets[i]
+            break
+    return float("inf")
+
+
+##
+## The server's metrics.
+##
+
+Registry = MetricsRegistry()
+'''Registry holding the server's metrics.'''
+
+PacketsIn = Registry.Counter("xvector_packets_received_total",
+                             "Packets received, by packet type.", ("type",))
+'''Packets received, by packet class name.'''
+
+BytesIn = Registry.Counter("xvector_bytes_received_total",
+                           "Bytes of packets received, by packet type.",
+                           ("type",))
+'''Bytes received, by packet class name.'''
+
+PacketsOut = Registry.Counter("xvector_packets_sent_total",
+                              "Packets sent, by packet type.", ("type",))
+'''Packets sent, by packet class name.'''
+
+BytesOut = Registry.Counter("xvector_bytes_sent_total",
+                            "Bytes of packets sent, by packet type.",
+                            ("type",))
+'''Bytes sent, by packet class name.'''
+
+BodyBytes = Registry.Counter("xvector_packet_body_bytes_total",
+                             "Bytes of packet bodies sent, before (raw) and "
+                             "after (wire) compression.", ("form",))
+'''Bytes of packet bodies sent, before and after compression.'''
+
+CompressionRatio = Registry.GaugeFunction(
+        "xvector_compression_ratio",
+        "Wire size of sent packet bodies over their uncompressed size.",
+        lambda: _Ratio(BodyBytes.Labels("wire").Value,
+                       BodyBytes.Labels("raw").Value))
+'''Overall compression ratio of sent packet bodies.'''
+
+CycleTime = Registry.Histogram("xvector_cycle_seconds",
+                               "Duration of main loop cycles.")
+'''Duration of main loop cycles.'''
+
+DatabaseJobTime = Registry.Histogram("xvector_database_job_seconds",
+                                     "Duration of database jobs, including "
+                                     "the commit.", ("queue",))
+'''Duration of database jobs, by queue (read or write).'''
+
+BanCheckTime = Registry.Histogram("xvector_ban_check_seconds",
+                                  "Duration of IP ban checks.",
+                                  buckets=(0.00001, 0.000025, 0.00005,
+                                           0.0001, 0.00025, 0.0005, 0.001,
+                                           0.0025, 0.01))
+'''Duration of IP ban checks.'''
+
+HandlerTime = Registry.Histogram("xvector_handler_seconds",
+                                 "Time spent handling received packets, by "
+                                 "packet type.", ("type",))
+'''
+Time spent in packet handlers, by packet class name.
+
+Only recorded while TraceHandlers is set.
+'''
+
+Stalls = Registry.Counter("xvector_main_loop_stalls_total",
+                          "Main loop stalls reported by the watchdog.")
+'''Main loop stalls reported by the watchdog.'''
+
+TraceHandlers = False
+'''If True, the time taken by each packet handler is recorded.'''
+
+
+def _Ratio(numerator, denominator):
+    '''
+    Divides, giving 1.0 if there's nothing to divide by.
+    '''
+    if not denominator:
+        return 1.0
+    return float(numerator) / denominator
+
+
+##
+## Periodic log summary.
+##
+
+class SummaryLogger(object):
+    '''
+    Writes a summary of the metrics to the main log at regular intervals.
+    
+    Rates and percentiles in each summary cover the interval since the
+    previous one.
+    '''
+    
+    def __init__(self):
+        self.Interval = 300
+        '''Seconds between summaries, or 0 to disable them.'''
+        self.LastSummary = time.time()
+        '''Time of the last summary.'''
+        self._Last = {}
+        '''Values of the metrics as of the last summary.'''
+    
+    def Tick(self):
+        '''
+        Writes a summary if one is due.  Called once per main loop cycle.
+        '''
+        if not self.Interval:
+            return
+        now = time.time()
+        elapsed = now - self.LastSummary
+        if elapsed < self.Interval:
+            return
+        self.LastSummary = now
+        mainlog.info(self.Summarize(elapsed))
+    
+    def Summarize(self, elapsed):
+        '''
+        Builds the summary for an interval.
+        
+        @type elapsed: number
+        @param elapsed: Length of the interval in seconds.
+        
+        @return: Summary message.
+        '''
+        parts = []
+        
+        # Traffic.
+        pin = self._Delta("pin", PacketsIn.Total())
+        bytesin = self._Delta("bin", BytesIn.Total())
+        pout = self._Delta("pout", PacketsOut.Total())
+        bytesout = self._Delta("bout", BytesOut.Total())
+        raw = self._Delta("raw", BodyBytes.Labels("raw").Value)
+        wire = self._Delta("wire", BodyBytes.Labels("wire").Value)
+        msg = "in %.1f pkt/s %.1f KB/s, out %.1f pkt/s %.1f KB/s "
+        msg += "(compression %.2f)"
+        parts.append(msg % (pin / elapsed, bytesin / elapsed / 1024.0,
+                            pout / elapsed, bytesout / elapsed / 1024.0,
+                            _Ratio(wire, raw)))
+        
+        # Latencies.
+        parts.append("cycle %s" % self._Latency("cycle", CycleTime))
+        parts.append("ban check %s" % self._Latency("ban", BanCheckTime))
+        for values, child in sorted(DatabaseJobTime.Children()):
+            key = "db" + values[0]
+            parts.append("db %s %s" % (values[0],
+                                       self._Latency(key, DatabaseJobTime,
+                                                     values)))
+        return "Metrics: " + "; ".join(parts) + "."
+    
+    def _Delta(self, key, value):
+        '''
+        Gets how much a value has grown since the last summary.
+        '''
+        delta = value - self._Last.get(key, 0)
+        self._Last[key] = value
+        return delta
+    
+    def _Latency(self, key, histogram, values=()):
+        '''
+        Describes the observations a histogram got since the last summary.
+        '''
+        counts, total, count = histogram.Labels(*values).Snapshot()
+        last = self._Last.get(key)
+        self._Last[key] = (counts, total, count)
+        if last:
+            counts = [a - b for a, b in zip(counts, last[0])]
+            total -= last[1]
+            count -= last[2]
+        if not count:
+            return "idle"
+        p50 = Quantile(histogram.Buckets, counts, 0.5)
+        p99 = Quantile(histogram.Buckets, counts, 0.99)
+        return "avg %.2f ms, p50 <%.2f ms, p99 <%.2f ms (%i)" % (
+                total / count * 1000, p50 * 1000, p99 * 1000, count)
+
+
+Summary = SummaryLogger()
+'''Shared summary logger.'''
+
+
+##
+## HTTP endpoint.
+##
+
+class _ExportRequest(asyncore.dispatcher_with_send):
+    '''
+    Handles a single HTTP request to the metrics endpoint.
+    '''
+    
+    MaxRequestSize = 8192
+    '''Largest request accepted, in bytes.'''
+    
+    def __init__(self, sock):
+        asyncore.dispatcher_with_send.__init__(self, sock)
+        self.Request = ""
+        '''Request data received so far.'''
+        self.Responded = False
+        '''True once the response has been queued.'''
+    
+    def readable(self):
+        return not self.Responded
+    
+    def handle_read(self):
+        data = self.recv(4096)
+        if not data:
+            return
+        self.Request += data
+        if "\r\n\r\n" in self.Request or "\n\n" in self.Request:
+            self.Respond()
+        elif len(self.Request) > self.MaxRequestSize:
+            self.SendResponse("413 Request Entity Too Large", "text/plain",
+                              "Request too large.\n")
+    
+    def Respond(self):
+        '''
+        Answers the request.
+        '''
+        line = self.Request.split("\n", 1)[0].split()
+        if len(line) < 2 or line[0] not in ("GET", "HEAD"):
+            self.SendResponse("405 Method Not Allowed", "text/plain",
+                              "Only GET is supported.\n")
+            return
+        if line[1].split("?", 1)[0] not in ("/", "/metrics"):
+            self.SendResponse("404 Not Found", "text/plain", "Not found.\n")
+            return
+        body = Registry.Render()
+        if line[0] == "HEAD":
+            body = ""
+        self.SendResponse("200 OK", "text/plain; version=0.0.4", body)
+    
+    def SendResponse(self, status, ctype, body):
+        '''
+        Queues a response and closes the connection once it's sent.
+        '''
+        self.Responded = True
+        head = "HTTP/1.0 %s\r\nContent-Type: %s\r\nContent-Length: %i\r\n"
+        head += "Connection: close\r\n\r\n"
+        self.send(head % (status, ctype, len(body)) + body)
+        if not self.out_buffer:
+            self.close()
+    
+    def handle_write(self):
+        self.initiate_send()
+        if self.Responded and not self.out_buffer:
+            self.close()
+    
+    def handle_close(self):
+        self.close()
+    
+    def handle_error(self):
+        msg = "Error in metrics endpoint request: %s" % (_ExceptionMessage(),)
+        mainlog.warning(msg)
+        self.close()
+
+
+class ExportServer(asyncore.dispatcher):
+    '''
+    Listens for HTTP requests for the metrics.
+    '''
+    
+    def __init__(self, iface, port, sock=None):
+        '''
+        Creates the endpoint and starts listening.
+        
+        @type sock: socket
+        @param sock: Listening socket taken over from the server process
+        being replaced (see the Upgrade module), or None to create one.
+        
+        @raise socket.error: Raised if the endpoint can't listen.
+        '''
+        asyncore.dispatcher.__init__(self)
+        if sock is not None:
+            sock.setblocking(0)
+            self.set_socket(sock)
+            self.accepting = True
+            self.addr = sock.getsockname()
+            return
+        family = socket.AF_INET
+        if ":" in iface:
+            family = socket.AF_INET6
+        self.create_socket(family, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((iface, port))
+        self.listen(5)
+    
+    def writable(self):
+        return False
+    
+    def handle_accept(self):
+        try:
+            pair = self.accept()
+        except socket.error:
+            return
+        if pair:
+            _ExportRequest(pair[0])
+    
+    def handle_error(self):
+        msg = "Error in metrics endpoint: %s" % (_ExceptionMessage(),)
+        mainlog.warning(msg)
+
+
+def _ExceptionMessage():
+    '''
+    Describes the exception being handled, for one-line log messages.
+    '''
+    err = sys.exc_info()[1]
+    return "%s: %s" % (type(err).__name__, err)
+
+
+Endpoint = None
+'''ExportServer serving the metrics, if enabled.'''
+
+
+def InitMetrics(config):
+    '''
+    Applies the metrics settings from the configuration file.
+    
+    @type config: xVLib.ConfigurationFile.ConfigurationFile
+    @param config: Handle to the main configuration file object.
+    '''
+    global TraceHandlers
+    Summary.Interval = config['Metrics/LogInterval']
+    TraceHandlers = config['Metrics/TraceHandlers']
+
+
+def StartEndpoint(config, sock=None):
+    '''
+    Starts the HTTP endpoint, if it is enabled.
+    
+    The endpoint is optional, so failing to start it is logged but isn't
+    fatal.
+    
+    @type config: xVLib.ConfigurationFile.ConfigurationFile
+    @param config: Handle to the main configuration file object.
+    
+    @type sock: socket
+    @param sock: The old endpoint's listening socket, if it was handed over
+    by the server process being replaced.  It is only used if the endpoint
+    is still enabled on the same port.
+    '''
+    global Endpoint
+    if not config['Metrics/HTTP/Enabled']:
+        if sock is not None:
+            sock.close()
+        return
+    iface = config['Metrics/HTTP/Interface']
+    port = config['Metrics/HTTP/Port']
+    if sock is not None and sock.getsockname()[1] != port:
+        sock.close()
+        sock = None
+    try:
+        Endpoint = ExportServer(iface, port, sock)
+    except socket.error as err:
+        msg = "Could not start metrics endpoint on %s port %i: %s"
+        mainlog.error(msg % (iface, port, err))
+        return
+    mainlog.info("Serving metrics on %s port %i." % (iface, port))
+
+
+def StopEndpoint():
+    '''
+    Stops the HTTP endpoint, if it is running.
+    '''
+    global Endpoint
+    if Endpoint is not None:
+        Endpoint.close()
+        Endpoint = None
+
+
+def Tick():
+    '''
+    Writes the log summary if it's due.  Called once per main loop cycle.
+    '''
+    Summary.Tick()
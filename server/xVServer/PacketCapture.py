@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+# xVector Engine Server
+# Copyright (c) 2012 James Buchwald
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+'''
+Packet capture of live connections.
+
+While Diagnostics/Capture/Enabled is set, every new connection is recorded to
+a capture file in the log directory (capture-<date>-<time>.xvcap).  The file
+holds the packets received from the clients along with their timing, in the
+format described in xVLib.Capture, and can be fed back into a server with
+server/bin/xVReplay.py to turn a real session into a repeatable benchmark.
+
+Capturing can be switched on and off by editing the configuration and
+sending the server SIGHUP.  Connections which were already open when the
+capture started aren't recorded, since a replay of them would start in the
+middle of a session.
+'''
+
+import logging
+import os
+import time
+from xVLib import Capture
+
+mainlog = logging.getLogger("Server.Main")
+
+
+class ServerCaptureWriter(Capture.CaptureWriter):
+    '''
+    Capture writer which logs when the capture stops.
+    '''
+    
+    def OnStopped(self, reason):
+        if reason:
+            msg = "Packet capture to %s stopped: %s." % (self.Path, reason)
+            mainlog.warning(msg)
+        else:
+            msg = "Packet capture to %s finished, %i bytes written."
+            mainlog.info(msg % (self.Path, self.Size))
+
+
+Writer = None
+'''ServerCaptureWriter recording new connections, if capturing.'''
+
+
+def InitCapture(config):
+    '''
+    Starts or stops the packet capture according to the configuration file.
+    
+    @type config: xVLib.ConfigurationFile.ConfigurationFile
+    @param config: Handle to the main configuration file object.
+    '''
+    global Writer
+    if not config['Diagnostics/Capture/Enabled']:
+        StopCapture()
+        return
+    maxsize = config['Diagnostics/Capture/MaxSize'] * 1048576
+    if Writer is not None and not Writer.Stopped:
+        # Already capturing; just pick up the new limit.
+        Writer.MaxSize = maxsize
+        return
+    
+    # Start a new capture file.
+    filename = time.strftime("capture-%Y%m%d-%H%M%S.xvcap")
+    path = os.path.join(config['Logging/Directory'], filename)
+    try:
+        Writer = ServerCaptureWriter(path, maxsize)
+    except IOError as err:
+        msg = "Could not start packet capture to %s: %s" % (path, err)
+        mainlog.error(msg)
+        Writer = None
+        return
+    mainlog.info("Capturing packets from new connections to %s." % path)
+
+
+def StopCapture():
+    '''
+    Stops the packet capture, if one is running.
+    '''
+    global Writer
+    if Writer is not None:
+        Writer.Close()
+        Writer = None
+
+
+def Attach(conn):
+    '''
+    Starts recording a new connection if a capture is running.
+    
+    @type conn: ServerNetworking.ServerConnection
+    @param conn: Connection to record.
+    '''
+    if Writer is None or Writer.Stopped:
+        return
+    conn.Recorder = Writer
+    Writer.OpenConnection(conn)
+
+
+def Detach(conn):
+    '''
+    Stops recording a connection which is being closed.
+    
+    @type conn: ServerNetworking.ServerConnection
+    @param conn: Connection being closed.
+    '''
+    if conn.Recorder is not None:
+        conn.Recorder.CloseConnection(conn)
+        conn.Recorder = None
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+
+# xVector Engine Server
+# Copyright (c) 2012 James Buchwald
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+'''
+Write-behind persistence for frequently changing records.
+
+Code on the main loop changes detached records in memory and calls
+MarkDirty() on them, naming the attributes it changed.  Every few seconds the
+changed columns are copied and written back to the database in a single
+transaction on a database worker, so the cost of persistence per cycle
+doesn't grow with the number of changes.
+
+Only the columns named to MarkDirty() are written; the rest of the record is
+left alone, so that changes made directly through a session in the meantime
+(banning an account, for instance) are not overwritten by an out of date
+copy.
+
+Only one flush is in flight at a time, so flushes are committed in the order
+they were taken.  If a flush fails, its records are marked dirty again and are
+retried with the next flush.  Any remaining changes are written out when the
+server shuts down.
+
+Only records which already exist in the database can be written behind; new
+records must still be added through a session.
+'''
+
+import logging
+import time
+import traceback
+import functools
+from collections import OrderedDict
+from sqlalchemy import bindparam
+from . import Database, Callbacks
+
+mainlog = logging.getLogger("Server.Main")
+
+
+class UnitOfWork(object):
+    '''
+    Tracks dirty records and writes them back in batches.
+    
+    This must only be used from the main loop.
+    '''
+    
+    def __init__(self, interval=5.0):
+        '''
+        Creates an empty unit of work.
+        
+        @type interval: number
+        @param interval: Number of seconds between flushes.
+        '''
+        self.Interval = interval
+        '''Number of seconds between flushes.'''
+        self.LastFlush = time.time()
+        '''Time at which the last flush was started.'''
+        self.InFlight = None
+        '''Records being written by the current flush, or None.'''
+        self._Dirty = OrderedDict()
+        '''
+        Maps (class, primary key) to (record, set of changed attribute names),
+        oldest first.
+        '''
+    
+    def MarkDirty(self, record, attributes):
+        '''
+        Marks attributes of a record as needing to be written back.
+        
+        If the record is already dirty, the attributes are added to those
+        already marked, and the values are taken from this copy of the record.
+        
+        @param record: Detached mapped object which already has a primary key.
+        
+        @type attributes: iterable of strings
+        @param attributes: Names of the column attributes which were changed.
+        
+        @raise ValueError: Raised if no attributes are given, or if any of
+        them are not (non-key) columns of the record's table.
+        '''
+        attributes = set(attributes)
+        if not attributes:
+            raise ValueError("No attributes given")
+        columns = record.__table__.columns
+        for name in attributes:
+            if name not in columns or columns[name].primary_key:
+                raise ValueError("%s is not a writable column" % name)
+        key = (type(record), _PrimaryKey(record))
+        try:
+            old, marked = self._Dirty[key]
+        except KeyError:
+            self._Dirty[key] = (record, attributes)
+        else:
+            self._Dirty[key] = (record, marked | attributes)
+    
+    def DirtyCount(self):
+        '''
+        Gets the number of records waiting to be written back.
+        '''
+        return len(self._Dirty)
+    
+    def Tick(self):
+        '''
+        Starts a flush if the interval has elapsed.
+        
+        This should be called once per cycle of the main loop.
+        '''
+        if time.time() - self.LastFlush >= self.Interval:
+            self.Flush()
+    
+    def Flush(self):
+        '''
+        Starts writing the dirty records back on a database worker.
+        
+        Nothing happens if there's nothing dirty or a flush is in flight.
+        
+        @return: True if a flush was started, False otherwise.
+        '''
+        self.LastFlush = time.time()
+        if not self._Dirty or self.InFlight is not None:
+            return False
+        batch = self._TakeBatch()
+        job = functools.partial(_WriteBatch, _Snapshot(batch))
+        Database.Submit(job, self._FlushDone, self._FlushFailed, write=True)
+        return True
+    
+    def FlushNow(self):
+        '''
+        Writes all dirty records back synchronously on the main session.
+        
+        The database workers must already be stopped, so that nothing else is
+        writing to the database.  Called when the server shuts down.
+        '''
+        # Pick up the result of the last asynchronous flush, if any.
+        Callbacks.RunCallbacks()
+        if not self._Dirty:
+            return
+        batch = self._TakeBatch()
+        session = Database.MainSession
+        try:
+            _WriteBatch(_Snapshot(batch), session)
+            session.commit()
+        except Exception:
+            session.rollback()
+            msg = "Could not write back %i records during shutdown.\n\n"
+            msg %= len(batch)
+            msg += traceback.format_exc()
+            mainlog.critical(msg)
+        self.InFlight = None
+    
+    def _TakeBatch(self):
+        '''
+        Moves every dirty record into the in-flight batch.
+        '''
+        batch = self._Dirty
+        self._Dirty = OrderedDict()
+        self.InFlight = batch
+        return batch
+    
+    def _FlushDone(self, result):
+        '''
+        Called on the main loop when a flush has been committed.
+        '''
+        self.InFlight = None
+    
+    def _FlushFailed(self, err):
+        '''
+        Called on the main loop when a flush fails.  Requeues its records.
+        '''
+        batch = self.InFlight
+        self.InFlight = None
+        msg = "Write-behind flush of %i records failed, will retry: %s"
+        mainlog.error(msg % (len(batch), err))
+        
+        # Put the failed records back in front, keeping their order.
+        for key, (record, attributes) in self._Dirty.iteritems():
+            if key in batch:
+                attributes = attributes | batch[key][1]
+            batch[key] = (record, attributes)
+        self._Dirty = batch
+
+
+def _PrimaryKey(record):
+    '''
+    Gets the primary key value of a mapped record.
+    '''
+    return tuple(getattr(record, col.key)
+                 for col in record.__table__.primary_key.columns)
+
+
+def _Snapshot(batch):
+    '''
+    Copies the changed column values out of a batch of records.
+    
+    The copy is taken on the main loop so that the worker never reads records
+    which the main loop may be changing.
+    
+    @return: List of (table, rows) pairs in the order the tables were first
+    dirtied, where rows is a list of dicts suitable for an executemany.  A
+    table appears once for each set of changed columns.
+    '''
+    groups = OrderedDict()
+    for (cls, pk), (record, attributes) in batch.iteritems():
+        table = record.__table__
+        row = {}
+        for col in table.primary_key.columns:
+            row["_pk_" + col.key] = getattr(record, col.key)
+        for name in attributes:
+            row[name] = getattr(record, name)
+        group = (table, frozenset(attributes))
+        groups.setdefault(group, []).append(row)
+    return [(table, rows) for (table, columns), rows in groups.iteritems()]
+
+
+def _WriteBatch(snapshot, session):
+    '''
+    Database job which writes a snapshot in one transaction.
+    
+    Each group of rows is written with a single executemany UPDATE, which sets
+    only the columns present in the rows.
+    '''
+    for table, rows in snapshot:
+        stmt = table.update()
+        for col in table.primary_key.columns:
+            stmt = stmt.where(col == bindparam("_pk_" + col.key))
+        session.execute(stmt, rows)
+
+
+Work = UnitOfWork()
+'''Shared unit of work.'''
+
+
+def InitPersistence(config):
+    '''
+    Applies the write-behind settings from the configuration file.
+    
+    @type config: xVLib.ConfigurationFile.ConfigurationFile
+    @param config: Handle to the main configuration file object.
+    '''
+    Work.Interval = config['Database/WriteBehind/Interval']
+    Work.LastFlush = time.time()
+
+
+def MarkDirty(record, attributes):
+    '''
+    Marks attributes of a record as needing to be written back.  Main loop
+    only.
+    
+    @param record: Detached mapped object which already has a primary key.
+    
+    @type attributes: iterable of strings
+    @param attributes: Names of the column attributes which were changed.
+    '''
+    Work.MarkDirty(record, attributes)
+
+
+def Tick():
+    '''
+    Starts a flush if one is due.  Called once per cycle of the main loop.
+    '''
+    Work.Tick()
+
+
+def FlushNow():
+    '''
+    Writes back everything that is still dirty.  Called during shutdown, after
+    the database workers have stopped.
+    '''
+    Work.FlushNow()
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+# xVector Engine Server
+# Copyright (c) 2012 James Buchwald
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+'''
+On-demand sampling profiler.
+
+Sending the server SIGUSR1 starts a profiling run.  For the configured number
+of seconds, a background thread looks at the main thread's stack at a fixed
+rate and counts how often each stack is seen.  When the run is over, the
+counts are written to the log directory in the "collapsed stack" format read
+by flame graph tools such as flamegraph.pl and speedscope:
+
+    ServerCore.py:Main;MainLoop.py:MainLoop;ServerNetworking.py:PollNetwork 42
+
+Unlike cProfile, the main thread isn't slowed down by the profiler, so it can
+be used on a live server under load.  Nothing runs while no profile is being
+taken.
+
+SIGUSR1 doesn't exist on Windows, so there the profiler is unavailable.
+'''
+
+import logging
+import os
+import sys
+import threading
+import time
+
+mainlog = logging.getLogger("Server.Main")
+
+
+class SamplingProfiler(threading.Thread):
+    '''
+    Background thread which samples the main thread's stack.
+    '''
+    
+    def __init__(self, rate, duration, path):
+        '''
+        Creates a profiler for the calling thread.  Call start() to run it.
+        
+        @type rate: number
+        @param rate: Samples to take per second.
+        
+        @type duration: number
+        @param duration: Seconds to profile for.
+        
+        @type path: string
+        @param path: File to write the collapsed stacks to.
+        '''
+        # Inherit base class behavior.
+        threading.Thread.__init__(self, name="Profiler")
+        self.daemon = True
+        
+        # Declare attributes.
+        self.Interval = 1.0 / rate
+        '''Seconds between samples.'''
+        self.Duration = duration
+        '''Seconds to profile for.'''
+        self.Path = path
+        '''File to write the collapsed stacks to.'''
+        self.Target = threading.current_thread().ident
+        '''Identifier of the thread being profiled.'''
+        self.Stacks = {}
+        '''Maps tuples of frame names, outermost first, to sample counts.'''
+        self.Samples = 0
+        '''Number of samples taken.'''
+        self._Names = {}
+        '''Maps code objects to their frame names.'''
+    
+    def run(self):
+        '''
+        Main function of the profiler thread.
+        '''
+        end = time.time() + self.Duration
+        due = time.time()
+        while due < end:
+            self.Sample()
+            due += self.Interval
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        self.Write()
+    
+    def Sample(self):
+        '''
+        Records the current stack of the profiled thread.
+        '''
+        frame = sys._current_frames().get(self.Target)
+        if frame is None:
+            return
+        stack = []
+        names = self._Names
+        while frame is not None:
+            code = frame.f_code
+            try:
+                stack.append(names[code])
+            except KeyError:
+                name = "%s:%s" % (os.path.basename(code.co_filename),
+                                  code.co_name)
+                names[code] = name
+                stack.append(name)
+            frame = frame.f_back
+        stack.reverse()
+        stack = tuple(stack)
+        self.Stacks[stack] = self.Stacks.get(stack, 0) + 1
+        self.Samples += 1
+    
+    def Write(self):
+        '''
+        Writes the collapsed stacks to the output file.
+        '''
+        try:
+            with open(self.Path, "w") as out:
+                for stack, count in sorted(self.Stacks.iteritems()):
+                    out.write("%s %i\n" % (";".join(stack), count))
+        except IOError as err:
+            msg = "Could not write profile to %s: %s" % (self.Path, err)
+            mainlog.error(msg)
+            return
+        msg = "Wrote profile of %i samples to %s."
+        mainlog.info(msg % (self.Samples, self.Path))
+
+
+Rate = 100
+'''Samples taken per second.'''
+
+Duration = 30
+'''Seconds each profiling run lasts.'''
+
+Directory = u''
+'''Directory profiles are written to.'''
+
+Current = None
+'''SamplingProfiler running right now, if any.'''
+
+Requested = False
+'''Set when a profiling run has been requested.'''
+
+
+def InitProfiler(config):
+    '''
+    Applies the profiler settings from the configuration file.
+    
+    @type config: xVLib.ConfigurationFile.ConfigurationFile
+    @param config: Handle to the main configuration file object.
+    '''
+    global Rate, Duration, Directory
+    Rate = config['Diagnostics/Profiler/Rate']
+    Duration = config['Diagnostics/Profiler/Duration']
+    Directory = config['Logging/Directory']
+
+
+def RequestProfile(signum=None, frame=None):
+    '''
+    Requests a profiling run.  Usable as a signal handler.
+    
+    The run starts at the end of the current main loop cycle.
+    '''
+    global Requested
+    Requested = True
+
+
+def Poll():
+    '''
+    Starts a requested profiling run.  Called once per main loop cycle.
+    '''
+    global Requested, Current
+    if not Requested:
+        return
+    Requested = False
+    if Current is not None and Current.is_alive():
+        mainlog.warning("A profile is already being taken.")
+        return
+    if Rate <= 0 or Duration <= 0:
+        mainlog.warning("The profiler is disabled in the configuration.")
+        return
+    filename = time.strftime("profile-%Y%m%d-%H%M%S.folded")
+    path = os.path.join(Directory, filename)
+    Current = SamplingProfiler(Rate, Duration, path)
+    Current.start()
+    msg = "Profiling the main loop for %i seconds at %i samples per second."
+    mainlog.info(msg % (Duration, Rate))
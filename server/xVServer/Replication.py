@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+
+# xVector Engine Server
+# Copyright (c) 2012 James Buchwald
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+'''
+Replication of game object state to the players who can see it.
+
+The area of interest manager (see the Interest module) decides who sees
+what; this module decides what they are sent.  For every player in the game
+it keeps a baseline: the state of each object in view as last sent to that
+player.  Connections are TCP, so anything sent arrives, in order; the last
+state sent is the state the client has.
+
+Objects which change are only marked as changed.  A few times a second (at
+Game/Replication/TickRate) the changes are sent out: each player gets a
+single UpdateObject packet holding, for each changed object in view, only
+the fields which differ from their baseline.  An object which moves several
+times between ticks is sent once, and an object which only took a step
+costs its ID, a bitmask and one coordinate.
+
+Every Game/Replication/SnapshotInterval seconds, each player is sent every
+field of everything they can see instead, so that a client which has gone
+wrong somehow puts itself right.  The snapshots of different players fall
+at different times, as they are counted from when each player entered the
+game.
+'''
+
+import collections
+import time
+from xVLib import Packets
+from . import Metrics
+
+Fields = ((Packets.UpdateObjectPacket.Field_Sprite, 0),
+          (Packets.UpdateObjectPacket.Field_X, 1),
+          (Packets.UpdateObjectPacket.Field_Y, 2),
+          (Packets.UpdateObjectPacket.Field_Direction, 3))
+'''Field flags of UpdateObject packets, with their places in a state.'''
+
+
+def State(obj):
+    '''
+    Gets the replicated state of an object.
+    
+    @type obj: Interest.GameObject
+    @param obj: Object to read.
+    
+    @return: Tuple (sprite, x, y, direction).
+    '''
+    return (obj.Sprite, obj.X, obj.Y, obj.Direction)
+
+
+class Baseline(object):
+    '''
+    The state of the objects in a player's view, as last sent to them.
+    '''
+    
+    __slots__ = ('Player', 'States', 'NextSnapshot')
+    
+    def __init__(self, player, nextsnapshot):
+        self.Player = player
+        '''Interest.GameObject of the player.'''
+        self.States = {}
+        '''Maps object IDs to their state as last sent to the player.'''
+        self.NextSnapshot = nextsnapshot
+        '''Time at which the player is next sent a full snapshot.'''
+
+
+class Replicator(object):
+    '''
+    Sends players the objects they can see, and the changes to them.
+    '''
+    
+    def __init__(self):
+        '''
+        Creates a replicator with the default settings.
+        '''
+        # Declare settings.
+        self.TickInterval = 0.05
+        '''Seconds between rounds of updates.'''
+        self.SnapshotInterval = 30.0
+        '''Seconds between full snapshots for each player.'''
+        
+        # Declare state.
+        self.Baselines = {}
+        '''Maps the objects of players in the game to their Baselines.'''
+        self.Changed = set()
+        '''Objects which have changed since the last round of updates.'''
+        self.Snapshots = collections.deque()
+        '''Baselines in the order their next snapshots are due.'''
+        self.NextTick = 0
+        '''Time at which the next round of updates is due.'''
+    
+    def Configure(self, config):
+        '''
+        Applies the replication settings from the configuration file.
+        
+        @type config: xVLib.ConfigurationFile.ConfigurationFile
+        @param config: Handle to the main configuration file object.
+        '''
+        self.TickInterval = 1.0 / max(1, config['Game/Replication/TickRate'])
+        interval = config['Game/Replication/SnapshotInterval']
+        self.SnapshotInterval = float(max(1, interval))
+    
+    ##
+    ## Changes to what players see
+    ##
+    
+    def Add(self, player, obj):
+        '''
+        Sends a player an object which has come into view.
+        
+        @type player: Interest.GameObject
+        @param player: Object of the player.
+        
+        @type obj: Interest.GameObject
+        @param obj: Object now in view.
+        '''
+        try:
+            baseline = self.Baselines[player]
+        except KeyError:
+            # First object the player has seen, so they've just arrived.
+            due = time.time() + self.SnapshotInterval
+            baseline = Baseline(player, due)
+            self.Baselines[player] = baseline
+            self.Snapshots.append(baseline)
+        baseline.States[obj.ObjectID] = State(obj)
+        
+        packet = Packets.AddObjectPacket(player.Connection)
+        packet.ObjectID = obj.ObjectID
+        packet.ObjectType = obj.ObjectType
+        packet.Name = obj.Name
+        packet.Sprite = obj.Sprite
+        packet.X = obj.X
+        packet.Y = obj.Y
+        packet.Direction = obj.Direction
+        player.Connection.SendPacket(packet)
+    
+    def Delete(self, player, obj):
+        '''
+        Tells a player to forget an object which has gone out of view.
+        
+        @type player: Interest.GameObject
+        @param player: Object of the player.
+        
+        @type obj: Interest.GameObject
+        @param obj: Object no longer in view.
+        '''
+        self.Baselines[player].States.pop(obj.ObjectID, None)
+        packet = Packets.DeleteObjectPacket(player.Connection)
+        packet.ObjectID = obj.ObjectID
+        player.Connection.SendPacket(packet)
+    
+    def Forget(self, player):
+        '''
+        Drops the baseline of a player who has left the game.
+        
+        @type player: Interest.GameObject
+        @param player: Object of the player.
+        '''
+        self.Baselines.pop(player, None)
+    
+    def MarkChanged(self, obj):
+        '''
+        Marks an object as changed, to be sent out with the next round of
+        updates.
+        
+        @type obj: Interest.GameObject
+        @param obj: Object which has changed.
+        '''
+        self.Changed.add(obj)
+    
+    ##
+    ## Updates
+    ##
+    
+    def Tick(self):
+        '''
+        Sends out a round of updates if it's time.  Called once per main
+        loop cycle.
+        '''
+        now = time.time()
+        if now < self.NextTick:
+            return
+        self.NextTick = now + self.TickInterval
+        self.Flush(now)
+    
+    def Flush(self, now=None):
+        '''
+        Sends out a round of updates.
+        
+        @type now: float
+        @param now: Current time, if already known.
+        '''
+        if now is None:
+            now = time.time()
+        pending = {}
+        
+        # Work out what changed for whom.
+        changed = self.Changed
+        self.Changed = set()
+        baselines = self.Baselines
+        deltas = 0
+        for obj in changed:
+            if obj.Map is None:
+                continue
+            objectid = obj.ObjectID
+            state = State(obj)
+            for player in obj.Observers:
+                states = baselines[player].States
+                old = states.get(objectid)
+                if old is None or old == state:
+                    continue
+                fields = 0
+                for flag, index in Fields:
+                    if state[index] != old[index]:
+                        fields |= flag
+                states[objectid] = state
+                update = (objectid, fields) + state
+                try:
+                    pending[player].append(update)
+                except KeyError:
+                    pending[player] = [update]
+                deltas += 1
+        
+        # Replace the changes with full snapshots for anyone due one.
+        snapshots = 0
+        queue = self.Snapshots
+        full = Packets.UpdateObjectPacket.Field_All
+        while queue and queue[0].NextSnapshot <= now:
+            baseline = queue.popleft()
+            player = baseline.Player
+            if baselines.get(player) is not baseline:
+                # The player has left the game.
+                continue
+            updates = []
+            states = baseline.States
+            for obj in player.Visible:
+                state = State(obj)
+                states[obj.ObjectID] = state
+                updates.append((obj.ObjectID, full) + state)
+            deltas -= len(pending.get(player, ()))
+            pending[player] = updates
+            snapshots += len(updates)
+            baseline.NextSnapshot = now + self.SnapshotInterval
+            queue.append(baseline)
+        
+        # Send them off.
+        limit = Packets.UpdateObjectPacket.MaxUpdates
+        for player, updates in pending.iteritems():
+            conn = player.Connection
+            for start in xrange(0, len(updates), limit):
+                packet = Packets.UpdateObjectPacket(conn)
+                packet.Updates = updates[start:start + limit]
+                conn.SendPacket(packet)
+        if deltas:
+            ObjectUpdates.Labels("delta").Inc(deltas)
+        if snapshots:
+            ObjectUpdates.Labels("snapshot").Inc(snapshots)
+
+
+ObjectUpdates = Metrics.Registry.Counter("xvector_object_updates_total",
+                                         "Object updates sent to players, "
+                                         "by kind (delta or snapshot).",
+                                         ("kind",))
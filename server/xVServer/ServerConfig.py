@@ -42,6 +42,18 @@ DefaultValues = {
                  'Database/Name': u'xvector.sqlite',
                  'Database/Username': u'',
                  'Database/Password': u'',
+                 'Database/Threads': 2,
+                 'Database/Pool/Size': 5,
+                 'Database/Pool/MaxOverflow': 10,
+                 'Database/Pool/Recycle': 3600,
+                 'Database/Pool/PrePing': True,
+                 'Database/SQLite/WAL': True,
+                 'Database/SQLite/Synchronous': u'NORMAL',
+                 'Database/SQLite/MmapSize': 268435456,
+                 'Database/AccountCache/Size': 10000,
+                 'Database/AccountCache/TTL': 300,
+                 'Database/AccountCache/NegativeTTL': 30,
+                 'Database/WriteBehind/Interval': 5,
                  
                  # Resources section
                  'Resources/AutoUpdater/Enabled': False,
@@ -58,12 +70,54 @@ DefaultValues = {
                  'Network/Address/IPv6/Port': 24020,
                  'Network/Connections/Max': 50,
                  'Network/Connections/PerIP': 2,
+                 'Network/Connections/RecvBufferLimit': 131072,
+                 'Network/Connections/SendHighWater': 262144,
+                 'Network/Connections/SendLowWater': 65536,
+                 'Network/Connections/SendBufferLimit': 1048576,
+                 'Network/Connections/SlowConsumerGrace': 15,
                  'Network/Engine/UsePoll': False,
+                 'Network/Engine/ListenBacklog': 128,
+                 'Network/Admission/CycleBudget': 50,
+                 'Network/Admission/QueueLimit': 200,
+                 'Network/Admission/AcceptRate': 50,
+                 'Network/Admission/AcceptBurst': 20,
+                 'Network/Admission/OverloadAcceptRate': 2,
+                 'Network/Admission/ShedDelay': 5,
+                 'Network/TLS/Certificate': ServerGlobals.DefaultCertPath,
+                 'Network/TLS/PrivateKey': u'',
+                 'Network/TLS/HandshakeThreads': 0,
+                 'Network/TLS/HandshakeTimeout': 10,
+                 'Network/Upgrade/Enabled': False,
+                 'Network/Upgrade/Socket': ServerGlobals.DefaultUpgradePath,
+                 'Network/Upgrade/HandoffIdle': True,
+                 'Network/Upgrade/DrainTime': 30,
+                 'Network/Upgrade/Notice': u'The server is restarting.',
+                 
+                 # Game section
+                 'Game/Interest/ViewRadius': 12,
+                 'Game/Interest/CellSize': 16,
+                 'Game/Replication/TickRate': 20,
+                 'Game/Replication/SnapshotInterval': 30,
                  
                  # Logging section
                  'Logging/Directory': ServerGlobals.DefaultLogsPath,
                  'Logging/Rotator/MaxSize': 4194304,
                  'Logging/Rotator/LogCount': 10,
+                 'Logging/QueueSize': 10000,
+                 
+                 # Metrics section
+                 'Metrics/LogInterval': 300,
+                 'Metrics/HTTP/Enabled': False,
+                 'Metrics/HTTP/Interface': u'127.0.0.1',
+                 'Metrics/HTTP/Port': 24080,
+                 'Metrics/TraceHandlers': False,
+                 
+                 # Diagnostics section
+                 'Diagnostics/Watchdog/Threshold': 1000,
+                 'Diagnostics/Profiler/Rate': 100,
+                 'Diagnostics/Profiler/Duration': 30,
+                 'Diagnostics/Capture/Enabled': False,
+                 'Diagnostics/Capture/MaxSize': 100,
                  }
 '''
 Standard default values for the server configuration.
@@ -75,6 +129,20 @@ KnownTransformers = {
                       'General/ServerNewsURL': NullTransformer,
                       'General/DisableRegistration': BoolTransformer,
                       
+                      # Database section
+                      'Database/Threads': IntTransformer,
+                      'Database/Pool/Size': IntTransformer,
+                      'Database/Pool/MaxOverflow': IntTransformer,
+                      'Database/Pool/Recycle': IntTransformer,
+                      'Database/Pool/PrePing': BoolTransformer,
+                      'Database/SQLite/WAL': BoolTransformer,
+                      'Database/SQLite/Synchronous': NullTransformer,
+                      'Database/SQLite/MmapSize': IntTransformer,
+                      'Database/AccountCache/Size': IntTransformer,
+                      'Database/AccountCache/TTL': IntTransformer,
+                      'Database/AccountCache/NegativeTTL': IntTransformer,
+                      'Database/WriteBehind/Interval': IntTransformer,
+                      
                       # Resources section
                       'Resources/AutoUpdater/Enabled': BoolTransformer,
                       'Resources/AutoUpdater/URL': NullTransformer,
@@ -90,12 +158,54 @@ KnownTransformers = {
                       'Network/Address/IPv6/Port': IntTransformer,
                       'Network/Connections/Max': IntTransformer,
                       'Network/Connections/PerIP': IntTransformer,
+                      'Network/Connections/RecvBufferLimit': IntTransformer,
+                      'Network/Connections/SendHighWater': IntTransformer,
+                      'Network/Connections/SendLowWater': IntTransformer,
+                      'Network/Connections/SendBufferLimit': IntTransformer,
+                      'Network/Connections/SlowConsumerGrace': IntTransformer,
                       'Network/Engine/UsePoll': BoolTransformer,
+                      'Network/Engine/ListenBacklog': IntTransformer,
+                      'Network/Admission/CycleBudget': IntTransformer,
+                      'Network/Admission/QueueLimit': IntTransformer,
+                      'Network/Admission/AcceptRate': IntTransformer,
+                      'Network/Admission/AcceptBurst': IntTransformer,
+                      'Network/Admission/OverloadAcceptRate': IntTransformer,
+                      'Network/Admission/ShedDelay': IntTransformer,
+                      'Network/TLS/Certificate': NullTransformer,
+                      'Network/TLS/PrivateKey': NullTransformer,
+                      'Network/TLS/HandshakeThreads': IntTransformer,
+                      'Network/TLS/HandshakeTimeout': IntTransformer,
+                      'Network/Upgrade/Enabled': BoolTransformer,
+                      'Network/Upgrade/Socket': NullTransformer,
+                      'Network/Upgrade/HandoffIdle': BoolTransformer,
+                      'Network/Upgrade/DrainTime': IntTransformer,
+                      'Network/Upgrade/Notice': NullTransformer,
+                      
+                      # Game section
+                      'Game/Interest/ViewRadius': IntTransformer,
+                      'Game/Interest/CellSize': IntTransformer,
+                      'Game/Replication/TickRate': IntTransformer,
+                      'Game/Replication/SnapshotInterval': IntTransformer,
                       
                       # Logging section
                       'Logging/Directory': NullTransformer,
                       'Logging/Rotator/MaxSize': IntTransformer,
                       'Logging/Rotator/LogCount': IntTransformer,
+                      'Logging/QueueSize': IntTransformer,
+                      
+                      # Metrics section
+                      'Metrics/LogInterval': IntTransformer,
+                      'Metrics/HTTP/Enabled': BoolTransformer,
+                      'Metrics/HTTP/Interface': NullTransformer,
+                      'Metrics/HTTP/Port': IntTransformer,
+                      'Metrics/TraceHandlers': BoolTransformer,
+                      
+                      # Diagnostics section
+                      'Diagnostics/Watchdog/Threshold': IntTransformer,
+                      'Diagnostics/Profiler/Rate': IntTransformer,
+                      'Diagnostics/Profiler/Duration': IntTransformer,
+                      'Diagnostics/Capture/Enabled': BoolTransformer,
+                      'Diagnostics/Capture/MaxSize': IntTransformer,
                       }
 '''
 Standard value transforms for the server configuration.
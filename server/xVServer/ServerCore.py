@@ -21,12 +21,15 @@ Main script for the server.
 
 import sys
 import os
+import atexit
+import signal
 import logging
 import traceback
-from logging import handlers
 from xml.etree.cElementTree import ParseError
 from xVServer import ServerGlobals, MainLoop, ServerNetworking, ServerConfig
-from xVServer import Database
+from xVServer import Database, ServerTLS, Accounts, Persistence, IPBans
+from xVServer import Admission, LogQueue, Metrics, Watchdog, Profiler
+from xVServer import Memory, PacketCapture, Login, Upgrade, Interest
 from xVLib import Version
 from xVLib.ConfigurationFile import ConfigurationFile
 
@@ -62,6 +65,8 @@ class ServerApplication(object):
         '''If running in daemon mode, the path to run under.'''
         self.CreateTables = False
         '''If set to True, will try to create DB tables and then exit.'''
+        self.Takeover = False
+        '''If True, take over from a running server (see Upgrade).'''
         
         ##
         ## NT service configuration attributes (for Win32 only)
@@ -80,7 +85,15 @@ class ServerApplication(object):
         ## Runtime attributes
         ##
         self.Config = None
-        '''Main configuration values, stored as a dict.'''
+        '''
+        Main configuration values, as a xVLib.ConfigurationFile.ConfigSnapshot.
+        
+        Options can be read either as a dict or as attributes.  The snapshot
+        is replaced as a whole when the configuration is reloaded, so don't
+        hold onto it (or values from it) for longer than you need to.
+        '''
+        self.ReloadRequested = False
+        '''If True, the configuration will be reloaded on the next cycle.'''
         self.ChatLogger = None
         '''Special logger for logging chat messages.'''
         self.EarlyHandler = None
@@ -93,6 +106,8 @@ class ServerApplication(object):
         '''Main connection manager.'''
         self.Servers = []
         '''Iterable list of network server objects.'''
+        self.Handoff = None
+        '''Upgrade.Handoff from the server being replaced, while starting.'''
         
         # set up early logging support
         self.EarlyHandler = logging.StreamHandler()
@@ -179,6 +194,14 @@ class ServerApplication(object):
                         raise _EarlyServerExit
                     else:
                         nextIsValue = True
+                elif arg == "--takeover":
+                    # platform supported?
+                    if sys.platform == "win32":
+                        print "Error: --takeover not supported on Windows.\n"
+                        self.ShowCLIHelp()
+                        raise _EarlyServerExit
+                    else:
+                        self.Takeover = True
                 elif arg == "--createtables":
                     self.CreateTables = True
                 elif arg == "--service-install":
@@ -237,6 +260,7 @@ class ServerApplication(object):
             print "\t--daemon-user [user]\tUser to run daemon as."
             print "\t--daemon-pid [file]\tPID file to track daemon with."
             print "\t--daemon-path [dir]\tPath to run daemon under."
+            print "\t--takeover\t\tTake over from a running server."
         else:
             # NT service mode available
             print "\t--service-install\tInstall as an NT service."
@@ -347,38 +371,47 @@ class ServerApplication(object):
                 msg = "Failed to remove service: %s" % err[2]
     
     def ConfigureLogger(self):
-        '''Configures the logger.'''
+        '''
+        Configures the logger.
+        
+        The log files are written by a background thread (see LogQueue), so
+        logging never blocks the main loop on disk I/O.
+        '''
         # We need a format...
         format = "%(asctime)s - %(levelname)s - %(message)s"
         formatter = logging.Formatter(format)
         
-        # Configure the main logger.
+        # Set up the main log file.
         MainLogger = logging.getLogger("Server.Main")
         MainLogger.setLevel(logging.DEBUG)
         baselogpath = os.path.join(self.Config['Logging/Directory'],
                                    "main.log")
         maxbytes = self.Config['Logging/Rotator/MaxSize']
         maxlogs = self.Config['Logging/Rotator/LogCount']
-        MainHandler = handlers.RotatingFileHandler(baselogpath,
-                                                   maxBytes=maxbytes,
-                                                   backupCount=maxlogs)
+        MainHandler = LogQueue.BufferedRotatingFileHandler(baselogpath,
+                maxBytes=maxbytes, backupCount=maxlogs)
         MainHandler.setFormatter(formatter)
         MainFilter = logging.Filter("Server.Main")
         MainHandler.addFilter(MainFilter)
-        MainLogger.addHandler(MainHandler)
         
-        # Configure the chat logger.
+        # Set up the chat log file.
         ChatLogger = logging.getLogger("Server.Chat")
         ChatLogger.setLevel(logging.INFO)
         chatlogpath = os.path.join(self.Config['Logging/Directory'], 
                                    "chat.log")
-        ChatHandler = handlers.RotatingFileHandler(chatlogpath,
-                                                   maxBytes=maxbytes,
-                                                   backupCount=maxlogs)
+        ChatHandler = LogQueue.BufferedRotatingFileHandler(chatlogpath,
+                maxBytes=maxbytes, backupCount=maxlogs)
         ChatFilter = logging.Filter("Server.Chat")
         ChatHandler.addFilter(ChatFilter)
         ChatHandler.setFormatter(formatter)
-        ChatLogger.addHandler(ChatHandler)
+        
+        # Feed both loggers to the writer thread.
+        queuesize = self.Config['Logging/QueueSize']
+        QueueHandler = LogQueue.StartLogging([MainHandler, ChatHandler],
+                                             queuesize)
+        atexit.register(LogQueue.StopLogging)
+        MainLogger.addHandler(QueueHandler)
+        ChatLogger.addHandler(QueueHandler)
     
     def GoDaemon(self, user):
         '''
@@ -450,9 +483,13 @@ class ServerApplication(object):
         try:
             # IPv4 and IPv6 use independent server objects
             if self.Config['Network/Address/IPv4/Enabled']:
-                self.Servers.append(ServerNetworking.IPv4Server())
+                port = self.Config['Network/Address/IPv4/Port']
+                sock = self.TakeListener("ipv4", port)
+                self.Servers.append(ServerNetworking.IPv4Server(sock))
             if self.Config['Network/Address/IPv6/Enabled']:
-                self.Servers.append(ServerNetworking.IPv6Server())
+                port = self.Config['Network/Address/IPv6/Port']
+                sock = self.TakeListener("ipv6", port)
+                self.Servers.append(ServerNetworking.IPv6Server(sock))
             
             # Make sure that there's at least one operational server object
             if len(self.Servers) < 1:
@@ -471,9 +508,72 @@ class ServerApplication(object):
             mainlog.critical(msg)
             raise _EarlyServerExit
     
+    def TakeListener(self, kind, port=None):
+        '''
+        Takes a listening socket from the server being replaced, if there is
+        one (see Upgrade.Handoff.TakeListener()).
+        
+        @return: The socket, or None to create a new one.
+        '''
+        if self.Handoff is None:
+            return None
+        return self.Handoff.TakeListener(kind, port)
+    
+    def TakeOver(self):
+        '''
+        Takes over from the server being replaced once this one is ready.
+        
+        The old server lets go of the handed over sockets and starts draining
+        its players, who reconnect to this one.
+        
+        @raise _EarlyServerExit: Raised if the old server didn't let go, in
+        which case this one has let go of everything instead.
+        '''
+        handoff = self.Handoff
+        self.Handoff = None
+        count = handoff.AdoptConnections()
+        try:
+            handoff.Finish()
+        except Upgrade.HandoffFailed as err:
+            msg = "Could not take over from server process %s: %s"
+            mainlog.critical(msg % (handoff.OldPid, err))
+            self.AbandonTakeOver()
+            raise _EarlyServerExit
+        
+        # The old server has stopped waiting on us, so the accounts can be
+        # loaded now.  No packets are handled until the main loop starts.
+        try:
+            tokens = Login.ImportTokens(handoff.Tokens)
+        except Exception as err:
+            # Players will have to log in again, but that's all.
+            msg = "Could not take over the login tokens: %s" % err
+            mainlog.error(msg)
+            tokens = 0
+        args = (count, tokens, handoff.OldPid)
+        msg = "Took over the listening sockets, %i connections and %i login "
+        msg += "tokens from server process %s."
+        mainlog.info(msg % args)
+    
+    def AbandonTakeOver(self):
+        '''
+        Lets go of everything taken over from the server being replaced,
+        which is still serving it, after the takeover has failed.
+        '''
+        for conn in list(self.Connections.ConnectionSet):
+            conn.HandOver()
+        for server in self.Servers:
+            server.close()
+        self.Servers = []
+        Metrics.StopEndpoint()
+        Upgrade.StopListener(unlink=False)
+    
     def CleanupNetwork(self):
         '''Cleans up after the network.'''
-        pass    # TODO: Implement
+        # TODO: Close the connections and servers.
+        Upgrade.StopListener()
+        Metrics.StopEndpoint()
+        PacketCapture.StopCapture()
+        ServerTLS.CleanupTLS()
 
     def Run(self):
         '''Runs the application.'''        
@@ -490,25 +590,92 @@ class ServerApplication(object):
             # bail out
             return -1
         
-    def _Run_Core(self):
-        '''Runs the main part of the application.'''
-        # okay, now let's try loading the main configuration file
+    def LoadConfig(self):
+        '''
+        Loads the main configuration file and takes a snapshot of it.
+        
+        @return: The new snapshot, or None if the file could not be loaded.
+        '''
         transformers = ServerConfig.KnownTransformers
         try:
-            self.Config = ConfigurationFile(self.ConfigFilePath,
-                                        defaults=ServerConfig.DefaultValues,
-                                        transformers=transformers)
+            config = ConfigurationFile(self.ConfigFilePath,
+                                       defaults=ServerConfig.DefaultValues,
+                                       transformers=transformers)
+            return config.Snapshot()
         except IOError as err:
             # file i/o error
             args = (self.ConfigFilePath, err[1])
             msg = "Error reading configuration file %s: %s." % args
             mainlog.critical(msg)
-            return -1
+            return None
         except ParseError as err:
             # syntax error
             args = (self.ConfigFilePath, err)
             msg = "In configuration file %s: %s." % args
             mainlog.critical(msg)
+            return None
+        except ValueError as err:
+            # bad option value
+            args = (self.ConfigFilePath, err)
+            msg = "In configuration file %s: %s." % args
+            mainlog.critical(msg)
+            return None
+    
+    def ApplyConfig(self):
+        '''
+        Passes the current configuration to the subsystems that keep their
+        own copies of settings.
+        '''
+        Admission.InitAdmission(self.Config)
+        Accounts.ConfigureCache(self.Config)
+        Persistence.InitPersistence(self.Config)
+        Metrics.InitMetrics(self.Config)
+        Watchdog.InitWatchdog(self.Config)
+        Profiler.InitProfiler(self.Config)
+        PacketCapture.InitCapture(self.Config)
+        Interest.InitInterest(self.Config)
+    
+    def ReloadConfig(self):
+        '''
+        Reloads the main configuration file while the server is running.
+        
+        The new settings replace the old ones all at once.  If the file can't
+        be loaded, the old settings stay in effect.  Network addresses, the
+        database and TLS settings are only read at startup, so changes to
+        them still need a restart.
+        '''
+        mainlog.info("Reloading configuration file %s." % self.ConfigFilePath)
+        config = self.LoadConfig()
+        if config is None:
+            mainlog.error("Keeping the old configuration.")
+            return
+        self.Config = config
+        self.ApplyConfig()
+        mainlog.info("Configuration reloaded.")
+    
+    def PollReload(self):
+        '''
+        Reloads the configuration if a reload was requested.
+        
+        This should be called once per cycle of the main loop.
+        '''
+        if self.ReloadRequested:
+            self.ReloadRequested = False
+            self.ReloadConfig()
+    
+    def _OnSIGHUP(self, signum, frame):
+        '''
+        Signal handler which requests a configuration reload.
+        
+        The reload itself happens on the main loop, not in the handler.
+        '''
+        self.ReloadRequested = True
+    
+    def _Run_Core(self):
+        '''Runs the main part of the application.'''
+        # okay, now let's try loading the main configuration file
+        self.Config = self.LoadConfig()
+        if self.Config is None:
             return -1
         
         # configure the logger
@@ -526,18 +693,72 @@ class ServerApplication(object):
             Database.CreateTables()
             return 0
         
+        # load the IP ban index
+        try:
+            count = IPBans.LoadBans()
+        except Exception as err:
+            msg = "Could not load IP bans: %s" % err
+            mainlog.critical(msg)
+            return -1
+        mainlog.info("Loaded %i IP bans." % count)
+        
+        # configure the subsystems and start the database workers
+        self.ApplyConfig()
+        Database.StartExecutor(self.Config)
+        
+        # set up the TLS layer
+        try:
+            ServerTLS.InitTLS(self.Config)
+        except ServerTLS.TLSStartupError:
+            # bail out
+            return -1
+        
+        # ask the running server to hand over, if we're replacing it
+        if self.Takeover:
+            try:
+                self.Handoff = Upgrade.RequestHandoff(self.Config)
+            except Upgrade.HandoffFailed as err:
+                msg = "Could not take over from the running server: %s" % err
+                mainlog.critical(msg)
+                return -1
+        
         # set up the network
         try:
             self.InitNetwork()
         except _EarlyServerExit:
-            # bail out
+            # bail out, leaving the running server alone
+            if self.Handoff is not None:
+                self.Handoff.Abort("the new server could not start")
             return -1
+        Metrics.StartEndpoint(self.Config, self.TakeListener("metrics"))
+        Upgrade.StartListener(self.Config, self.TakeListener("control"))
+        if self.Handoff is not None:
+            try:
+                self.TakeOver()
+            except _EarlyServerExit:
+                # bail out, leaving the running server alone
+                return -1
+        
+        # reload the configuration on SIGHUP (where there is one)
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, self._OnSIGHUP)
+        
+        # take a profile on SIGUSR1 and a memory report on SIGUSR2
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, Profiler.RequestProfile)
+        if hasattr(signal, "SIGUSR2"):
+            signal.signal(signal.SIGUSR2, Memory.RequestReport)
         
         # enter the main loop
+        Watchdog.StartWatchdog()
         MainLoop.MainLoop()
         
         # clean up
+        Watchdog.StopWatchdog()
         self.CleanupNetwork()
+        Database.StopExecutor()
+        Persistence.FlushNow()
+        LogQueue.StopLogging()
         logging.shutdown()
         
         # exit successfully
@@ -38,7 +38,11 @@ if sys.platform == "win32":
     # Windows default paths
     DefaultConfigPath = "ServerConfig.xml"
     DefaultLogsPath = "logs"
+    DefaultCertPath = "defaultcert.pem"
+    DefaultUpgradePath = ""
 else:
     # Assuming a POSIX-style system (Linux, etc.)
     DefaultConfigPath = "/etc/xvector/ServerConfig.xml"
     DefaultLogsPath = "/var/log/xvector"
+    DefaultCertPath = "/etc/xvector/defaultcert.pem"
+    DefaultUpgradePath = "/var/run/xvector/upgrade.sock"
@@ -25,10 +25,14 @@ import logging
 import traceback
 import asyncore
 import socket
+import ssl
 import sys
+import time
 
-from xVLib import Networking
-from . import ServerGlobals, IPBans, ConnectionNegotiation, Login
+from xVLib import Networking, Packets
+from . import ServerGlobals, IPBans, ConnectionNegotiation, Login, ServerTLS
+from . import Admission, Metrics, PacketCapture, Game
+from .ServerPacketRouter import BaseServerPacketRouter, GetRouter
 
 # stuff we use later
 mainlog = logging.getLogger("Server.Main")
@@ -68,14 +72,41 @@ class ServerConnection(Networking.BaseConnectionHandler):
         State_Negotiate: ConnectionNegotiation.ConnectionNegotiationRouter,
         State_WaitForLogin: Login.WaitForLoginRouter,
         State_Login: Login.LoginRouter,
-        State_CharacterSelect: None,                # TODO: Implement
-        State_CharacterCreate: None,                # TODO: Implement
-        State_Game: None,                           # TODO: Implement
+        State_CharacterSelect: BaseServerPacketRouter,    # TODO: Implement
+        State_CharacterCreate: BaseServerPacketRouter,    # TODO: Implement
+        State_Game: Game.GameRouter,
     }
     '''
-    Maps connection states to their packet router classes.
+    Maps connection states to their packet router classes.  Connections share
+    a single router of each class.
     '''
     
+    ##
+    ## Initial connection state (see Networking.BaseConnectionHandler).
+    ##
+    
+    # Account management attributes.
+    _Account = None
+    '''Account associated with this connection.'''
+    
+    # Login state tracking attributes.
+    LoginChallenge = None
+    '''Login challenge for the current login attempt.'''
+    LastLogin = 0
+    '''Time of the last login attempt.'''
+    LoginPending = False
+    '''If True, a login or registration is waiting on the database.'''
+    LoginToken = None
+    '''Login token issued to this connection, if logged in.'''
+    
+    # TLS state tracking attributes.
+    _HandshakeOffloaded = False
+    '''If True, a worker thread owns the socket for a TLS handshake.'''
+    
+    # Game state tracking attributes.
+    GameObject = None
+    '''Interest.GameObject of the character being played, if in the game.'''
+    
     def __init__(self, sock=None):
         '''
         Creates a new server-side connection handler.
@@ -86,27 +117,25 @@ class ServerConnection(Networking.BaseConnectionHandler):
         # Inherit base class behavior
         Networking.BaseConnectionHandler.__init__(self, sock)
         
+        # Apply the flow control limits.
+        App = ServerGlobals.Application
+        Limits = App.Config.Network.Connections
+        self.RecvBufferLimit = Limits.RecvBufferLimit
+        self.SendHighWater = Limits.SendHighWater
+        self.SendLowWater = Limits.SendLowWater
+        self.SendBufferLimit = Limits.SendBufferLimit
+        self.SlowConsumerGrace = Limits.SlowConsumerGrace
+        
         # Set the initial state.
         self.State = self.State_Negotiate
         '''Current state.'''
-        self.Router = self.StateRouters[self.State]()
-        '''Current packet router.'''
-        print "[debug] self.Router = %s" % self.Router
-        
-        # Declare account management attributes.
-        self._Account = None
-        '''Account associated with this connection.'''
-        
-        # Login state tracking attributes.
-        self.LoginChallenge = None
-        '''Login challenge for the current login attempt.'''
-        self.LastLogin = 0
-        '''Time of the last login attempt.'''
+        self.Router = GetRouter(self.StateRouters[self.State])
+        '''Current packet router, shared with other connections.'''
         
         # Register the connection.
         msg = "New connection from %s." % self.Address[0]
         mainlog.info(msg)
-        App = ServerGlobals.Application
+        PacketCapture.Attach(self)
         try:
             App.Connections.AddConnection(self)
         except ConnectionLimitExceeded:
@@ -118,7 +147,7 @@ class ServerConnection(Networking.BaseConnectionHandler):
         self.State = newstate
         
         # Adjust the packet router.
-        self.Router = self.StateRouters[newstate]()
+        self.Router = GetRouter(self.StateRouters[newstate])
     
     ##
     ## connection information properties
@@ -143,6 +172,9 @@ class ServerConnection(Networking.BaseConnectionHandler):
         '''Old-style class setter for the associated account.'''
         self._Account = newaccount
     
+    Account = property(GetAccount, SetAccount)
+    '''Account associated with this connection.'''
+    
     ##
     ## reimplemented methods from Networking.BaseConnectionHandler
     ##
@@ -155,7 +187,33 @@ class ServerConnection(Networking.BaseConnectionHandler):
         special.  This is essentially just a routing method.
         '''
         # Hand it off to the router.
-        self.Router.HandlePacket(packet)
+        if not Metrics.TraceHandlers:
+            self.Router.HandlePacket(packet)
+            return
+        
+        # Time the handler while we're at it.
+        start = time.time()
+        try:
+            self.Router.HandlePacket(packet)
+        finally:
+            elapsed = time.time() - start
+            name = type(packet).__name__
+            Metrics.HandlerTime.Labels(name).Observe(elapsed)
+    
+    def OnPacketSent(self, packet, size):
+        # Count the packet.
+        name = type(packet).__name__
+        Metrics.PacketsOut.Labels(name).Inc()
+        Metrics.BytesOut.Labels(name).Inc(size)
+        if packet.BodySize:
+            Metrics.BodyBytes.Labels("raw").Inc(packet.BodySize)
+            Metrics.BodyBytes.Labels("wire").Inc(size - Packets.HeaderSize)
+    
+    def OnPacketDecoded(self, packet, size):
+        # Count the packet.
+        name = type(packet).__name__
+        Metrics.PacketsIn.Labels(name).Inc()
+        Metrics.BytesIn.Labels(name).Inc(size)
     
     def OnCorruptPacket(self):
         # Log an error message.
@@ -174,6 +232,24 @@ class ServerConnection(Networking.BaseConnectionHandler):
         # Close the connection.
         self.close()
     
+    def OnRecvOverflow(self):
+        # Log the event.
+        msg = "%s - Receive buffer limit exceeded." % self.Address[0]
+        mainlog.warning(msg)
+        
+        # Close the connection.
+        self.close()
+    
+    def OnSlowConsumer(self):
+        # Log the event.
+        args = (self.Address[0], len(self.out_buffer))
+        msg = "%s - Client stopped reading, dropping %i unsent bytes." % args
+        mainlog.warning(msg)
+        
+        # Throw away the backlog and close the connection.
+        self.out_buffer = b""
+        self.close()
+    
     ##
     ## low-level asyncore callbacks
     ##
@@ -198,16 +274,111 @@ class ServerConnection(Networking.BaseConnectionHandler):
     ## crypto stuff
     ##
     
-    def WrapTLS(self):
+    def OnNegotiateTLS(self):
+        '''
+        Reimplemented from xVLib.Networking.BaseConnectionHandler.
+        
+        Any plaintext still in the send buffer has to reach the client before
+        the TLS layer goes up, so the socket isn't wrapped here; that happens
+        in _PushTLSHandshake() once the send buffer has been flushed.
+        '''
+        pass
+    
+    def _PushTLSHandshake(self):
+        '''
+        Extends the base class to wrap the socket and offload the handshake.
+        '''
+        if self._NegotiateTLS and not isinstance(self.socket, ssl.SSLSocket):
+            # Start the handshake.
+            self.socket = ServerTLS.WrapSocket(self.socket)
+            
+            # Hand the handshake off to a worker if we have any.
+            if ServerTLS.Workers:
+                self.del_channel()
+                self._HandshakeOffloaded = True
+                ServerTLS.OffloadHandshake(self)
+                return
+        
+        # Run the handshake on the main loop.
+        Networking.BaseConnectionHandler._PushTLSHandshake(self)
+    
+    def OnOffloadedHandshake(self, error):
+        '''
+        Called on the main loop when a worker thread finishes a handshake.
+        
+        @type error: string
+        @param error: Error message if the handshake failed, None otherwise.
+        '''
+        if not self._HandshakeOffloaded:
+            # Closed while the worker had it; nothing to do.
+            return
+        self._HandshakeOffloaded = False
+        
+        # Give the socket back to the main loop.
+        self._fileno = self.socket.fileno()
+        self.add_channel()
+        
+        # Did it work?
+        if error:
+            msg = "%s - TLS handshake failed: %s" % (self.Address[0], error)
+            mainlog.info(msg)
+            self.close()
+            return
+        self._FinishTLSNegotiation()
+    
+    ##
+    ## server upgrades
+    ##
+    
+    def CanHandOver(self):
+        '''
+        Checks whether the connection can be taken over by a new server
+        process (see the Upgrade module).
+        
+        Only connections which haven't logged in and have nothing in flight
+        are handed over; anything else would lose state that lives in this
+        process.
         '''
-        Encrypts the connection in a TLS layer.
+        if self.State not in (self.State_Negotiate, self.State_WaitForLogin):
+            return False
+        if self.IsEncrypted or self._NegotiateTLS or self._DenegotiateTLS:
+            return False
+        if self._HandshakeOffloaded or self.LoginPending:
+            return False
+        if self.RecvBuffer or self.out_buffer:
+            return False
+        return self.connected
+    
+    def HandOver(self):
         '''
+        Lets go of a connection which a new server process has taken over.
         
+        Only this process's copy of the socket is closed; the connection
+        itself stays open in the new process.
+        '''
+        msg = "%s - Connection handed over." % self.Address[0]
+        mainlog.info(msg)
+        App = ServerGlobals.Application
+        try:
+            App.Connections.RemoveConnection(self)
+        except UnregisteredConnection:
+            pass
+        PacketCapture.Detach(self)
+        asyncore.dispatcher.close(self)
     
     ##
     ## reimplemented methods from asyncore.dispatcher
     ##
     
+    def readable(self):
+        '''
+        Extends the base class to hold off on connections which haven't
+        logged in while the server is overloaded.
+        '''
+        if Admission.Controller.IsDeferred(self):
+            return False
+        return Networking.BaseConnectionHandler.readable(self)
+    
     def close(self):
         '''
         Closes the socket and cleans up.
@@ -225,6 +396,18 @@ class ServerConnection(Networking.BaseConnectionHandler):
         except UnregisteredConnection:
             pass
         
+        # Abandon any handshake in progress on a worker thread.
+        self._HandshakeOffloaded = False
+        
+        # Take the character out of the game.
+        Game.LeaveGame(self)
+        
+        # Keep the login token alive briefly in case the client reconnects.
+        Login.ReleaseToken(self)
+        
+        # Finish off the connection's packet capture.
+        PacketCapture.Detach(self)
+        
         # Inherit base class behavior.
         asyncore.dispatcher_with_send.close(self)
 
@@ -289,14 +472,17 @@ class ConnectionManager(object):
         
         # Make sure the connection's IP isn't banned.
         addr = conn.Address
-        if IPBans.IsBanned(addr[0]):
+        start = time.time()
+        banned = IPBans.IsBanned(addr[0])
+        Metrics.BanCheckTime.Observe(time.time() - start)
+        if banned:
             msg = "%s - IP is banned, rejecting connection." % addr[0]
             mainlog.info(msg)
             raise BannedIPAddress
         
         # now register the connection
         App = ServerGlobals.Application
-        maxtotal = App.Config['Network/Connections/Max']
+        maxtotal = App.Config.Network.Connections.Max
         if len(self.ConnectionSet) > maxtotal:
             # Total connection limit exceeded
             msg = "Too many total connections, rejecting from %s." % addr[0]
@@ -305,7 +491,7 @@ class ConnectionManager(object):
         self.ConnectionSet.add(conn)
         
         # check the address
-        maxip = App.Config['Network/Connections/PerIP']
+        maxip = App.Config.Network.Connections.PerIP
         if addr[0] in self.AddressConnectCount:
             if self.AddressConnectCount[addr[0]] > maxip:
                 # Per-IP connection limit exceeded.
@@ -450,10 +636,36 @@ class NetworkServer(asyncore.dispatcher):
     subclasses, either IPv4Server or IPv6Server.
     '''
     
-    def __init__(self):
-        '''Creates the network server and starts listening for connections.'''
+    def __init__(self, sock=None):
+        '''
+        Creates the network server.
+        
+        @type sock: socket
+        @param sock: Listening socket taken over from the server process
+        being replaced (see the Upgrade module), or None if the subclass
+        creates its own.
+        '''
         # Inherit base class behavior
         asyncore.dispatcher.__init__(self)
+        
+        # Pick up where the old process left off.
+        if sock is not None:
+            sock.setblocking(0)
+            self.set_socket(sock)
+            self.accepting = True
+            self.addr = sock.getsockname()
+    
+    def readable(self):
+        '''
+        Only check for new connections when admission control allows one.
+        
+        Connections we aren't ready for wait in the listen backlog.
+        '''
+        return Admission.Controller.CanAccept()
+    
+    def writable(self):
+        '''Listening sockets are never written to.'''
+        return False
     
     def handle_accept(self):
         '''Called when a client is trying to connect.'''
@@ -470,6 +682,7 @@ class NetworkServer(asyncore.dispatcher):
             return
         
         # wrap the connection
+        Admission.Controller.Accepted()
         sock = pair[0]
         conn = ServerConnection(sock)
     
@@ -486,9 +699,12 @@ class IPv4Server(NetworkServer):
     Network server class for IPv4 connections.
     '''
     
-    def __init__(self):
+    def __init__(self, sock=None):
         # inherit base class behavior
-        NetworkServer.__init__(self)
+        NetworkServer.__init__(self, sock)
+        if sock is not None:
+            # already listening
+            return
         
         # create the listening socket
         App = ServerGlobals.Application
@@ -511,7 +727,7 @@ class IPv4Server(NetworkServer):
             mainlog.critical(msg)
             raise NetworkStartupError
         try:
-            self.listen(5)
+            self.listen(App.Config['Network/Engine/ListenBacklog'])
         except socket.error as err:
             msg = "Could not listen on listening socket: %s" % err.args[1]
             mainlog.critical(msg)
@@ -532,9 +748,12 @@ class IPv6Server(NetworkServer):
     information, please see http://bugs.python.org/issue6926.
     '''
     
-    def __init__(self):
+    def __init__(self, sock=None):
         # inherit base class behavior
-        NetworkServer.__init__(self)
+        NetworkServer.__init__(self, sock)
+        if sock is not None:
+            # already listening
+            return
         
         # create the listening socket
         App = ServerGlobals.Application
@@ -567,7 +786,7 @@ class IPv6Server(NetworkServer):
             mainlog.critical(msg)
             raise NetworkStartupError
         try:
-            self.listen(5)
+            self.listen(App.Config['Network/Engine/ListenBacklog'])
         except socket.error as err:
             msg = "Could not listen on listening socket: %s" % err.args[1]
             mainlog.critical(msg)
@@ -582,10 +801,41 @@ def PollNetwork():
     '''
     # Figure out what we're doing
     App = ServerGlobals.Application
-    usepoll = App.Config['Network/Engine/UsePoll']
+    usepoll = App.Config.Network.Engine.UsePoll
     
     # Poll the network
     asyncore.loop(timeout=0, count=1, use_poll=usepoll)
     
     # Check for timed-out connections
     App.Connections.ScanForTimeouts()
+
+
+StateNames = {
+    ServerConnection.State_Negotiate: "negotiate",
+    ServerConnection.State_WaitForLogin: "wait_for_login",
+    ServerConnection.State_Login: "login",
+    ServerConnection.State_CharacterSelect: "character_select",
+    ServerConnection.State_CharacterCreate: "character_create",
+    ServerConnection.State_Game: "game",
+}
+'''Maps connection states to the names used in the metrics.'''
+
+
+def CountConnections():
+    '''
+    Counts the open connections in each state.
+    
+    @return: Dict mapping 1-tuples of state names to connection counts.
+    '''
+    counts = dict(((name,), 0) for name in StateNames.itervalues())
+    App = ServerGlobals.Application
+    if App is None or App.Connections is None:
+        return counts
+    for conn in App.Connections.ConnectionSet:
+        counts[(StateNames[conn.State],)] += 1
+    return counts
+
+
+Metrics.Registry.GaugeFunction("xvector_connections",
+                               "Open connections, by connection state.",
+                               CountConnections, ("state",))
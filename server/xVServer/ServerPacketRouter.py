@@ -42,7 +42,7 @@ def PacketRejector(packet):
     packet.Connection.close()
 
 
-def KeepAliveHandler(self, packet):
+def KeepAliveHandler(packet):
     '''
     Packet handler for the KeepAlive packet type.
     
@@ -61,11 +61,25 @@ def KeepAliveHandler(self, packet):
     packet.Connection.SendPacket(reply)
 
 
+def DisconnectHandler(packet):
+    '''
+    Packet handler for the Disconnect packet type.
+    
+    The client is leaving, so we close our end of the connection.
+    
+    @type packet: xVLib.Packets.DisconnectPacket
+    @param packet: Packet to handle.
+    '''
+    packet.Connection.close()
+
+
 class BaseServerPacketRouter(Packets.PacketRouter):
     '''
     Base server packet router.  This automatically rejects all packets.
     
-    Subclass this to create state-specific packet routers.
+    Subclass this to create state-specific packet routers.  A single router
+    of each class is shared by every connection (see GetRouter()), so routers
+    must not keep any per-connection state; that belongs on the connection.
     '''
     
     def __init__(self):
@@ -77,3 +91,26 @@ class BaseServerPacketRouter(Packets.PacketRouter):
         
         # Create our keep-alive handler.
         self.Handlers[Packets.KeepAlive] = KeepAliveHandler
+        self.Handlers[Packets.Disconnect] = DisconnectHandler
+
+
+_Routers = {}
+'''Shared router instances, by router class.'''
+
+
+def GetRouter(routerclass):
+    '''
+    Gets the shared instance of a packet router class, creating it the first
+    time it is needed.
+    
+    @type routerclass: class
+    @param routerclass: Subclass of BaseServerPacketRouter.
+    
+    @return: The router shared by every connection using this class.
+    '''
+    try:
+        return _Routers[routerclass]
+    except KeyError:
+        router = routerclass()
+        _Routers[routerclass] = router
+        return router
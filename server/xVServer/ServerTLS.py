@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+
+# xVector Engine Server
+# Copyright (c) 2012 James Buchwald
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+'''
+TLS support for the server.
+
+Every connection is wrapped using a single shared SSL context.  OpenSSL keeps
+its server-side session cache and session ticket keys in the context, so a
+client that reconnects shortly after dropping can resume its previous session
+instead of going through a full handshake.
+
+The handshake itself can optionally be moved off of the main loop.  While a
+connection is handshaking on a worker thread it is removed from the asyncore
+map, so the main loop never touches its socket; the worker posts the result
+back to the main loop when the handshake finishes.
+'''
+
+import ssl
+import socket
+import select
+import threading
+import logging
+import time
+import Queue
+from . import Callbacks
+
+mainlog = logging.getLogger("Server.Main")
+
+
+Context = None
+'''Shared server-side SSL context.'''
+
+Workers = []
+'''Handshake worker threads.  Empty if handshakes are run on the main loop.'''
+
+_NextWorker = 0
+'''Index of the worker thread which will receive the next handshake.'''
+
+
+class TLSStartupError(Exception): pass
+'''Raised if the TLS layer cannot be initialized.'''
+
+
+class HandshakeWorker(threading.Thread):
+    '''
+    Background thread which performs TLS handshakes for many connections.
+    
+    Each worker runs its own select() loop over the connections it has been
+    given, so a single worker can handle a large number of handshakes at once.
+    '''
+    
+    PollInterval = 0.05
+    '''Maximum number of seconds to wait in select() between checks.'''
+    
+    def __init__(self, timeout):
+        '''
+        Creates a new handshake worker.  Call start() to run it.
+        
+        @type timeout: number
+        @param timeout: Number of seconds a handshake may take before failing.
+        '''
+        # Inherit base class behavior.
+        threading.Thread.__init__(self, name="TLSHandshakeWorker")
+        self.daemon = True
+        
+        # Declare attributes.
+        self.Timeout = timeout
+        '''Number of seconds a handshake may take before failing.'''
+        self.Incoming = Queue.Queue()
+        '''Queue of connections submitted by the main loop.'''
+        self.Running = True
+        '''Set to False to stop the worker.'''
+    
+    def Submit(self, conn):
+        '''
+        Hands a connection to the worker.  Called from the main loop.
+        
+        @type conn: xVServer.ServerNetworking.ServerConnection
+        @param conn: Connection with a wrapped, unhandshaken socket.
+        '''
+        self.Incoming.put(conn)
+    
+    def Stop(self):
+        '''
+        Asks the worker to stop.  Pending handshakes are abandoned.
+        '''
+        self.Running = False
+    
+    def run(self):
+        '''
+        Main loop of the worker thread.
+        '''
+        pending = {}
+        while self.Running:
+            # Pick up any new handshakes.
+            try:
+                if not pending:
+                    # Nothing to do, so wait for something to come in.
+                    conn = self.Incoming.get(timeout=self.PollInterval)
+                    self._Push(conn, pending, time.time() + self.Timeout)
+                while 1:
+                    conn = self.Incoming.get_nowait()
+                    self._Push(conn, pending, time.time() + self.Timeout)
+            except Queue.Empty:
+                pass
+            if not pending:
+                continue
+            
+            # Wait for the sockets to become ready.
+            readers = []
+            writers = []
+            for conn, (deadline, wantwrite) in pending.iteritems():
+                if wantwrite:
+                    writers.append(conn.socket)
+                else:
+                    readers.append(conn.socket)
+            try:
+                ready = select.select(readers, writers, [], self.PollInterval)
+                ready = set(ready[0]) | set(ready[1])
+            except (select.error, socket.error, ValueError):
+                # One of the sockets was closed out from under us; try them
+                # all and let the failures sort themselves out.
+                ready = set(readers) | set(writers)
+            
+            # Continue the handshakes.
+            now = time.time()
+            for conn in pending.keys():
+                deadline = pending[conn][0]
+                if conn.socket in ready:
+                    self._Push(conn, pending, deadline)
+                elif now > deadline:
+                    del pending[conn]
+                    self._Finish(conn, "handshake timed out")
+    
+    def _Push(self, conn, pending, deadline):
+        '''
+        Continues the handshake on a single connection.
+        '''
+        try:
+            conn.socket.do_handshake()
+        except ssl.SSLError as err:
+            if err.args[0] == ssl.SSL_ERROR_WANT_READ:
+                pending[conn] = (deadline, False)
+                return
+            elif err.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                pending[conn] = (deadline, True)
+                return
+            pending.pop(conn, None)
+            self._Finish(conn, str(err))
+            return
+        except Exception as err:
+            pending.pop(conn, None)
+            self._Finish(conn, str(err))
+            return
+        
+        # Handshake complete.
+        pending.pop(conn, None)
+        self._Finish(conn, None)
+    
+    def _Finish(self, conn, error):
+        '''
+        Reports a finished handshake back to the main loop.
+        '''
+        Callbacks.PostCallback(conn.OnOffloadedHandshake, error)
+
+
+def InitTLS(config):
+    '''
+    Creates the shared SSL context and starts any handshake workers.
+    
+    @type config: xVLib.ConfigurationFile.ConfigurationFile
+    @param config: Handle to the main configuration file object.
+    
+    @raise TLSStartupError: Raised if the certificate can't be loaded.
+    '''
+    global Context
+    
+    # Set up the context.
+    ctx = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    ctx.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3
+    ctx.options |= ssl.OP_NO_COMPRESSION
+    certfile = config['Network/TLS/Certificate']
+    keyfile = config['Network/TLS/PrivateKey'] or None
+    try:
+        ctx.load_cert_chain(certfile, keyfile)
+    except (IOError, ssl.SSLError) as err:
+        msg = "Could not load TLS certificate %s: %s" % (certfile, err)
+        mainlog.critical(msg)
+        raise TLSStartupError
+    Context = ctx
+    
+    # Start the handshake workers.
+    threads = config['Network/TLS/HandshakeThreads']
+    timeout = config['Network/TLS/HandshakeTimeout']
+    for i in range(threads):
+        worker = HandshakeWorker(timeout)
+        worker.start()
+        Workers.append(worker)
+
+
+def CleanupTLS():
+    '''
+    Stops any handshake workers.
+    '''
+    for worker in Workers:
+        worker.Stop()
+    for worker in Workers:
+        worker.join()
+    del Workers[:]
+
+
+def WrapSocket(sock):
+    '''
+    Wraps a connected socket for a server-side TLS handshake.
+    
+    The handshake is not started; it must be driven by the caller, either by
+    the connection's I/O callbacks or by OffloadHandshake().
+    
+    @type sock: socket
+    @param sock: Non-blocking socket to wrap.
+    
+    @return: The wrapped ssl.SSLSocket.
+    '''
+    return Context.wrap_socket(sock, server_side=True,
+                               do_handshake_on_connect=False)
+
+
+def OffloadHandshake(conn):
+    '''
+    Hands a connection's handshake to a worker thread, if there are any.
+    
+    The caller must remove the connection from the asyncore map first.  When
+    the handshake finishes, conn.OnOffloadedHandshake(error) is called on the
+    main loop, with error set to None on success.
+    
+    @type conn: xVServer.ServerNetworking.ServerConnection
+    @param conn: Connection with a wrapped, unhandshaken socket.
+    
+    @return: True if a worker took the handshake, False otherwise.
+    '''
+    global _NextWorker
+    if not Workers:
+        return False
+    worker = Workers[_NextWorker % len(Workers)]
+    _NextWorker += 1
+    worker.Submit(conn)
+    return True
+
+
+def SessionStats():
+    '''
+    Gets the session cache statistics for the shared context.
+    
+    The "hits" count is the number of handshakes that resumed an earlier
+    session rather than doing a full key exchange.
+    
+    @return: dict of statistics, as returned by SSLContext.session_stats().
+    '''
+    if Context is None:
+        return {}
+    return Context.session_stats()
@@ -0,0 +1,589 @@
+# -*- coding: utf-8 -*-
+
+# xVector Engine Server
+# Copyright (c) 2012 James Buchwald
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+'''
+Zero-downtime restarts.
+
+A new server process can take over from a running one without the listening
+sockets ever being closed, so players aren't all thrown out at the same time
+and the new process doesn't have to absorb every one of them reconnecting at
+once.  It works like this:
+
+  1. The running server listens on a Unix socket (Network/Upgrade/Socket).
+  2. The new server is started with --takeover.  Once it has loaded its
+     configuration and set up the database and TLS, it connects to that
+     socket instead of binding its own listening sockets.
+  3. The old server sends it the listening sockets (the game ports, the
+     metrics endpoint and the upgrade socket itself) with SCM_RIGHTS, along
+     with the connections which haven't logged in yet and have nothing in
+     flight (if Network/Upgrade/HandoffIdle is set) and the login tokens of
+     its players.
+  4. Once the new server has wrapped the sockets up, it tells the old one,
+     which replies that it is letting go, closes its copies of the sockets
+     and sends each remaining player a Disconnect packet asking them to
+     reconnect.  Players who do so reach the new server and skip the login
+     with their tokens, whose accounts the new server loads only now.
+  5. The old server keeps serving the players who haven't left yet for up to
+     Network/Upgrade/DrainTime seconds, then shuts down as usual.
+
+If anything goes wrong before the old server replies in step 4, it carries on
+as if nothing had happened.  The new server doesn't touch the sockets until
+that reply arrives; if it doesn't, the new server lets go of everything and
+exits, so the two never serve at the same time.  The handoff runs on the old
+server's main loop, but the new server only asks for it when it is ready and
+does nothing slow until it has finished, so it takes a few milliseconds.
+
+Listening sockets are reused as they are, so changes to the network
+interfaces still need a full restart; a listener whose port has changed is
+replaced by a new one.  In daemon mode, give the new server its own pidfile.
+Unix sockets and SCM_RIGHTS don't exist on Windows, so there upgrades are
+unavailable.
+'''
+
+import asyncore
+import errno
+import json
+import logging
+import os
+import select
+import socket
+import struct
+import time
+import traceback
+
+try:
+    # sendfd() and recvfd() pass a descriptor over a Unix socket.
+    from _multiprocessing import sendfd, recvfd
+except ImportError:
+    # Not available on Windows.
+    sendfd = recvfd = None
+
+from xVLib import Packets
+from . import ServerGlobals, ServerNetworking, Login, Metrics
+
+mainlog = logging.getLogger("Server.Main")
+
+HandoffVersion = 2
+'''Version of the handoff protocol spoken over the upgrade socket.'''
+
+HandoffTimeout = 10.0
+'''Seconds either side waits on the other before giving up.'''
+
+MaxMessageSize = 16777216
+'''Largest message accepted over the upgrade socket, in bytes.'''
+
+Listener = None
+'''UpgradeListener waiting for a new server process, if any.'''
+
+DrainDeadline = None
+'''Time at which a draining server shuts down, or None if not draining.'''
+
+
+class HandoffFailed(Exception): pass
+'''Raised if a handoff between two server processes fails.'''
+
+
+##
+## Messages
+##
+
+def _WaitReadable(sock, deadline):
+    '''
+    Waits until a socket has data to read.
+    
+    @raise HandoffFailed: Raised if the deadline passes first.
+    '''
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise HandoffFailed("timed out")
+        try:
+            readable = select.select([sock], [], [], remaining)[0]
+        except select.error as err:
+            if err.args[0] == errno.EINTR:
+                continue
+            raise
+        if readable:
+            return
+
+
+def _RecvExactly(sock, size, deadline):
+    '''
+    Reads exactly size bytes from a socket.
+    
+    Never reads further than it has to, so that a descriptor passed right
+    after the data isn't lost.
+    '''
+    chunks = []
+    while size > 0:
+        _WaitReadable(sock, deadline)
+        data = sock.recv(size)
+        if not data:
+            raise HandoffFailed("the other process closed the connection")
+        chunks.append(data)
+        size -= len(data)
+    return b"".join(chunks)
+
+
+def _SendMessage(sock, message):
+    '''
+    Sends a JSON message, prefixed with its length.
+    '''
+    data = json.dumps(message)
+    sock.sendall(struct.pack("!I", len(data)) + data)
+
+
+def _RecvMessage(sock, deadline):
+    '''
+    Receives a message sent with _SendMessage().
+    
+    @return: dict holding the message.
+    '''
+    size = struct.unpack("!I", _RecvExactly(sock, 4, deadline))[0]
+    if size > MaxMessageSize:
+        raise HandoffFailed("message of %i bytes is too large" % size)
+    try:
+        message = json.loads(_RecvExactly(sock, size, deadline))
+    except ValueError:
+        raise HandoffFailed("malformed message")
+    if not isinstance(message, dict):
+        raise HandoffFailed("malformed message")
+    return message
+
+
+##
+## Old process
+##
+
+class UpgradeListener(asyncore.dispatcher):
+    '''
+    Listens on the upgrade socket for a new server process.
+    '''
+    
+    def __init__(self, path, sock=None):
+        '''
+        Creates the listener.
+        
+        @type path: string
+        @param path: Path of the upgrade socket.
+        
+        @type sock: socket
+        @param sock: Listening socket handed over by the server process being
+        replaced, or None to create one.
+        
+        @raise socket.error: Raised if the listener can't be created.
+        '''
+        asyncore.dispatcher.__init__(self)
+        self.Path = path
+        '''Path of the upgrade socket.'''
+        if sock is not None:
+            sock.setblocking(0)
+            self.set_socket(sock)
+            self.accepting = True
+            self.addr = path
+            return
+        
+        # Clear out a socket left behind by a server which crashed, but not
+        # one which is still in use.
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except socket.error as err:
+                if err.args[0] != errno.ECONNREFUSED:
+                    raise
+                os.unlink(path)
+            else:
+                raise socket.error(errno.EADDRINUSE,
+                                   "another server is listening")
+            finally:
+                probe.close()
+        
+        # Only the server's own user may connect.
+        self.create_socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        oldmask = os.umask(0o077)
+        try:
+            self.bind(path)
+        finally:
+            os.umask(oldmask)
+        self.listen(1)
+    
+    def writable(self):
+        return False
+    
+    def handle_accept(self):
+        try:
+            pair = self.accept()
+        except socket.error:
+            return
+        if not pair:
+            return
+        sock = pair[0]
+        try:
+            HandOver(sock)
+        except (HandoffFailed, socket.error, OSError) as err:
+            msg = "Handoff to the new server process failed: %s" % err
+            mainlog.error(msg)
+            mainlog.info("Carrying on as before.")
+        finally:
+            sock.close()
+    
+    def handle_error(self):
+        msg = "Unhandled exception in UpgradeListener:\n"
+        msg += traceback.format_exc()
+        mainlog.error(msg)
+
+
+def StartListener(config, sock=None):
+    '''
+    Starts listening for new server processes, if upgrades are enabled.
+    
+    Upgrades are optional, so failing to listen is logged but isn't fatal.
+    
+    @type config: xVLib.ConfigurationFile.ConfigurationFile
+    @param config: Handle to the main configuration file object.
+    
+    @type sock: socket
+    @param sock: The old listener's socket, if it was handed over by the
+    server process being replaced.
+    '''
+    global Listener
+    path = config['Network/Upgrade/Socket']
+    if not config['Network/Upgrade/Enabled']:
+        if sock is not None:
+            sock.close()
+        return
+    if sendfd is None or not hasattr(socket, "AF_UNIX"):
+        mainlog.warning("Upgrades are not supported on this platform.")
+        return
+    try:
+        Listener = UpgradeListener(path, sock)
+    except socket.error as err:
+        msg = "Could not listen for upgrades on %s: %s" % (path, err)
+        mainlog.error(msg)
+        return
+    mainlog.info("Listening for upgrades on %s." % path)
+
+
+def StopListener(unlink=True):
+    '''
+    Stops listening for new server processes and removes the upgrade
+    socket.
+    
+    @type unlink: bool
+    @param unlink: If False, the upgrade socket is left in place, for when
+    the listener belongs to another process as well.
+    '''
+    global Listener
+    if Listener is None:
+        return
+    Listener.close()
+    if unlink:
+        try:
+            os.unlink(Listener.Path)
+        except OSError:
+            pass
+    Listener = None
+
+
+def HandOver(sock):
+    '''
+    Hands the listening sockets and idle connections over to a new server
+    process, then starts draining.
+    
+    Nothing is given up until the new process says it has taken everything
+    over, so if this fails, the server can carry on as before.
+    
+    @type sock: socket
+    @param sock: Connection from the new process to the upgrade socket.
+    
+    @raise HandoffFailed: Raised if the handoff fails.
+    '''
+    global Listener
+    App = ServerGlobals.Application
+    config = App.Config
+    deadline = time.time() + HandoffTimeout
+    sock.setblocking(1)
+    request = _RecvMessage(sock, deadline)
+    if request.get("version") != HandoffVersion:
+        _SendMessage(sock, {"error": "unsupported handoff version"})
+        raise HandoffFailed("new process speaks handoff version %s"
+                            % request.get("version"))
+    newpid = request.get("pid")
+    mainlog.info("Handing over to server process %s." % newpid)
+    
+    # Work out what to hand over.
+    listeners = [("control", Listener)]
+    for server in App.Servers:
+        if isinstance(server, ServerNetworking.IPv6Server):
+            listeners.append(("ipv6", server))
+        else:
+            listeners.append(("ipv4", server))
+    if Metrics.Endpoint is not None:
+        listeners.append(("metrics", Metrics.Endpoint))
+    conns = []
+    if config['Network/Upgrade/HandoffIdle']:
+        conns = [conn for conn in App.Connections.ConnectionSet
+                 if conn.CanHandOver()]
+    drain = config['Network/Upgrade/DrainTime']
+    header = {
+              "version": HandoffVersion,
+              "pid": os.getpid(),
+              "listeners": [(kind, dispatcher.socket.family)
+                            for kind, dispatcher in listeners],
+              "connections": [(conn.socket.family, conn.State)
+                              for conn in conns],
+              "tokens": Login.ExportTokens(drain),
+             }
+    
+    # Send the description, then the descriptors in the same order.
+    _SendMessage(sock, header)
+    for kind, dispatcher in listeners:
+        sendfd(sock.fileno(), dispatcher.socket.fileno())
+    for conn in conns:
+        sendfd(sock.fileno(), conn.socket.fileno())
+    reply = _RecvMessage(sock, deadline)
+    if not reply.get("accepted"):
+        raise HandoffFailed(reply.get("error", "refused by new process"))
+    
+    # The new process waits to hear that we're letting go before it starts
+    # serving, and gives up if it doesn't.
+    _SendMessage(sock, {"released": True})
+    
+    # The new process has everything; let go of our copies.  Closing a
+    # descriptor here doesn't close the socket while the new process still
+    # has it open.
+    for kind, dispatcher in listeners:
+        dispatcher.close()
+    Listener = None
+    App.Servers = []
+    Metrics.Endpoint = None
+    for conn in conns:
+        conn.HandOver()
+    args = (len(listeners), len(conns), newpid)
+    mainlog.info("Handed %i listening sockets and %i connections over to "
+                 "server process %s." % args)
+    StartDrain(config)
+
+
+def StartDrain(config):
+    '''
+    Asks every remaining player to reconnect, and starts the clock on the
+    shutdown.
+    
+    @type config: xVLib.ConfigurationFile.ConfigurationFile
+    @param config: Handle to the main configuration file object.
+    '''
+    global DrainDeadline
+    App = ServerGlobals.Application
+    drain = config['Network/Upgrade/DrainTime']
+    notice = config['Network/Upgrade/Notice']
+    DrainDeadline = time.time() + drain
+    conns = list(App.Connections.ConnectionSet)
+    for conn in conns:
+        packet = Packets.DisconnectPacket(conn)
+        packet.Reason = packet.Reason_Restart
+        packet.Message = notice
+        conn.SendPacket(packet)
+    msg = "Draining %i connections; shutting down within %i seconds."
+    mainlog.info(msg % (len(conns), drain))
+
+
+def Poll():
+    '''
+    Checks on a drain in progress.  Called once per main loop cycle.
+    
+    @return: True once the server has finished draining and should shut
+    down.
+    '''
+    if DrainDeadline is None:
+        return False
+    App = ServerGlobals.Application
+    remaining = App.Connections.ConnectionSet
+    if remaining and time.time() < DrainDeadline:
+        return False
+    if remaining:
+        mainlog.info("Closing %i connections left after draining."
+                     % len(remaining))
+        for conn in list(remaining):
+            conn.close()
+    mainlog.info("Finished draining.")
+    return True
+
+
+##
+## New process
+##
+
+class Handoff(object):
+    '''
+    Everything handed over by the server process being replaced.
+    '''
+    
+    def __init__(self, sock, header, listeners, conns):
+        '''
+        Creates the handoff.  Use RequestHandoff() rather than calling this
+        directly.
+        '''
+        self.Socket = sock
+        '''Connection to the old process's upgrade socket.'''
+        self.OldPid = header.get("pid")
+        '''Process ID of the old server.'''
+        self.Listeners = listeners
+        '''Maps kinds of listener to their sockets, until they are taken.'''
+        self.Connections = conns
+        '''List of (socket, state) tuples of the handed over connections.'''
+        self.Tokens = [tuple(token) for token in header.get("tokens", [])]
+        '''(token value, account name, seconds left) tuples.'''
+    
+    def TakeListener(self, kind, port=None):
+        '''
+        Takes one of the listening sockets.
+        
+        @type kind: string
+        @param kind: "ipv4", "ipv6", "metrics" or "control".
+        
+        @type port: integer
+        @param port: If set, the socket is only returned if it is listening
+        on this port.
+        
+        @return: The socket, or None if there isn't a suitable one.
+        '''
+        sock = self.Listeners.pop(kind, None)
+        if sock is not None and port is not None:
+            if sock.getsockname()[1] != port:
+                sock.close()
+                return None
+        return sock
+    
+    def AdoptConnections(self):
+        '''
+        Wraps the handed over connections, putting each one back into the
+        state it was in.
+        
+        @return: Number of connections adopted.
+        '''
+        count = 0
+        for sock, state in self.Connections:
+            conn = ServerNetworking.ServerConnection(sock)
+            if conn.connected:
+                conn.SetState(state)
+                count += 1
+        self.Connections = []
+        return count
+    
+    def Finish(self):
+        '''
+        Tells the old process that everything has been taken over, and waits
+        for it to let go of its copies and start draining.
+        
+        Any listening sockets which weren't taken are closed.
+        
+        @raise HandoffFailed: Raised if the old process doesn't confirm that
+        it has let go, in which case it carries on serving and this process
+        must let go of everything instead.
+        '''
+        for sock in self.Listeners.itervalues():
+            sock.close()
+        self.Listeners = {}
+        try:
+            deadline = time.time() + HandoffTimeout
+            _SendMessage(self.Socket, {"accepted": True})
+            reply = _RecvMessage(self.Socket, deadline)
+        except socket.error as err:
+            raise HandoffFailed(str(err))
+        finally:
+            self.Socket.close()
+        if not reply.get("released"):
+            reason = reply.get("error", "the old server didn't let go")
+            raise HandoffFailed(reason)
+    
+    def Abort(self, reason):
+        '''
+        Tells the old process that the handoff failed, so that it carries on
+        as before.
+        
+        @type reason: string
+        @param reason: Description of what went wrong.
+        '''
+        try:
+            _SendMessage(self.Socket, {"error": reason})
+        except socket.error:
+            pass
+        self.Socket.close()
+
+
+def RequestHandoff(config):
+    '''
+    Asks the running server to hand everything over to this process.
+    
+    @type config: xVLib.ConfigurationFile.ConfigurationFile
+    @param config: Handle to the main configuration file object.
+    
+    @raise HandoffFailed: Raised if the handoff fails.
+    
+    @return: A Handoff object.  Call its Finish() method once the server is
+    ready to take over, or Abort() if it can't.  The old server is blocked
+    until then, so do nothing slow in between.
+    '''
+    if recvfd is None or not hasattr(socket, "AF_UNIX"):
+        raise HandoffFailed("not supported on this platform")
+    path = config['Network/Upgrade/Socket']
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error as err:
+        sock.close()
+        raise HandoffFailed("could not connect to %s: %s" % (path, err))
+    
+    # Ask for the handoff, then collect the descriptors in the order they
+    # were described.
+    fds = []
+    try:
+        deadline = time.time() + HandoffTimeout
+        _SendMessage(sock, {"version": HandoffVersion, "pid": os.getpid()})
+        header = _RecvMessage(sock, deadline)
+        if "error" in header:
+            raise HandoffFailed(header["error"])
+        kinds = header.get("listeners", [])
+        described = header.get("connections", [])
+        for i in xrange(len(kinds) + len(described)):
+            _WaitReadable(sock, deadline)
+            fds.append(recvfd(sock.fileno()))
+    except (socket.error, OSError) as err:
+        for fd in fds:
+            os.close(fd)
+        sock.close()
+        raise HandoffFailed(str(err))
+    except HandoffFailed:
+        for fd in fds:
+            os.close(fd)
+        sock.close()
+        raise
+    
+    # Wrap them back up as sockets.
+    listeners = {}
+    for (kind, family), fd in zip(kinds, fds):
+        listeners[kind] = socket.fromfd(fd, family, socket.SOCK_STREAM)
+        os.close(fd)
+    conns = []
+    for (family, state), fd in zip(described, fds[len(kinds):]):
+        conns.append((socket.fromfd(fd, family, socket.SOCK_STREAM), state))
+        os.close(fd)
+    return Handoff(sock, header, listeners, conns)
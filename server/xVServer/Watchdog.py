@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+# xVector Engine Server
+# Copyright (c) 2012 James Buchwald
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+'''
+Main loop stall watchdog.
+
+The main loop reports a heartbeat once per cycle.  A background thread checks
+the heartbeat, and if the main loop hasn't finished a cycle within the
+configured threshold, it logs what the main thread is doing at that moment.
+The stack trace points at the handler and line which is holding up the game.
+
+Each stall is reported once, with a second message when the main loop
+recovers.
+'''
+
+import logging
+import sys
+import threading
+import time
+import traceback
+from . import Metrics
+
+mainlog = logging.getLogger("Server.Main")
+
+
+class StallWatchdog(threading.Thread):
+    '''
+    Background thread which reports main loop stalls.
+    '''
+    
+    def __init__(self, threshold=1.0):
+        '''
+        Creates the watchdog.  Call start() from the main loop's thread to
+        start watching it.
+        
+        @type threshold: number
+        @param threshold: Seconds without a heartbeat after which the main
+        loop is considered stalled, or 0 to disable the watchdog.
+        '''
+        # Inherit base class behavior.
+        threading.Thread.__init__(self, name="Watchdog")
+        self.daemon = True
+        
+        # Declare attributes.
+        self.Threshold = threshold
+        '''Seconds without a heartbeat before a stall is reported.'''
+        self.LastBeat = time.time()
+        '''Time of the main loop's last heartbeat.'''
+        self.Stalled = False
+        '''True while a stall is in progress.'''
+        self.StallBegan = None
+        '''Time of the last heartbeat before the current stall.'''
+        self.MainThread = threading.current_thread().ident
+        '''Identifier of the thread running the main loop.'''
+        self._Stop = threading.Event()
+        '''Set to stop the watchdog.'''
+    
+    def Stop(self):
+        '''
+        Stops the watchdog thread.
+        '''
+        self._Stop.set()
+        self.join()
+    
+    def run(self):
+        '''
+        Main loop of the watchdog thread.
+        '''
+        while not self._Stop.is_set():
+            threshold = self.Threshold
+            if threshold:
+                self.Check(threshold)
+                self._Stop.wait(min(threshold / 4.0, 1.0))
+            else:
+                self._Stop.wait(1.0)
+    
+    def Check(self, threshold):
+        '''
+        Reports a stall if the main loop has missed its heartbeat.
+        '''
+        last = self.LastBeat
+        elapsed = time.time() - last
+        if elapsed < threshold:
+            if self.Stalled:
+                self.Stalled = False
+                msg = "Main loop resumed after %.1f seconds."
+                mainlog.warning(msg % (last - self.StallBegan))
+            return
+        if self.Stalled:
+            return
+        self.Stalled = True
+        self.StallBegan = last
+        Metrics.Stalls.Inc()
+        
+        # Grab the main thread's stack.
+        frame = sys._current_frames().get(self.MainThread)
+        if frame is None:
+            return
+        stack = "".join(traceback.format_stack(frame))
+        del frame
+        msg = "Main loop stalled for %.1f seconds, currently at:\n\n%s"
+        mainlog.warning(msg % (elapsed, stack))
+
+
+Dog = None
+'''StallWatchdog watching the main loop, once started.'''
+
+Threshold = 1.0
+'''Configured stall threshold, in seconds.'''
+
+
+def InitWatchdog(config):
+    '''
+    Applies the watchdog settings from the configuration file.
+    
+    @type config: xVLib.ConfigurationFile.ConfigurationFile
+    @param config: Handle to the main configuration file object.
+    '''
+    global Threshold
+    Threshold = config['Diagnostics/Watchdog/Threshold'] / 1000.0
+    if Dog is not None:
+        Dog.Threshold = Threshold
+
+
+def StartWatchdog():
+    '''
+    Starts watching the calling thread's main loop.
+    '''
+    global Dog
+    Dog = StallWatchdog(Threshold)
+    Dog.start()
+
+
+def StopWatchdog():
+    '''
+    Stops the watchdog, if it is running.
+    '''
+    global Dog
+    if Dog is not None:
+        Dog.Stop()
+        Dog = None
+
+
+def Heartbeat(now):
+    '''
+    Tells the watchdog that the main loop has finished a cycle.
+    
+    @type now: number
+    @param now: Current time, as from time.time().
+    '''
+    if Dog is not None:
+        Dog.LastBeat = now
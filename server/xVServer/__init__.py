@@ -18,7 +18,10 @@
 # Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
 __all__ = ['Database', 'MainLoop', 'ServerConfig', 'ServerCore',
-           'ServerGlobals', 'ServerNetworking', 'IPBans', 'Accounts', 'Login']
+           'ServerGlobals', 'ServerNetworking', 'IPBans', 'Accounts', 'Login',
+           'Callbacks', 'ServerTLS', 'Persistence', 'Admission',
+           'LogQueue', 'Metrics', 'Watchdog', 'Profiler', 'Memory',
+           'PacketCapture']
 
 ##
 ## SQLAlchemy setup
@@ -86,7 +86,10 @@ def SerializeUTF8(fileobj, string, maxlen=0):
         raise MaxLengthExceeded
     
     # figure out what we're serializing
-    toSerialize = str(string).encode('utf-8')
+    if isinstance(string, unicode):
+        toSerialize = string.encode('utf-8')
+    else:
+        toSerialize = str(string)
     width = len(toSerialize)
     
     # serialize
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+
+# xVector Engine Core Library
+# Copyright (c) 2012 James Buchwald
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+'''
+Packet capture files.
+
+A capture records the data received on a set of connections: when each
+connection was opened, every packet it received exactly as it came off the
+wire (after any TLS layer), and when it was closed.  Captures are written by
+a CaptureWriter, which connection handlers feed through their Recorder
+attribute, and read back with a CaptureReader in order to replay them.
+
+The file starts with a header:
+
+    magic       6 bytes     "xVCAP" followed by a null byte
+    version     uint8       CaptureVersion
+    start       float64     time the capture started, since the epoch
+
+and is followed by records:
+
+    kind        uint8       Record_Open, Record_Frame or Record_Close
+    connection  uint32      number of the connection within the capture
+    time        float64     seconds since the start of the capture
+    length      uint32      length of the data
+    data                    the peer's address for Record_Open, the packet
+                            for Record_Frame, nothing for Record_Close
+
+All values are little-endian.  If the capture was cut short (by a crash, for
+example), it can still be read up to the last complete record.
+
+A capture holds everything the clients sent, including the password hashes
+sent when registering an account, so treat capture files as confidential.
+'''
+
+import struct
+import time
+
+CaptureMagic = b"xVCAP\0"
+'''Magic string at the start of every capture file.'''
+
+CaptureVersion = 1
+'''Version of the capture format written by this module.'''
+
+HeaderStruct = struct.Struct("<6sBd")
+'''Layout of the capture file header.'''
+
+RecordStruct = struct.Struct("<BIdI")
+'''Layout of the fixed part of a record.'''
+
+Record_Open = 0
+'''Record of a new connection; the data is the peer's address.'''
+
+Record_Frame = 1
+'''Record of a packet received on a connection; the data is the packet.'''
+
+Record_Close = 2
+'''Record of a connection being closed.'''
+
+
+class CaptureFormatError(Exception): pass
+'''Raised if a file is not a capture this module can read.'''
+
+
+class CaptureWriter(object):
+    '''
+    Writes a capture file.
+    
+    Connection handlers are recorded by passing them to OpenConnection() and
+    setting their Recorder attribute to the writer; from then on, every packet
+    they decode is recorded until CloseConnection() is called.
+    
+    Writing stops for good once the size limit is reached, the file can't be
+    written to, or Close() is called.  OnStopped() is called when that
+    happens.
+    '''
+    
+    def __init__(self, path, maxsize=0):
+        '''
+        Creates a new capture file, replacing any file already at the path.
+        
+        @type path: string
+        @param path: Path of the capture file.
+        
+        @type maxsize: integer
+        @param maxsize: Size limit of the file in bytes, or 0 for no limit.
+        
+        @raise IOError: Raised if the file can't be created.
+        '''
+        # Declare attributes.
+        self.Path = path
+        '''Path of the capture file.'''
+        self.MaxSize = maxsize
+        '''Size limit of the file in bytes, or 0 for no limit.'''
+        self.Start = time.time()
+        '''Time at which the capture started.'''
+        self.Size = 0
+        '''Number of bytes written so far.'''
+        self.Stopped = False
+        '''True once the capture has stopped.'''
+        self._File = None
+        '''File object being written to.'''
+        self._NextID = 0
+        '''Number given to the next connection recorded.'''
+        
+        # Start the file.
+        self._File = open(path, "wb", 65536)
+        header = HeaderStruct.pack(CaptureMagic, CaptureVersion, self.Start)
+        self._File.write(header)
+        self.Size = len(header)
+    
+    def OpenConnection(self, conn):
+        '''
+        Starts recording a connection.
+        
+        @type conn: xVLib.Networking.BaseConnectionHandler
+        @param conn: Connection to record.
+        '''
+        conn.CaptureID = self._NextID
+        self._NextID += 1
+        address = conn.Address[0].encode("utf-8")
+        self._Write(Record_Open, conn.CaptureID, address)
+    
+    def RecordFrame(self, conn, data):
+        '''
+        Records a packet received on a connection.
+        
+        @type conn: xVLib.Networking.BaseConnectionHandler
+        @param conn: Connection the packet was received on.
+        
+        @type data: string
+        @param data: Encoded packet, as received.
+        '''
+        self._Write(Record_Frame, conn.CaptureID, data)
+    
+    def CloseConnection(self, conn):
+        '''
+        Records that a connection was closed.
+        
+        @type conn: xVLib.Networking.BaseConnectionHandler
+        @param conn: Connection which was closed.
+        '''
+        self._Write(Record_Close, conn.CaptureID, b"")
+    
+    def Close(self):
+        '''
+        Stops the capture and closes the file.
+        '''
+        self._Stop(None)
+    
+    def OnStopped(self, reason):
+        '''
+        Called when the capture stops.
+        
+        Subclasses can reimplement this to report the event; the default
+        behavior is to do nothing.
+        
+        @type reason: string
+        @param reason: Why the capture stopped early, or None if it was
+        stopped by Close().
+        '''
+        pass
+    
+    def _Write(self, kind, connid, data):
+        '''
+        Writes a record to the file.
+        '''
+        if self.Stopped:
+            return
+        size = RecordStruct.size + len(data)
+        if self.MaxSize and self.Size + size > self.MaxSize:
+            self._Stop("size limit reached")
+            return
+        record = RecordStruct.pack(kind, connid, time.time() - self.Start,
+                                   len(data))
+        try:
+            self._File.write(record + data)
+        except IOError as err:
+            self._Stop(str(err))
+            return
+        self.Size += size
+    
+    def _Stop(self, reason):
+        '''
+        Closes the file and stops recording.
+        '''
+        if self.Stopped:
+            return
+        self.Stopped = True
+        try:
+            self._File.close()
+        except IOError as err:
+            reason = reason or str(err)
+        self.OnStopped(reason)
+
+
+class CaptureReader(object):
+    '''
+    Reads the records of a capture file.
+    
+    Iterating over the reader yields tuples (kind, connection, time, data) in
+    the order they were recorded.
+    '''
+    
+    def __init__(self, path):
+        '''
+        Opens a capture file.
+        
+        @type path: string
+        @param path: Path of the capture file.
+        
+        @raise IOError: Raised if the file can't be opened.
+        @raise CaptureFormatError: Raised if the file isn't a capture.
+        '''
+        self.Path = path
+        '''Path of the capture file.'''
+        self._File = open(path, "rb")
+        '''File object being read from.'''
+        
+        # Check the header.
+        header = self._File.read(HeaderStruct.size)
+        if len(header) < HeaderStruct.size:
+            self._File.close()
+            raise CaptureFormatError("%s is not a capture file" % path)
+        magic, version, start = HeaderStruct.unpack(header)
+        if magic != CaptureMagic:
+            self._File.close()
+            raise CaptureFormatError("%s is not a capture file" % path)
+        if version != CaptureVersion:
+            self._File.close()
+            msg = "%s has unsupported capture version %i" % (path, version)
+            raise CaptureFormatError(msg)
+        self.Version = version
+        '''Version of the capture format.'''
+        self.Start = start
+        '''Time at which the capture started.'''
+    
+    def __iter__(self):
+        read = self._File.read
+        size = RecordStruct.size
+        unpack = RecordStruct.unpack
+        while 1:
+            fixed = read(size)
+            if len(fixed) < size:
+                return
+            kind, connid, offset, length = unpack(fixed)
+            data = read(length)
+            if len(data) < length:
+                # Cut short; stop at the last complete record.
+                return
+            yield (kind, connid, offset, data)
+    
+    def Close(self):
+        '''
+        Closes the file.
+        '''
+        self._File.close()
@@ -101,8 +101,11 @@ class ConfigurationFile(object):
             default = None
         
         # Look up the option in the file
-        value = self.Tree.findtext(key, default)
+        value = self.Tree.findtext(key)
         if value == None:
+            if default != None:
+                # Not found; the default is already in its final form.
+                return default
             # Not found, no default
             msg = "Option %s not found in configuration file." % key
             mainlog.error(msg)
@@ -125,3 +128,93 @@ class ConfigurationFile(object):
         except KeyError:
             # no transformer, return raw value
             return value
+    
+    def Snapshot(self):
+        '''
+        Resolves every known option at once into a ConfigSnapshot.
+        
+        @raise ValueError: Raised if any option has an invalid value.
+        
+        @return: New ConfigSnapshot of the current file contents.
+        '''
+        return ConfigSnapshot(self)
+
+
+class ConfigSection(object):
+    '''
+    Group of options within a ConfigSnapshot.
+    
+    Options and subsections are plain attributes named after the parts of
+    the option name; for example, "Network/Connections/Max" is read as
+    snapshot.Network.Connections.Max.
+    '''
+    pass
+
+
+class ConfigSnapshot(ConfigSection):
+    '''
+    Typed, read-only copy of every known option in a configuration file.
+    
+    Reading a ConfigurationFile searches the XML tree and transforms the
+    value every time; a snapshot does all of that once up front, so reading
+    an option is just an attribute (or dict) lookup.  Options which have a
+    default value or a transformer are known; anything else is looked up in
+    the underlying file as before.
+    
+    To reload the file, load it again and take a new snapshot, then swap the
+    new snapshot in place of the old one.
+    '''
+    
+    def __init__(self, config):
+        '''
+        Resolves the options of a configuration file.
+        
+        @type config: ConfigurationFile
+        @param config: File to take a snapshot of.
+        
+        @raise ValueError: Raised if any option has an invalid value.
+        '''
+        self._Source = config
+        '''Configuration file that the snapshot was taken from.'''
+        self._Values = {}
+        '''Maps full option names to their values.'''
+        
+        # Resolve everything we know about.
+        keys = set(config.DefaultValues) | set(config.Transformers)
+        for key in sorted(keys):
+            if key not in config.DefaultValues:
+                if config.Tree.find(key) is None:
+                    # Not set, and no default; leave it to __getitem__.
+                    continue
+            try:
+                value = config[key]
+            except ValueError as err:
+                msg = "Invalid value for option %s: %s" % (key, err)
+                raise ValueError(msg)
+            self._Values[key] = value
+            
+            # Build the attribute tree.
+            parts = key.split("/")
+            section = self
+            for part in parts[:-1]:
+                child = section.__dict__.get(part)
+                if child is None:
+                    child = ConfigSection()
+                    setattr(section, part, child)
+                section = child
+            setattr(section, parts[-1], value)
+    
+    def __getitem__(self, key):
+        '''
+        Looks up an option by its full name, as with ConfigurationFile.
+        
+        @type key: string
+        @param key: Option name
+        
+        @raise KeyError: Raised if the option is not set and no default value
+        is available for the option.
+        '''
+        try:
+            return self._Values[key]
+        except KeyError:
+            return self._Source[key]
@@ -67,6 +67,65 @@ class BaseConnectionHandler(asyncore.dispatcher_with_send):
     xVServer) so we use a ConnectionHandler to abstract high-level network code
     and avoid compatibility issues between the two APIs.
     '''
+    
+    ##
+    ## connection state
+    ##
+    
+    # A server holds one of these objects for every player, so like asyncore
+    # itself, we keep the initial state in class attributes.  An attribute
+    # only takes up room in the instance dictionary once it is changed, which
+    # keeps idle connections small.  (__slots__ would need a new-style class,
+    # and mixing those with asyncore's old-style classes slows down every
+    # attribute lookup.)  Only immutable values may be used as defaults.
+    
+    RecvBuffer = b""
+    '''Buffer of received data; packets are built from this.'''
+    
+    # Encryption trackers.
+    _NegotiateTLS = False
+    '''If True, negotiates a TLS encryption layer with the other side.'''
+    _DenegotiateTLS = False
+    '''If True, denegotiates a TLS encryption layer with the other side.'''
+    PostNegotiationPackets = None
+    '''
+    Queue of packets to send after a successful TLS negotiation, or None if
+    nothing has been queued.
+    '''
+    PostDenegotiationPackets = None
+    '''
+    Queue of packets to send after a successful TLS denegotiation, or None if
+    nothing has been queued.
+    '''
+    IsEncrypted = False
+    '''If True, the connection is encrypted with TLS.'''
+    _TLSWantWrite = False
+    '''If True, the TLS layer is waiting for the socket to be writable.'''
+    
+    # Flow control.  A limit of None disables the check.
+    RecvBufferLimit = None
+    '''Maximum number of bytes held in the receive buffer.'''
+    SendHighWater = None
+    '''Send buffer size at which the connection is marked as congested.'''
+    SendLowWater = None
+    '''Send buffer size at which a congested connection is cleared.'''
+    SendBufferLimit = None
+    '''Send buffer size at which the peer is treated as a slow consumer.'''
+    SlowConsumerGrace = None
+    '''Number of seconds a connection may stay congested.'''
+    IsCongested = False
+    '''If True, the send buffer is above its high watermark.'''
+    CongestedSince = 0
+    '''Time at which the connection last became congested.'''
+    ReadPaused = False
+    '''If True, no data will be read from the connection.'''
+    
+    # Packet capture.
+    Recorder = None
+    '''Capture.CaptureWriter recording received packets, if any.'''
+    CaptureID = None
+    '''Number of the connection within the capture recording it.'''
+    
     def __init__(self, sock=None):
         '''
         Creates a new BaseConnection object.
@@ -80,26 +139,16 @@ class BaseConnectionHandler(asyncore.dispatcher_with_send):
         # Set up our initial timeout tracker.
         self.LastActivity = time.time()
         '''Time at which last network activity occurred.'''
-        
-        # Create the buffer.
-        self.RecvBuffer = b""
-        '''Buffer of received data; packets are built from this.'''
-        
-        # Set up encryption trackers.
-        self._NegotiateTLS = False
-        '''If True, negotiates a TLS encryption layer with the other side.'''
-        self._DenegotiateTLS = False
-        '''If True, denegotiates a TLS encryption layer with the other side.'''
-        self.PostNegotiationPackets = deque()
-        '''Queue of packets to send after a successful TLS negotiation.'''
-        self.PostDenegotiationPackets = deque()
-        '''Queue of packets to send after a successful TLS denegotiation.'''
-        self.IsEncrypted = False
-        '''If True, the connection is encrypted with TLS.'''
     
     @property
     def Address(self):
-        return self.socket.getpeername()
+        '''
+        Network address of the remote side.
+        
+        This is the address asyncore recorded when the connection was made,
+        so it is still available after the remote side has disconnected.
+        '''
+        return self.addr
     
     def SendPacket(self, packet):
         '''
@@ -109,28 +158,81 @@ class BaseConnectionHandler(asyncore.dispatcher_with_send):
         @param packet: Packet to send over the connection.
         '''
         # Any negotiations/denegotiations going on to queue packets for?
+        # The queues are only created when needed; most connections never
+        # use them.
         if self._NegotiateTLS:
+            if self.PostNegotiationPackets is None:
+                self.PostNegotiationPackets = deque()
             self.PostNegotiationPackets.append(packet)
             return
         elif self._DenegotiateTLS:
+            if self.PostDenegotiationPackets is None:
+                self.PostDenegotiationPackets = deque()
             self.PostDenegotiationPackets.append(packet)
             return
         
         # get the packet data and send it
         data = packet.GetBinaryForm()
+        self.OnPacketSent(packet, len(data))
         self.send(data)
     
+    def PauseReading(self):
+        '''
+        Stops reading data from the connection until ResumeReading() is called.
+        
+        Any data already in the receive buffer is left alone; the kernel's
+        socket buffer will fill up and the remote side will be throttled by
+        TCP flow control.
+        '''
+        self.ReadPaused = True
+    
+    def ResumeReading(self):
+        '''
+        Resumes reading data from the connection after PauseReading().
+        '''
+        self.ReadPaused = False
+    
     def CheckTimeout(self):
         '''
         Checks if the connection has timed out.
         
         If the connection has timed out, this will call the OnTimeout() method.
+        If the connection has been congested for longer than the slow consumer
+        grace period, this will call the OnSlowConsumer() method.
         '''
         # check timeout
-        delta = time.time() - self.LastActivity
+        now = time.time()
+        delta = now - self.LastActivity
         if delta > TimeoutLimit:
             # connection timed out
             self.OnTimeout()
+            return
+        
+        # check for a peer that has stopped reading
+        if self.IsCongested and self.SlowConsumerGrace is not None:
+            if now - self.CongestedSince > self.SlowConsumerGrace:
+                self.OnSlowConsumer()
+    
+    def _CheckSendBuffer(self):
+        '''
+        Updates the congestion state from the size of the send buffer.
+        '''
+        buffered = len(self.out_buffer)
+        if self.IsCongested:
+            # Has the buffer drained far enough?
+            if self.SendLowWater is None or buffered <= self.SendLowWater:
+                self.IsCongested = False
+                self.OnDecongested()
+        elif self.SendHighWater is not None and buffered > self.SendHighWater:
+            # Peer isn't keeping up with us.
+            self.IsCongested = True
+            self.CongestedSince = time.time()
+            self.OnCongested()
+        
+        # Hard limit on the buffer size, regardless of the grace period.
+        limit = self.SendBufferLimit
+        if limit is not None and buffered > limit:
+            self.OnSlowConsumer()
     
     def _TryPacketBuild(self):
         '''Tries to build a packet from the read buffer.'''
@@ -141,13 +243,16 @@ class BaseConnectionHandler(asyncore.dispatcher_with_send):
         try:
             # wrap the buffer in a stream
             BufferStream = cStringIO.StringIO(self.RecvBuffer)
-        
+            
             # try to build the packet
             NewPacket = Packets.BuildPacketFromStream(BufferStream, self)
-        
+            
             # If we get here, it worked.  Drop the data from the buffer.
             PacketEnd = BufferStream.tell()
+            if self.Recorder is not None:
+                self.Recorder.RecordFrame(self, self.RecvBuffer[:PacketEnd])
             self.RecvBuffer = self.RecvBuffer[PacketEnd:]
+            self.OnPacketDecoded(NewPacket, PacketEnd)
             
             BufferStream.close()
             return NewPacket
@@ -246,6 +351,44 @@ class BaseConnectionHandler(asyncore.dispatcher_with_send):
         '''
         raise NotImplementedError
     
+    def OnRecvOverflow(self):
+        '''
+        Called when the receive buffer is full but holds no complete packet.
+        
+        Must be reimplemented by all subclasses that set RecvBufferLimit.
+        '''
+        raise NotImplementedError
+    
+    def OnSlowConsumer(self):
+        '''
+        Called when the remote side has stopped reading data from us.
+        
+        This happens when the connection stays congested for longer than
+        SlowConsumerGrace seconds, or when the send buffer grows past
+        SendBufferLimit.  Must be reimplemented by all subclasses that set
+        either of these limits.
+        '''
+        raise NotImplementedError
+    
+    def OnCongested(self):
+        '''
+        Called when the send buffer rises above the high watermark.
+        
+        The default behavior is to stop reading from the connection so that
+        a peer which doesn't read our replies can't keep making requests.
+        Producers of non-essential traffic should check IsCongested before
+        sending.
+        '''
+        self.PauseReading()
+    
+    def OnDecongested(self):
+        '''
+        Called when the send buffer drains below the low watermark.
+        
+        The default behavior is to resume reading from the connection.
+        '''
+        self.ResumeReading()
+    
     def OnNegotiateTLS(self):
         '''
         Called when TLS encryption needs to be negotiated.
@@ -271,6 +414,37 @@ class BaseConnectionHandler(asyncore.dispatcher_with_send):
         '''
         return True
     
+    def OnPacketSent(self, packet, size):
+        '''
+        Called when a packet is encoded to be sent.
+        
+        Subclasses can reimplement this to keep traffic statistics; the
+        default behavior is to do nothing.
+        
+        @type packet: xVLib.Packets.Packet
+        @param packet: Packet being sent.
+        
+        @type size: integer
+        @param size: Encoded size of the packet in bytes.
+        '''
+        pass
+    
+    def OnPacketDecoded(self, packet, size):
+        '''
+        Called when a packet is decoded from the receive buffer, before it is
+        passed to PacketReceived().
+        
+        Subclasses can reimplement this to keep traffic statistics; the
+        default behavior is to do nothing.
+        
+        @type packet: xVLib.Packets.Packet
+        @param packet: Packet received.
+        
+        @type size: integer
+        @param size: Encoded size of the packet in bytes.
+        '''
+        pass
+    
     ##
     ## more encryption stuff
     ##
@@ -283,59 +457,140 @@ class BaseConnectionHandler(asyncore.dispatcher_with_send):
                 self.socket.do_handshake()
             except ssl.SSLError as err:
                 # Failed; is this a fatal error?
-                if (err.arg[0] != ssl.SSL_ERROR_WANT_READ
-                    and err.arg[0] != ssl.SSL_ERROR_WANT_WRITE):
+                if not self._TLSWouldBlock(err):
                     # Fatal error.
                     raise
                 else:
                     # Can't do anything for now.
                     return
-            # Negotiation successful... clear the backlog.
-            self.IsEncrypted = True
-            self._NegotiateTLS = False
-            self._DenegotiateTLS = False
-            
-            # Validate the key.
-            key_accepted = self.OnValidateRemoteKey()
-            if not key_accepted:
-                # Remote key is rejected for some reason
-                self.shutdown(socket.SHUT_RDWR)
-                self.close()
-            
-            # Send all the packets that were waiting to be sent.
-            try:
-                while 1:
-                    packet = self.PostNegotiationPackets.popleft()
-                    self.SendPacket(packet)
-            except IndexError:
-                pass
+            self._FinishTLSNegotiation()
         
         elif self._DenegotiateTLS:
             try:
                 self.socket = self.socket.unwrap()
             except ssl.SSLError as err:
                 # Failed; is this a fatal error?
-                if (err.arg[0] != ssl.SSL_ERROR_WANT_READ
-                    and err.arg[0] != ssl.SSL_ERROR_WANT_WRITE):
+                if not self._TLSWouldBlock(err):
                     # Fatal error.
                     raise
                 else:
                     # Can't do anything for now.
                     return
             # Denegotiation successful... clear the backlog.
-            self.IsEncrypted = True
+            self.IsEncrypted = False
             self._NegotiateTLS = False
             self._DenegotiateTLS = False
-            try:
-                while 1:
-                    packet = self.PostDenegotiationPackets.popleft()
-                    self.SendPacket(packet)
-            except IndexError:
-                pass
+            self._TLSWantWrite = False
+            queue = self.PostDenegotiationPackets
+            self.PostDenegotiationPackets = None
+            while queue:
+                self.SendPacket(queue.popleft())
+    
+    def _FinishTLSNegotiation(self):
+        '''
+        Called once the TLS handshake has completed successfully.
+        
+        This validates the remote key and sends any packets that were queued
+        during the negotiation.
+        '''
+        # Negotiation successful... clear the backlog.
+        self.IsEncrypted = True
+        self._NegotiateTLS = False
+        self._DenegotiateTLS = False
+        self._TLSWantWrite = False
+        
+        # Validate the key.
+        key_accepted = self.OnValidateRemoteKey()
+        if not key_accepted:
+            # Remote key is rejected for some reason
+            self.shutdown(socket.SHUT_RDWR)
+            self.close()
+            return
+        
+        # Send all the packets that were waiting to be sent.
+        queue = self.PostNegotiationPackets
+        self.PostNegotiationPackets = None
+        while queue:
+            self.SendPacket(queue.popleft())
+    
+    def _TLSWouldBlock(self, err):
+        '''
+        Checks whether an SSL error only means that the socket isn't ready.
+        
+        @type err: ssl.SSLError
+        @param err: Error raised by the SSL socket.
+        
+        @return: True if the operation should be retried later.
+        '''
+        if err.args[0] == ssl.SSL_ERROR_WANT_READ:
+            self._TLSWantWrite = False
+            return True
+        elif err.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+            self._TLSWantWrite = True
+            return True
+        return False
     
     ##
     ## low-level callbacks
     ##
+    def readable(self):
+        '''
+        Called by asyncore to check if we want to read from the connection.
+        
+        This is a reimplemented callback method from dispatcher_with_send.
+        '''
+        return not self.ReadPaused
+    
+    def writable(self):
+        '''
+        Called by asyncore to check if we want to write to the connection.
+        
+        This extends the writable() method of dispatcher_with_send so that a
+        TLS handshake blocked on a write gets a chance to continue.
+        '''
+        if self._TLSWantWrite:
+            return True
+        return asyncore.dispatcher_with_send.writable(self)
+    
+    def recv(self, buffer_size):
+        '''
+        Reads data from the connection.
+        
+        This extends the recv() method of dispatcher_with_send to treat a TLS
+        record that hasn't fully arrived yet as an empty read.
+        '''
+        try:
+            return asyncore.dispatcher_with_send.recv(self, buffer_size)
+        except ssl.SSLError as err:
+            if self._TLSWouldBlock(err):
+                return b""
+            raise
+    
+    def send(self, data):
+        '''
+        Queues data to be written to the connection.
+        
+        This extends the send() method of dispatcher_with_send to keep track of
+        the size of the send buffer.
+        '''
+        asyncore.dispatcher_with_send.send(self, data)
+        self._CheckSendBuffer()
+    
+    def initiate_send(self):
+        '''
+        Writes as much of the send buffer as possible to the connection.
+        
+        This extends the initiate_send() method of dispatcher_with_send to
+        clear the congestion state once the buffer drains.
+        '''
+        try:
+            asyncore.dispatcher_with_send.initiate_send(self)
+        except ssl.SSLError as err:
+            if not self._TLSWouldBlock(err):
+                raise
+        if self.IsCongested:
+            self._CheckSendBuffer()
+    
     def handle_read(self):
         '''
         Called when connection data can be read.
@@ -356,11 +611,36 @@ class BaseConnectionHandler(asyncore.dispatcher_with_send):
             if len(self.out_buffer) == 0:
                 # No; let's try to negotiate whatever.
                 self._PushTLSHandshake()
+            if self._NegotiateTLS or self._DenegotiateTLS:
+                # Still going; the handshake owns the socket for now.
+                return
         
         # receive data, append to buffer
-        data = self.recv(8192)
+        readsize = 8192
+        if self.RecvBufferLimit is not None:
+            # never read past the buffer limit
+            room = self.RecvBufferLimit - len(self.RecvBuffer)
+            readsize = min(readsize, room)
+            if readsize <= 0:
+                self.PauseReading()
+                self.OnRecvOverflow()
+                return
+        data = self.recv(readsize)
         self.RecvBuffer += data
         
+        # The TLS layer may be holding decrypted data that select() can't see.
+        if self.IsEncrypted:
+            while self.socket.pending():
+                if self.RecvBufferLimit is not None:
+                    room = self.RecvBufferLimit - len(self.RecvBuffer)
+                    readsize = min(8192, room)
+                    if readsize <= 0:
+                        break
+                data = self.recv(readsize)
+                if not data:
+                    break
+                self.RecvBuffer += data
+        
         # try building packets
         try:
             # this will loop until there are no more packets in the buffer
@@ -373,6 +653,14 @@ class BaseConnectionHandler(asyncore.dispatcher_with_send):
         except Packets.CorruptPacket:
             # Corrupt packet.
             self.OnCorruptPacket()
+            return
+        
+        # Packets are decoded as soon as they arrive, so a full buffer at this
+        # point means a single packet is larger than we're willing to hold.
+        if (self.RecvBufferLimit is not None
+            and len(self.RecvBuffer) >= self.RecvBufferLimit):
+            self.PauseReading()
+            self.OnRecvOverflow()
         # Unhandled exceptions here will go to asyncore's handle_error method,
         # which you should probably overload.
     
@@ -397,5 +685,9 @@ class BaseConnectionHandler(asyncore.dispatcher_with_send):
         '''
         Called when the connection is closed by the remote machine.
         '''
-        self.shutdown(socket.SHUT_RDWR)
+        try:
+            self.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            # The remote side may already have gone away completely.
+            pass
         self.close()
@@ -28,7 +28,7 @@ import logging
 from xVLib import BinaryStructs, Version
 
 
-ProtocolRevision = 0
+ProtocolRevision = 1
 '''Current revision of the network protocol.'''
 
 
@@ -89,8 +89,9 @@ DeleteCharacter = 34
 StartCharacterList = 35
 InvalidRequest = 36
 UserNotFound = 37
+LoginToken = 38
 
-MAX_VALID_PACKET = InvalidRequest
+MAX_VALID_PACKET = LoginToken
 '''Highest allowed value of a packet type, used for validation.'''
 
 UnknownType = 65535
@@ -100,6 +101,9 @@ UnknownType = 65535
 ## Packet Header Flags
 ##
 
+HeaderSize = 4
+'''Size of the packet header (type and flags) in bytes.'''
+
 HeaderFlag_zlib = 1
 '''Set in the packet header if the body is zlib-compressed.'''
 
@@ -130,6 +134,10 @@ class Packet(object):
         # Internal flags
         self._HasBody = False
         '''Subclasses which have bodies should set this to True.'''
+        
+        # Statistics
+        self.BodySize = 0
+        '''Uncompressed size of the body as of the last GetBinaryForm().'''
     
     def SendPacket(self):
         '''
@@ -151,6 +159,7 @@ class Packet(object):
         # let's figure out what we're sending
         flags = 0
         body = self.SerializeBody()
+        self.BodySize = len(body) if body else 0
         if body:
             # there's a body that needs to be compressed
             compressed = self.CompressIfNeeded(body)
@@ -227,6 +236,9 @@ class Packet(object):
             
             try:
                 self.DeserializeBody(data)
+            except (IncompletePacket, CorruptPacket):
+                # The body isn't all here yet, or was already found corrupt.
+                raise
             except:
                 msg = "Unhandled exception in DeserializeBody(), packet type "
                 msg += str(self.PacketType)
@@ -400,8 +412,13 @@ class NegotiateConnectionPacket(Packet):
         # Declare our type.
         self.PacketType = NegotiateConnection
         self._HasBody = True
-    
-        # No body attributes for this one, they're all engine constants.
+        
+        # Declare body attributes.
+        self.ResumeToken = b""
+        '''
+        Login token from a previous connection, used to skip the login.  Leave
+        this empty to perform a normal login.  (Max length: 32 bytes)
+        '''
     
     def SerializeBody(self):
         # Create a stream to work with
@@ -413,6 +430,9 @@ class NegotiateConnectionPacket(Packet):
         BinaryStructs.SerializeUint16(data, Version.MajorVersion)
         BinaryStructs.SerializeUint16(data, Version.MinorVersion)
         
+        # Then the login token, if any.
+        BinaryStructs.SerializeBinary(data, self.ResumeToken, maxlen=32)
+        
         # Return the body
         return data.getvalue()
     
@@ -428,6 +448,7 @@ class NegotiateConnectionPacket(Packet):
             self.Revision = BinaryStructs.DeserializeUint16(stream)
             self.MajorVersion = BinaryStructs.DeserializeUint16(stream)
             self.MinorVersion = BinaryStructs.DeserializeUint16(stream)
+            self.ResumeToken = BinaryStructs.DeserializeBinary(stream, 32)
         except BinaryStructs.EndOfFile:
             raise IncompletePacket
         except:
@@ -445,6 +466,8 @@ class ConnectionAcceptedPacket(Packet):
     ##
     Flag_NoRegister = 1
     '''Login screen flag indicating that in-client registration is disabled.'''
+    Flag_Resumed = 2
+    '''Flag indicating that the login token was accepted; skip the login.'''
     
     def __init__(self, connection):
         '''
@@ -461,6 +484,8 @@ class ConnectionAcceptedPacket(Packet):
         # Declare body attributes.
         self.RegistrationDisabled = False
         '''If True, in-client registration is disabled.'''
+        self.Resumed = False
+        '''If True, the previous session was restored from a login token.'''
         self.ServerName = u""
         '''Unicode string containing the server name.'''
         self.ServerNewsURL = u""
@@ -473,6 +498,7 @@ class ConnectionAcceptedPacket(Packet):
         # calculate the login screen flags
         flags = 0
         if self.RegistrationDisabled: flags |= self.Flag_NoRegister
+        if self.Resumed: flags |= self.Flag_Resumed
         BinaryStructs.SerializeUint8(data, flags)
         
         # store the other fields
@@ -506,6 +532,7 @@ class ConnectionAcceptedPacket(Packet):
         # process the flags
         if flags & self.Flag_NoRegister: self.RegistrationDisabled = True
         else: self.RegistrationDisabled = False
+        self.Resumed = bool(flags & self.Flag_Resumed)
 
 
 class ConnectionRejectedPacket(Packet):
@@ -541,6 +568,9 @@ class ConnectionRejectedPacket(Packet):
         # All we have to do is write the rejection code...
         data = cStringIO.StringIO()
         BinaryStructs.SerializeUint8(data, self.RejectionCode)
+        retval = data.getvalue()
+        data.close()
+        return retval
     
     def DeserializeBody(self, stream):
         # Read in the rejection code.
@@ -685,6 +715,15 @@ class LoginChallengePacket(Packet):
 class FinishLoginPacket(Packet, RequestPacketMixin):
     '''Packet class for the FinishLogin packet type.'''
     
+    ##
+    ## Reason codes for the Failed reply
+    ##
+    
+    Reason_BadSolution = 0
+    '''Challenge solution is incorrect (wrong password).'''
+    Reason_AlreadyLoggedIn = 1
+    '''Account is already logged in from another connection.'''
+    
     def __init__(self, connection):
         # Set up packet.
         super(FinishLoginPacket, self).__init__(connection)
@@ -778,6 +817,17 @@ class RegisterPacket(Packet, RequestPacketMixin):
     newly created account.
     '''
     
+    ##
+    ## Reason codes for the Failed reply
+    ##
+    
+    Reason_GeneralFailure = 0
+    '''Registration failed for an unspecified reason.'''
+    Reason_UsernameTaken = 1
+    '''The requested username is already in use.'''
+    Reason_InvalidValue = 2
+    '''One of the fields is invalid (bad length, malformed email, etc.)'''
+    
     def __init__(self, connection):
         # Set up packet.
         super(RegisterPacket, self).__init__(connection)
@@ -820,6 +870,314 @@ class RegisterPacket(Packet, RequestPacketMixin):
             raise IncompletePacket
 
 
+class LoginTokenPacket(Packet):
+    '''
+    Packet class for the LoginToken packet type.
+    
+    The LoginToken packet is sent from the server to the client after a
+    successful login.  If the connection drops, the client may present the
+    token in the NegotiateConnection packet of its next connection to skip the
+    login entirely.  Each token can only be used once; a new one is sent after
+    every successful resume, and every few minutes while the connection stays
+    open.  Only the latest token is any good.
+    '''
+    
+    def __init__(self, connection):
+        # Set up packet.
+        super(LoginTokenPacket, self).__init__(connection)
+        self.PacketType = LoginToken
+        self._HasBody = True
+        
+        # Declare field attributes.
+        self.Token = b""
+        '''Login token value.  (Max length: 32 bytes)'''
+        self.ValidFor = 0
+        '''Number of seconds the token remains valid after disconnecting.'''
+    
+    def SerializeBody(self):
+        # Write data.
+        data = cStringIO.StringIO()
+        BinaryStructs.SerializeBinary(data, self.Token, maxlen=32)
+        BinaryStructs.SerializeUint16(data, self.ValidFor)
+        retval = data.getvalue()
+        data.close()
+        return retval
+    
+    def DeserializeBody(self, stream):
+        # Read data.
+        try:
+            self.Token = BinaryStructs.DeserializeBinary(stream, maxlen=32)
+            self.ValidFor = BinaryStructs.DeserializeUint16(stream)
+        except BinaryStructs.EndOfFile:
+            raise IncompletePacket
+
+
+class DisconnectPacket(Packet):
+    '''
+    Packet class for the Disconnect packet type.
+    
+    The Disconnect packet is sent by either side just before it closes the
+    connection.  The server uses it to tell players why they are being
+    disconnected; if the reason is Reason_Restart, the client should connect
+    again straight away and resume its session with its login token.
+    '''
+    
+    ##
+    ## Reason codes
+    ##
+    
+    Reason_Other = 0
+    '''Disconnected for an unspecified reason.'''
+    Reason_Quit = 1
+    '''The player quit.'''
+    Reason_Shutdown = 2
+    '''The server is shutting down.'''
+    Reason_Restart = 3
+    '''The server is restarting and can be reconnected to right away.'''
+    Reason_Kicked = 4
+    '''The player was removed from the server.'''
+    
+    
+    ##
+    ## Methods
+    ##
+    
+    def __init__(self, connection):
+        # Set up packet.
+        super(DisconnectPacket, self).__init__(connection)
+        self.PacketType = Disconnect
+        self._HasBody = True
+        
+        # Declare field attributes.
+        self.Reason = 0
+        '''Reason code for the disconnection.'''
+        self.Message = u""
+        '''Message to show the player.  (Max length: 256 characters)'''
+    
+    def SerializeBody(self):
+        # Write data.
+        data = cStringIO.StringIO()
+        BinaryStructs.SerializeUint8(data, self.Reason)
+        BinaryStructs.SerializeUTF8(data, self.Message, maxlen=256)
+        retval = data.getvalue()
+        data.close()
+        return retval
+    
+    def DeserializeBody(self, stream):
+        # Read data.
+        try:
+            self.Reason = BinaryStructs.DeserializeUint8(stream)
+            self.Message = BinaryStructs.DeserializeUTF8(stream, maxlen=256)
+        except BinaryStructs.EndOfFile:
+            raise IncompletePacket
+
+
+class AddObjectPacket(Packet):
+    '''
+    Packet class for the AddObject packet type.
+    
+    The AddObject packet is sent from the server to the client when a game
+    object comes into the player's view, with everything needed to show it.
+    The first object a player is told about when entering the game is their
+    own character.
+    '''
+    
+    ##
+    ## Object types
+    ##
+    
+    Type_Player = 0
+    '''The object is a player's character.'''
+    Type_NPC = 1
+    '''The object is a non-player character.'''
+    Type_Item = 2
+    '''The object is an item lying on the map.'''
+    
+    
+    ##
+    ## Methods
+    ##
+    
+    def __init__(self, connection):
+        # Set up packet.
+        super(AddObjectPacket, self).__init__(connection)
+        self.PacketType = AddObject
+        self._HasBody = True
+        
+        # Declare field attributes.
+        self.ObjectID = 0
+        '''Server-assigned ID of the object.'''
+        self.ObjectType = 0
+        '''Type of the object (one of the Type_ constants).'''
+        self.Name = u""
+        '''Name shown for the object.  (Max length: 32 characters)'''
+        self.Sprite = 0
+        '''ID of the object's sprite.'''
+        self.X = 0
+        '''Horizontal tile coordinate of the object.'''
+        self.Y = 0
+        '''Vertical tile coordinate of the object.'''
+        self.Direction = 0
+        '''Direction faced (0 = north, 1 = east, 2 = south, 3 = west).'''
+    
+    def SerializeBody(self):
+        # Write data.
+        data = cStringIO.StringIO()
+        BinaryStructs.SerializeUint32(data, self.ObjectID)
+        BinaryStructs.SerializeUint8(data, self.ObjectType)
+        BinaryStructs.SerializeUTF8(data, self.Name, maxlen=32)
+        BinaryStructs.SerializeUint32(data, self.Sprite)
+        BinaryStructs.SerializeUint16(data, self.X)
+        BinaryStructs.SerializeUint16(data, self.Y)
+        BinaryStructs.SerializeUint8(data, self.Direction)
+        retval = data.getvalue()
+        data.close()
+        return retval
+    
+    def DeserializeBody(self, stream):
+        # Read data.
+        try:
+            self.ObjectID = BinaryStructs.DeserializeUint32(stream)
+            self.ObjectType = BinaryStructs.DeserializeUint8(stream)
+            self.Name = BinaryStructs.DeserializeUTF8(stream, maxlen=32)
+            self.Sprite = BinaryStructs.DeserializeUint32(stream)
+            self.X = BinaryStructs.DeserializeUint16(stream)
+            self.Y = BinaryStructs.DeserializeUint16(stream)
+            self.Direction = BinaryStructs.DeserializeUint8(stream)
+        except BinaryStructs.EndOfFile:
+            raise IncompletePacket
+
+
+class DeleteObjectPacket(Packet):
+    '''
+    Packet class for the DeleteObject packet type.
+    
+    The DeleteObject packet is sent from the server to the client when a game
+    object leaves the player's view.  The client should forget the object; if
+    it comes back, it is sent again with an AddObject packet.
+    '''
+    
+    def __init__(self, connection):
+        # Set up packet.
+        super(DeleteObjectPacket, self).__init__(connection)
+        self.PacketType = DeleteObject
+        self._HasBody = True
+        
+        # Declare field attributes.
+        self.ObjectID = 0
+        '''Server-assigned ID of the object.'''
+    
+    def SerializeBody(self):
+        # Write data.
+        data = cStringIO.StringIO()
+        BinaryStructs.SerializeUint32(data, self.ObjectID)
+        retval = data.getvalue()
+        data.close()
+        return retval
+    
+    def DeserializeBody(self, stream):
+        # Read data.
+        try:
+            self.ObjectID = BinaryStructs.DeserializeUint32(stream)
+        except BinaryStructs.EndOfFile:
+            raise IncompletePacket
+
+
+class UpdateObjectPacket(Packet):
+    '''
+    Packet class for the UpdateObject packet type.
+    
+    The UpdateObject packet is sent from the server to the client with the
+    changes to the game objects in the player's view since the last update.
+    Each update only carries the fields of the object which have changed
+    since the server last sent it to this client, marked in a bitmask; every
+    so often, the server sends all the fields of everything in view instead,
+    so that the client can correct any drift.
+    '''
+    
+    ##
+    ## Field flags
+    ##
+    
+    Field_Sprite = 1
+    '''The update has a new sprite.'''
+    Field_X = 2
+    '''The update has a new horizontal coordinate.'''
+    Field_Y = 4
+    '''The update has a new vertical coordinate.'''
+    Field_Direction = 8
+    '''The update has a new direction.'''
+    Field_All = 15
+    '''Every field; set in full updates.'''
+    
+    MaxUpdates = 1024
+    '''Maximum number of updates in a single packet.'''
+    
+    
+    ##
+    ## Methods
+    ##
+    
+    def __init__(self, connection):
+        # Set up packet.
+        super(UpdateObjectPacket, self).__init__(connection)
+        self.PacketType = UpdateObject
+        self._HasBody = True
+        
+        # Declare field attributes.
+        self.Updates = []
+        '''
+        List of updates, as (object ID, field flags, sprite, x, y, direction)
+        tuples.  Fields whose flags aren't set are ignored when sending and
+        zero when received.
+        '''
+    
+    def SerializeBody(self):
+        # Write data.
+        data = cStringIO.StringIO()
+        BinaryStructs.SerializeUint16(data, len(self.Updates))
+        for objectid, fields, sprite, x, y, direction in self.Updates:
+            BinaryStructs.SerializeUint32(data, objectid)
+            BinaryStructs.SerializeUint8(data, fields)
+            if fields & self.Field_Sprite:
+                BinaryStructs.SerializeUint32(data, sprite)
+            if fields & self.Field_X:
+                BinaryStructs.SerializeUint16(data, x)
+            if fields & self.Field_Y:
+                BinaryStructs.SerializeUint16(data, y)
+            if fields & self.Field_Direction:
+                BinaryStructs.SerializeUint8(data, direction)
+        retval = data.getvalue()
+        data.close()
+        return retval
+    
+    def DeserializeBody(self, stream):
+        # Read data.
+        try:
+            count = BinaryStructs.DeserializeUint16(stream)
+            if count > self.MaxUpdates:
+                raise CorruptPacket("Too many object updates.")
+            updates = []
+            for i in xrange(count):
+                objectid = BinaryStructs.DeserializeUint32(stream)
+                fields = BinaryStructs.DeserializeUint8(stream)
+                if fields & ~self.Field_All:
+                    raise CorruptPacket("Unknown object update fields.")
+                sprite = x = y = direction = 0
+                if fields & self.Field_Sprite:
+                    sprite = BinaryStructs.DeserializeUint32(stream)
+                if fields & self.Field_X:
+                    x = BinaryStructs.DeserializeUint16(stream)
+                if fields & self.Field_Y:
+                    y = BinaryStructs.DeserializeUint16(stream)
+                if fields & self.Field_Direction:
+                    direction = BinaryStructs.DeserializeUint8(stream)
+                updates.append((objectid, fields, sprite, x, y, direction))
+            self.Updates = updates
+        except BinaryStructs.EndOfFile:
+            raise IncompletePacket
+
+
 PacketTypes = {
                NegotiateConnection: NegotiateConnectionPacket,
                ConnectionAccepted: ConnectionAcceptedPacket,
@@ -832,6 +1190,11 @@ PacketTypes = {
                FinishLogin: FinishLoginPacket,
                BadLogin: BadLoginPacket,
                Register: RegisterPacket,
+               LoginToken: LoginTokenPacket,
+               Disconnect: DisconnectPacket,
+               AddObject: AddObjectPacket,
+               DeleteObject: DeleteObjectPacket,
+               UpdateObject: UpdateObjectPacket,
                }
 '''
 dict which maps packet types to the appropriate packet classes.
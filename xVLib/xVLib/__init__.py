@@ -15,5 +15,5 @@
 # along with this program; if not, write to the Free Software Foundation,
 # Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
-__all__ = ["async_subprocess", "BinaryStructs", "Directories", "Maps",
-           "Networking", "Packets", "Version"]
+__all__ = ["async_subprocess", "BinaryStructs", "Capture", "Directories",
+           "Maps", "Networking", "Packets", "Version"]